@@ -0,0 +1,249 @@
+import argparse
+import os
+import time
+from collections import deque
+from typing import List
+
+import morningstar.midi
+from morningstar.delta import batch_checksum, line_number, NAME_LINE, PRESET_LINES, TRAILER_LINE
+from morningstar.midi import DeviceSession, ACK_POLL_INTERVAL
+from morningstar.model import Bank, LINE_EXPRESSION_PRESET, NUM_BANKS, NUM_BANK_LINES, NUM_PRESETS, NUM_EXPR_PRESETS
+from morningstar.sysex_converter import bank_to_yaml, iter_banks, validate_frame
+from morningstar.utils import atomic_write, sysex_command, sysex_line
+
+"""
+Backs up every bank on the device to YAML. A single Dump All streams the whole device, and each bank is written out
+as soon as all of its lines have arrived. Preset and expression preset lines which went missing or arrived corrupt are
+then asked for again with Send Next, several requests at a time. Bank names only come in dumps, so a bank whose name
+line was lost needs another Dump All.
+"""
+
+DUMP_ALL = [0x10, 0x01]
+SEND_NEXT = [0x03, 0x00]
+DEFAULT_WINDOW = 4
+# replies to Send Next only say which preset they are, so every request in flight must be for a different one
+MAX_WINDOW = NUM_PRESETS + NUM_EXPR_PRESETS
+DEFAULT_RETRIES = 3
+DEFAULT_TIMEOUT = 0.5
+CONTENT_LINES = range(NAME_LINE + 1, TRAILER_LINE)
+EXPRESSION_LINE = PRESET_LINES[LINE_EXPRESSION_PRESET][0]
+
+
+def send_next(bank: int, line: int) -> bytes:
+    """
+    The Send Next request for one preset or expression preset line of a bank
+    """
+    if line >= EXPRESSION_LINE:
+        return sysex_command(SEND_NEXT + [bank, line - EXPRESSION_LINE, 1])
+    return sysex_command(SEND_NEXT + [bank, line - CONTENT_LINES[0], 0])
+
+
+def bank_filename(number: int) -> str:
+    return "bank" + str(number + 1).zfill(3) + ".yml"
+
+
+class Backup:
+    """
+    Collects the lines of every bank from the device over a DeviceSession, writing each bank to the output directory
+    once it is complete. Each line missing after the Dump All is requested at most retries more times.
+    """
+
+    def __init__(self, session: DeviceSession, output: str, window: int = DEFAULT_WINDOW,
+                 retries: int = DEFAULT_RETRIES, timeout: float = DEFAULT_TIMEOUT, banks: int = NUM_BANKS):
+        self.session = session
+        self.output = output
+        self.window = max(1, min(window, MAX_WINDOW))
+        self.retries = retries
+        self.timeout = timeout
+        self.lines = [{} for _ in range(banks)]
+        self.written = set()
+        self.failed = set()
+        self.frames_received = 0
+        self.corrupt_frames = 0
+        self.requests = 0
+        self.retried = 0
+        self.attempts = {}
+
+    def run(self) -> bool:
+        """
+        Backs up every bank, returning whether all of them were written
+        """
+        for attempt in range(self.retries + 1):
+            if attempt == 0 or any(NAME_LINE not in lines for lines in self.lines):
+                self.dump_all()
+            self.send_next()
+            if len(self.written) == len(self.lines):
+                return True
+        return False
+
+    def missing(self, bank: int) -> List[int]:
+        return [line for line in [NAME_LINE] + list(CONTENT_LINES) if line not in self.lines[bank]]
+
+    def receive(self) -> List[bytes]:
+        """
+        The valid frames the device has sent since the last call, other than acknowledgements
+        """
+        self.session.poll()
+        frames = []
+        while self.session.received:
+            frame = self.session.received.popleft()
+            self.frames_received += 1
+            if validate_frame(frame):
+                self.corrupt_frames += 1
+            else:
+                frames.append(frame)
+        return frames
+
+    def dump_all(self):
+        """
+        Asks for every bank and keeps whichever lines are still missing until the device goes quiet. Each bank ends
+        with its trailer, so a line which comes no later in a bank than the one before it starts the next bank.
+        """
+        self.session.flush()
+        self.receive()
+        self.session.send(sysex_command(DUMP_ALL), expect_ack=False)
+        self.requests += 1
+        bank = -1
+        previous = NUM_BANK_LINES
+        last_received = time.monotonic()
+        while time.monotonic() - last_received < self.timeout:
+            frames = self.receive()
+            if not frames:
+                time.sleep(ACK_POLL_INTERVAL)
+                continue
+            last_received = time.monotonic()
+            for frame in frames:
+                line = line_number(frame)
+                if line is None:
+                    continue
+                if line <= previous:
+                    bank += 1
+                previous = line
+                if bank < len(self.lines) and bank not in self.written:
+                    self.lines[bank].setdefault(line, frame)
+                    self.bank_received(bank)
+            if bank == len(self.lines) - 1 and previous == TRAILER_LINE:
+                break
+
+    def send_next(self):
+        """
+        Asks for every missing preset line, keeping up to window requests in flight. A reply matches the oldest
+        request for its line, and any requests before that one are presumed lost.
+        """
+        attempts = self.attempts
+        queue = deque((bank, line) for bank in range(len(self.lines)) if bank not in self.written
+                      for line in self.missing(bank)
+                      if line != NAME_LINE and attempts.get((bank, line), 0) < self.retries)
+        in_flight = deque()
+
+        def retry(request):
+            if attempts[request] < self.retries:
+                queue.append(request)
+
+        while queue or in_flight:
+            while queue and len(in_flight) < self.window and \
+                    all(line != queue[0][1] for (_, line), _ in in_flight):
+                request = queue.popleft()
+                attempts[request] = attempts.get(request, 0) + 1
+                self.session.send(send_next(*request), expect_ack=False)
+                self.requests += 1
+                self.retried += 1
+                in_flight.append((request, time.monotonic()))
+            frames = self.receive()
+            for frame in frames:
+                line = line_number(frame)
+                matched = next((i for i, ((_, requested), _) in enumerate(in_flight) if requested == line), None)
+                if matched is None:
+                    continue
+                for _ in range(matched):
+                    retry(in_flight.popleft()[0])
+                bank, _ = in_flight.popleft()[0]
+                self.lines[bank].setdefault(line, frame)
+                self.bank_received(bank)
+            if in_flight and time.monotonic() - in_flight[0][1] > self.timeout:
+                retry(in_flight.popleft()[0])
+            elif not frames:
+                time.sleep(ACK_POLL_INTERVAL)
+
+    def bank_received(self, bank: int):
+        """
+        Writes the bank out if it has every line. If its trailer arrived the batch checksum has to match, otherwise
+        the lines are presumed to have come from a mix of banks and its presets are asked for again.
+        """
+        lines = self.lines[bank]
+        if bank in self.written or self.missing(bank):
+            return
+        frames = [bytes(Bank.header1), bytes(Bank.header2)] + [lines[line] for line in range(NAME_LINE, TRAILER_LINE)]
+        trailer = lines.get(TRAILER_LINE)
+        if trailer is None or bank in self.failed:
+            trailer = bytes(sysex_line([0x7E, 0x00, batch_checksum(frames)] + [0x00] * 7))
+        decoded = next(iter_banks(frames + [trailer], on_error=lambda error: None), None)
+        if decoded is None:
+            # Send Next asks for a line of a particular bank, so the lines it brings back can be trusted
+            print("Bank " + str(bank + 1) + " doesn't match its batch checksum, requesting its presets again")
+            self.failed.add(bank)
+            for line in CONTENT_LINES:
+                del lines[line]
+            return
+        with atomic_write(os.path.join(self.output, bank_filename(bank))) as output_file:
+            output_file.write(bank_to_yaml(decoded))
+        self.written.add(bank)
+
+    def summary(self, elapsed: float) -> str:
+        text = "Backed up " + str(len(self.written)) + " of " + str(len(self.lines)) + " banks in " + \
+            "{:.2f}".format(elapsed) + "s (" + str(self.requests) + " requests, " + str(self.frames_received) + \
+            " frames received"
+        if self.corrupt_frames:
+            text += ", " + str(self.corrupt_frames) + " corrupt"
+        if self.retried:
+            text += ", " + str(self.retried) + " lines requested again"
+        return text + ")"
+
+
+def backup(session: DeviceSession, output: str, window: int = DEFAULT_WINDOW, retries: int = DEFAULT_RETRIES,
+           timeout: float = DEFAULT_TIMEOUT) -> Backup:
+    os.makedirs(output, exist_ok=True)
+    started = time.monotonic()
+    result = Backup(session, output, window, retries, timeout)
+    if not result.run():
+        for bank in range(len(result.lines)):
+            if bank not in result.written:
+                print("Couldn't back up bank " + str(bank + 1) + ", missing lines " +
+                      ", ".join(str(line + 1) for line in result.missing(bank)))
+    print(result.summary(time.monotonic() - started))
+    return result
+
+
+def main(output: str, window: int = DEFAULT_WINDOW, retries: int = DEFAULT_RETRIES,
+         timeout: float = DEFAULT_TIMEOUT, emulate=False) -> bool:
+    port = None
+    if emulate:
+        from morningstar.emulator import Emulator
+        port = Emulator()
+    elif not morningstar.midi.can_send:
+        print("Can't open a MIDI port to back up from")
+        return False
+    with DeviceSession(port) as session:
+        return len(backup(session, output, window, retries, timeout).written) == NUM_BANKS
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Back up every bank on a Morningstar MC6 mk2 to YAML')
+    parser.add_argument('output', type=str, help='directory to write a YAML file per bank to')
+    parser.add_argument('-d', '--midi-device', dest='device', type=str,
+                        help='alternate midi device name (default is "Morningstar MC6MK2")')
+    parser.add_argument('--window', type=int, default=DEFAULT_WINDOW,
+                        help='Send Next requests which may be waiting for the device at once (default ' +
+                             str(DEFAULT_WINDOW) + ', at most ' + str(MAX_WINDOW) + ')')
+    parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES,
+                        help='times to ask again for a line which is missing or corrupt (default ' +
+                             str(DEFAULT_RETRIES) + ')')
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT,
+                        help='seconds to wait for a reply (default ' + str(DEFAULT_TIMEOUT) + ')')
+    parser.add_argument('--emulate', action='store_true', help='back up an emulated MC6, eg to benchmark')
+
+    args = vars(parser.parse_args())
+    if args["device"]:
+        morningstar.midi.device_name = args["device"]
+    if not main(args["output"], args["window"], args["retries"], args["timeout"], args["emulate"]):
+        exit(1)
@@ -0,0 +1,73 @@
+import hashlib
+import json
+import os
+from typing import Optional
+
+from morningstar.model import ENCODER_VERSION
+from morningstar.utils import atomic_write
+
+"""
+Tracks which YAML files have already been converted so that unchanged banks can be skipped on the next build
+"""
+
+MANIFEST_FILENAME = 'manifest.json'
+
+
+def hash_file(filename: str) -> str:
+    with open(filename, 'rb') as input_file:
+        return hashlib.sha256(input_file.read()).hexdigest()
+
+
+class BuildCache:
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.manifest_filename = os.path.join(directory, MANIFEST_FILENAME)
+        self.input_hashes = {}
+        try:
+            with open(self.manifest_filename, 'r') as manifest_file:
+                self.entries = json.load(manifest_file)["files"]
+        except (OSError, ValueError, KeyError):
+            self.entries = {}
+
+    def reason_to_build(self, input_filename: str, output_filename: str, file_format: str) -> Optional[str]:
+        """
+        Returns why the input needs converting, or None if the output from a previous build can be reused
+        """
+        key = os.path.abspath(input_filename)
+        input_hash = hash_file(input_filename)
+        self.input_hashes[key] = input_hash
+
+        entry = self.entries.get(key)
+        if entry is None:
+            return "no previous build"
+        if entry["encoder_version"] != ENCODER_VERSION:
+            return "encoder version changed from " + str(entry["encoder_version"]) + " to " + str(ENCODER_VERSION)
+        if entry["input_hash"] != input_hash:
+            return "input changed"
+        if entry["format"] != file_format or entry["output"] != os.path.abspath(output_filename):
+            return "output file or format changed"
+        try:
+            stat = os.stat(output_filename)
+        except OSError:
+            return "output is missing"
+        if entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+            return "output was modified"
+        return None
+
+    def record(self, input_filename: str, output_filename: str, file_format: str):
+        key = os.path.abspath(input_filename)
+        stat = os.stat(output_filename)
+        self.entries[key] = {
+            "input_hash": self.input_hashes.get(key) or hash_file(input_filename),
+            "encoder_version": ENCODER_VERSION,
+            "format": file_format,
+            "output": os.path.abspath(output_filename),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+        }
+
+    def save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with atomic_write(self.manifest_filename) as manifest_file:
+            json.dump({"files": self.entries}, manifest_file, indent=1, sort_keys=True)
@@ -32,5 +32,22 @@ def add_checksum_footer(bytes: List[int]) -> List[int]:
     return bytes
 
 
+def write_checksum_footer(buffer: bytearray, start: int, end: int) -> int:
+    """
+    Writes the checksum of buffer[start:end] followed by the end of sysex byte at buffer[end:end + 2], without
+    copying the line. Returns the checksum.
+    """
+    # xor every byte at once by folding the line (as one big integer) in half until a single byte remains
+    length = end - start
+    x = int.from_bytes(memoryview(buffer)[start:end], 'little')
+    while length > 1:
+        length = (length + 1) // 2
+        x = (x >> (length * 8)) ^ (x & ((1 << (length * 8)) - 1))
+    x &= 127
+    buffer[end] = x
+    buffer[end + 1] = 0xF7
+    return x
+
+
 if __name__ == "__main__":
     main(sys.argv[1:])
@@ -0,0 +1,244 @@
+from typing import Dict, List, Tuple
+
+"""
+One declarative spec per message type, giving the YAML config field stored in each of a message's three data bytes.
+Each spec is compiled at import into an encoder (config value to data bytes) and a decoder (data bytes to config
+value), so that both directions come from the same definition.
+"""
+
+
+class Value:
+    """
+    The config value itself (eg program_change: 5) stored in a data byte
+    """
+
+    def __init__(self, byte=1):
+        self.byte = byte
+
+    def encode(self, value, data: List[int]):
+        data[self.byte] = int(value) if value else 0
+
+    def decode(self, data, result):
+        return data[self.byte]
+
+
+class Choice:
+    """
+    A config value which is one of a list of names, stored as its index
+    """
+
+    def __init__(self, byte: int, choices: List[str]):
+        self.byte = byte
+        self.choices = choices
+        self.indexes = {choice: i for i, choice in enumerate(choices)}
+
+    def encode(self, value, data: List[int]):
+        if value not in self.indexes:
+            raise Exception("Unknown value: " + str(value) + " (should be one of " + str(self.choices) + ")")
+        data[self.byte] = self.indexes[value]
+
+    def decode(self, data, result):
+        return self.choices[data[self.byte]] if data[self.byte] < len(self.choices) else data[self.byte]
+
+
+class Items:
+    """
+    A config list whose items fill the data bytes in order
+    """
+
+    def encode(self, value, data: List[int]):
+        for i, item in enumerate(value[:3]):
+            data[1 + i] = item
+
+    def decode(self, data, result):
+        return [data[1], data[2], data[3]]
+
+
+class Constant:
+    """
+    A message with no data, whose config value is always the same (eg midi_clock_tap: true)
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    def encode(self, value, data: List[int]):
+        pass
+
+    def decode(self, data, result):
+        return self.value
+
+
+class Key:
+    """
+    A numbered field of a config dict, stored plus offset in a data byte. Fields sharing a byte are combined, with
+    mask selecting this field's bits. If only_if is given, the field is only stored when that field is set.
+    """
+    keyed = True
+
+    def __init__(self, key: str, byte: int, offset=0, default=0, mask=0x7F, only_if=None):
+        self.key = key
+        self.byte = byte
+        self.offset = offset
+        self.default = default
+        self.mask = mask
+        self.only_if = only_if
+
+    def encode(self, value, data: List[int]):
+        if self.only_if and not value.get(self.only_if):
+            return
+        data[self.byte] |= (value.get(self.key) or self.default) + self.offset
+
+    def decode(self, data, result):
+        if not self.only_if or result.get(self.only_if):
+            result[self.key] = (data[self.byte] & self.mask) - self.offset
+
+
+class Flag:
+    """
+    A true/false field of a config dict, stored as a bit of a data byte
+    """
+    keyed = True
+
+    def __init__(self, key: str, byte: int, bit=1):
+        self.key = key
+        self.byte = byte
+        self.bit = bit
+
+    def encode(self, value, data: List[int]):
+        if value.get(self.key):
+            data[self.byte] |= self.bit
+
+    def decode(self, data, result):
+        result[self.key] = bool(data[self.byte] & self.bit)
+
+
+class Number:
+    """
+    A field of a config dict too large for one byte, stored as digits in radix across several data bytes (most
+    significant first)
+    """
+    keyed = True
+
+    def __init__(self, key: str, bytes: Tuple[int, ...], radix: int):
+        self.key = key
+        self.bytes = bytes
+        self.radix = radix
+
+    def encode(self, value, data: List[int]):
+        number = value.get(self.key) or 0
+        for byte in reversed(self.bytes):
+            number, data[byte] = divmod(number, self.radix)
+
+    def decode(self, data, result):
+        number = 0
+        for byte in self.bytes:
+            number = number * self.radix + data[byte]
+        result[self.key] = number
+
+
+MESSAGE_SPECS = [
+    ("empty", Value()),
+    ("program_change", Value()),
+    ("control_change", Key("number", 1), Key("value", 2)),
+    ("note_on", Key("number", 1), Key("velocity", 2)),
+    ("note_off", Key("number", 1), Key("velocity", 2)),
+    ("realtime", Choice(1, ["nothing", "start", "stop", "continue"])),
+    ("sysex", Items()),
+    ("midi_clock", Number("bpm", (1, 2), 100), Flag("tap_menu", 3)),
+    ("pc_scroll_up", Flag("increment", 1, 16), Key("slot", 1, offset=-1, default=1, mask=0x0F, only_if="increment"),
+     Key("lower_limit", 2), Key("upper_limit", 3)),
+    ("pc_scroll_down", Value()),
+    ("device_bank_up", Value()),
+    ("device_bank_down", Value()),
+    ("device_bank_change_mode", Value()),
+    ("device_set_bank", Value()),
+    ("device_toggle_page", Value()),
+    ("device_set_toggle", Value()),
+    ("device_set_midi_thru", Value()),
+    ("device_select_expression_pedal_message", Value()),
+    ("device_looper_mode", Value()),
+    ("strymon_bank_up", Value()),
+    ("strymon_bank_down", Value()),
+    ("axefx_tuner", Value()),
+    ("toggle_preset", Value()),
+    ("delay", Value()),
+    ("midi_clock_tap", Constant(True)),
+]
+
+EXPRESSION_SPECS = [
+    ("empty", Value()),
+    ("expression_cc", Key("cc_number", 1), Key("cc_min_value", 2), Key("cc_max_value", 3)),
+    ("cc_toe_down", Key("cc_number", 1), Key("cc_value", 2)),
+    ("cc_heel_down", Key("cc_number", 1), Key("cc_value", 2)),
+    ("toe_down_toggle_channel", Key("number", 1, offset=-1, default=1), Key("channel1", 2, offset=-1, default=1),
+     Key("channel2", 3, offset=-1, default=1)),
+    ("toe_down_toggle_cc", Key("number", 1, offset=-1, default=1), Key("cc_number1", 2), Key("cc_number2", 3)),
+]
+
+
+class MessageCodec:
+    """
+    The compiled encoder and decoder for one message type
+    """
+
+    def __init__(self, message_type: str, message_id: int, fields):
+        self.message_type = message_type
+        self.id = message_id
+        self.encode = compile_encoder(fields)
+        self.decode = compile_decoder(fields)
+
+
+def compile_encoder(fields):
+    encoders = tuple(field.encode for field in fields)
+
+    def encode(value) -> Tuple[int, int, int]:
+        data = [0, 0, 0, 0]
+        for encoder in encoders:
+            encoder(value, data)
+        return data[1], data[2], data[3]
+    return encode
+
+
+def compile_decoder(fields):
+    decoders = tuple(field.decode for field in fields)
+    if not getattr(fields[0], 'keyed', False):
+        decoder = decoders[0]
+        return lambda data1, data2, data3: decoder((None, data1, data2, data3), None)
+
+    def decode(data1, data2, data3) -> dict:
+        data = (None, data1, data2, data3)
+        result = {}
+        for field_decoder in decoders:
+            field_decoder(data, result)
+        return result
+    return decode
+
+
+def compile_specs(specs) -> Tuple[List[str], Dict[str, MessageCodec], List[MessageCodec]]:
+    """
+    Returns the message type names in id order, their codecs by name and their codecs by id
+    """
+    codecs = [MessageCodec(spec[0], i, spec[1:]) for i, spec in enumerate(specs)]
+    return [codec.message_type for codec in codecs], {codec.message_type: codec for codec in codecs}, codecs
+
+
+MESSAGE_TYPES, MESSAGE_CODECS, MESSAGE_CODECS_BY_ID = compile_specs(MESSAGE_SPECS)
+EXPRESSION_TYPES, EXPRESSION_CODECS, EXPRESSION_CODECS_BY_ID = compile_specs(EXPRESSION_SPECS)
+
+
+def message_codecs_in(config: dict, codecs: Dict[str, MessageCodec]) -> List[MessageCodec]:
+    """
+    Returns the codec of each message type given in a config dict, in id order
+    """
+    found = [codecs[key] for key in config if key in codecs]
+    if len(found) > 1:
+        found.sort(key=lambda codec: codec.id)
+    return found
+
+
+def codec_for_id(message_id: int, codecs_by_id: List[MessageCodec]) -> MessageCodec:
+    if message_id >= len(codecs_by_id):
+        raise Exception("byte 0 was too large for expected: " + str(message_id) +
+                        " (message_type should be one of " + str([codec.message_type for codec in codecs_by_id]) + ")")
+    return codecs_by_id[message_id]
@@ -0,0 +1,125 @@
+import os
+import re
+from typing import List, Optional
+
+from morningstar.model import BANK_LINE_SPANS, BANK_SYSEX_LENGTH, NUM_BANK_LINES, NUM_PRESETS, NUM_EXPR_PRESETS, \
+    LINE_BANK_HEADER1, LINE_BANK_HEADER2, LINE_BANK_SETTINGS, LINE_PRESET, LINE_EXPRESSION_PRESET, LINE_BANK_TRAILER
+from morningstar.utils import atomic_write, STANDARD_HEADER, SYSEX_HEADER_LENGTH
+
+"""
+Works out which lines of a bank need sending to bring the device from its last known state to a new one
+"""
+
+DEFAULT_STATE_DIRECTORY = os.path.join(os.path.expanduser('~'), '.morningstar', 'device')
+# holds the key of the bank last uploaded to the device's current bank
+CURRENT_FILENAME = 'current'
+TRAILER_LINE = NUM_BANK_LINES - 1
+# the header lines are always sent so that the device treats the frames as a bank upload, and the trailer since its
+# batch checksum covers every line
+ALWAYS_SENT_LINES = (0, 1)
+NAME_LINE = 2
+# the first line and number of lines of each type of preset, whose lines are numbered within their type
+PRESET_LINES = {LINE_PRESET: (3, NUM_PRESETS), LINE_EXPRESSION_PRESET: (3 + NUM_PRESETS, NUM_EXPR_PRESETS)}
+FIXED_LINES = {LINE_BANK_HEADER1: 0, LINE_BANK_HEADER2: 1, LINE_BANK_SETTINGS: NAME_LINE,
+               LINE_BANK_TRAILER: TRAILER_LINE}
+
+
+def bank_line(data: bytes, line: int) -> bytes:
+    start, end = BANK_LINE_SPANS[line]
+    return data[start:end]
+
+
+def line_number(frame) -> Optional[int]:
+    """
+    Which of the lines of a bank a frame is, or None if it isn't a bank line
+    """
+    if tuple(frame[:SYSEX_HEADER_LENGTH]) != STANDARD_HEADER:
+        return None
+    line_type = tuple(frame[SYSEX_HEADER_LENGTH:SYSEX_HEADER_LENGTH + 2])
+    if line_type in PRESET_LINES:
+        first, count = PRESET_LINES[line_type]
+        number = frame[SYSEX_HEADER_LENGTH + 3]
+        return first + number if number < count else None
+    return FIXED_LINES.get(line_type)
+
+
+def batch_checksum(lines: List[bytes]) -> int:
+    """
+    The checksum a bank trailer carries of every line before it, given all the lines of the bank
+    """
+    result = 240
+    for line in lines[:TRAILER_LINE]:
+        result ^= line[-2]
+    return result & 127
+
+
+def changed_lines(previous: bytes, current: bytes) -> List[int]:
+    """
+    Returns the bank settings, preset and expression preset lines which differ between two encoded banks
+    """
+    return [line for line in range(len(ALWAYS_SENT_LINES), TRAILER_LINE)
+            if bank_line(previous, line) != bank_line(current, line)]
+
+
+def delta_frames(previous: Optional[bytes], current: bytes) -> List[bytes]:
+    """
+    Returns the frames to send to update a bank on the device from previous to current. The whole bank is sent if
+    the previous state is unknown, and nothing if the bank is unchanged.
+    """
+    if previous is None or len(previous) != BANK_SYSEX_LENGTH:
+        return [bank_line(current, line) for line in range(0, NUM_BANK_LINES)]
+    lines = changed_lines(previous, current)
+    if not lines:
+        return []
+    return [bank_line(current, line) for line in list(ALWAYS_SENT_LINES) + lines + [TRAILER_LINE]]
+
+
+class DeviceState:
+    """
+    The last known contents of each bank on a device, stored as one raw .syx file per bank, and which of them was last
+    uploaded to the device's current bank. Every upload goes to the current bank, so a bank's state is only what the
+    device holds while it is the current one.
+    """
+
+    def __init__(self, device_name: str, directory: str = DEFAULT_STATE_DIRECTORY):
+        self.directory = os.path.join(directory, re.sub(r'[^\w.-]+', '_', device_name))
+
+    def filename(self, key: str) -> str:
+        return os.path.join(self.directory, re.sub(r'[^\w.-]+', '_', key) + '.syx')
+
+    def load(self, key: str) -> Optional[bytes]:
+        try:
+            with open(self.filename(key), 'rb') as state_file:
+                return state_file.read()
+        except OSError:
+            return None
+
+    def current(self) -> Optional[str]:
+        """
+        The key of the bank last uploaded to the device's current bank, or None if unknown
+        """
+        try:
+            with open(os.path.join(self.directory, CURRENT_FILENAME), 'r') as current_file:
+                return current_file.read() or None
+        except OSError:
+            return None
+
+    def set_current(self, key: Optional[str]):
+        os.makedirs(self.directory, exist_ok=True)
+        with atomic_write(os.path.join(self.directory, CURRENT_FILENAME), 'w') as current_file:
+            current_file.write(key or '')
+
+    def previous(self, key: str) -> Optional[bytes]:
+        """
+        What the device's current bank holds if it was last uploaded from key, otherwise None
+        """
+        return self.load(key) if self.current() == key else None
+
+    def save(self, key: str, data: bytes):
+        """
+        Records a bank as uploaded to the device's current bank
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with atomic_write(self.filename(key), 'wb') as state_file:
+            state_file.write(data)
+        self.set_current(key)
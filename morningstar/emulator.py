@@ -0,0 +1,253 @@
+import argparse
+import random
+import threading
+import time
+from collections import deque
+from typing import List, Optional
+
+from morningstar.checksum import checksum
+from morningstar.delta import bank_line, batch_checksum, line_number, PRESET_LINES, TRAILER_LINE
+from morningstar.model import Bank, LINE_PRESET, LINE_EXPRESSION_PRESET, NUM_BANKS, NUM_BANK_LINES, BANK_LINE_SPANS
+from morningstar.sysex_converter import iter_banks
+from morningstar.utils import sysex_command, sysex_line, COMMAND_HEADER, COMMAND_LENGTH, STANDARD_HEADER, \
+    SYSEX_HEADER_LENGTH
+
+try:
+    import mido
+except ImportError:
+    mido = None
+
+"""
+An emulation of the MC6's sysex interface, so that uploads, dumps and the proxy can be exercised (and benchmarked)
+without the device. It behaves as a mido port: frames sent to it are answered either by iterating over
+iter_pending() or through a callback, as with a port opened with one.
+"""
+
+DEFAULT_PORT_NAME = 'Morningstar MC6MK2 emulator'
+
+BANK_UP = (0x00, 0x10)
+BANK_DOWN = (0x00, 0x11)
+COPY_BANK = (0x00, 0x12)
+PASTE_BANK = (0x00, 0x13)
+EDITOR_MODE = (0x00, 0x20)
+DUMP_ALL = (0x10, 0x01)
+DUMP_BANK = (0x10, 0x02)
+SEND_NEXT = (0x03, 0x00)
+PING = (0x00, 0x7D)
+ACKNOWLEDGE = (0x00, 0x7F)
+# requests answered with data rather than an acknowledgement
+UNACKNOWLEDGED = {DUMP_ALL, DUMP_BANK, SEND_NEXT, PING, ACKNOWLEDGE}
+
+ACKNOWLEDGE_FRAME = sysex_command(list(ACKNOWLEDGE))
+PING_REPLY = bytes(sysex_line(list(PING) + [0x01] + [0x00] * (COMMAND_LENGTH - 3)))
+
+
+class Emulator:
+    """
+    Holds NUM_BANKS banks and a current bank. Checks the checksum of every frame it is sent, acknowledging each one
+    which is valid. Bank uploads (whole or just the changed lines) are applied to the current bank when the trailer
+    arrives with a batch checksum matching the result. Answers Dump Bank, Dump All, Send Next (bank, preset and
+    expression flag, counting from 0), and Ping in editor mode. Bank up/down and copy/paste bank change the banks.
+
+    Each frame takes delay seconds to process, and each line of a dump delay seconds to send, one after another.
+    drop_rate of frames sent to the device are lost before it sees them.
+    """
+
+    def __init__(self, delay: float = 0.0, drop_rate: float = 0.0, callback=None, seed: Optional[int] = None,
+                 editor_mode=False, acknowledge=True, banks: Optional[List[Bank]] = None):
+        if mido is None:
+            raise Exception("The emulator requires mido- run 'pip install mido'")
+        self.delay = delay
+        self.drop_rate = drop_rate
+        self.callback = callback
+        self.random = random.Random(seed)
+        self.editor_mode = editor_mode
+        self.acknowledge = acknowledge
+        banks = list(banks or []) + [Bank("Bank " + str(i + 1)) for i in range(len(banks or []), NUM_BANKS)]
+        self.banks = [bank.to_sysex_bytes() for bank in banks]
+        self.current = 0
+        self.clipboard = None
+        self.upload = None
+        self.lock = threading.Condition()
+        self.pending = deque()
+        self.busy_until = 0.0
+        self.closed = False
+        self.thread = None
+        self.frames_received = 0
+        self.frames_dropped = 0
+        self.checksum_errors = 0
+        self.banks_uploaded = 0
+        self.uploads_rejected = 0
+        self.frames_sent = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def send(self, message):
+        """
+        Called with each message sent to the device
+        """
+        if message.type != 'sysex':
+            return
+        frame = bytes(message.bin())
+        with self.lock:
+            self.frames_received += 1
+            if self.drop_rate and self.random.random() < self.drop_rate:
+                self.frames_dropped += 1
+                return
+            self.busy_until = max(self.busy_until, time.monotonic()) + self.delay
+            for reply in self.receive(frame):
+                self.reply(reply)
+
+    def reply(self, frame: bytes):
+        self.pending.append((self.busy_until, mido.Message.from_bytes(frame)))
+        self.frames_sent += 1
+        if self.callback is not None:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.deliver, daemon=True)
+                self.thread.start()
+            self.lock.notify()
+
+    def receive(self, frame: bytes) -> List[bytes]:
+        """
+        Handles a single frame, returning the frames the device sends in answer
+        """
+        if checksum(frame[:-2]) != frame[-2]:
+            self.checksum_errors += 1
+            return []
+        header = tuple(frame[:SYSEX_HEADER_LENGTH])
+        function = tuple(frame[SYSEX_HEADER_LENGTH:SYSEX_HEADER_LENGTH + 2])
+        if header == STANDARD_HEADER:
+            self.receive_line(frame)
+            return [ACKNOWLEDGE_FRAME] if self.acknowledge else []
+        if header != COMMAND_HEADER:
+            return []
+        arguments = frame[SYSEX_HEADER_LENGTH + 2:SYSEX_HEADER_LENGTH + COMMAND_LENGTH]
+        if function == DUMP_BANK:
+            self.dump(self.banks[self.current])
+        elif function == DUMP_ALL:
+            for data in self.banks:
+                self.dump(data)
+        elif function == SEND_NEXT:
+            bank, preset, expression = arguments[0], arguments[1], arguments[2]
+            first, count = PRESET_LINES[LINE_EXPRESSION_PRESET if expression else LINE_PRESET]
+            if bank < NUM_BANKS and preset < count:
+                return [bank_line(self.banks[bank], first + preset)]
+        elif function == PING:
+            return [PING_REPLY] if self.editor_mode else []
+        elif function == BANK_UP:
+            self.current = (self.current + 1) % NUM_BANKS
+        elif function == BANK_DOWN:
+            self.current = (self.current - 1) % NUM_BANKS
+        elif function == COPY_BANK:
+            self.clipboard = self.banks[self.current]
+        elif function == PASTE_BANK and self.clipboard is not None:
+            self.banks[self.current] = self.clipboard
+        elif function == EDITOR_MODE:
+            self.editor_mode = not self.editor_mode
+        if function in UNACKNOWLEDGED or not self.acknowledge:
+            return []
+        return [ACKNOWLEDGE_FRAME]
+
+    def receive_line(self, frame: bytes):
+        """
+        Collects the lines of an upload between the first header and the trailer, then applies them to the current
+        bank if the trailer's batch checksum matches
+        """
+        line = line_number(frame)
+        if line == 0:
+            self.upload = {}
+        elif self.upload is None or line is None:
+            return
+        elif line == TRAILER_LINE:
+            current = self.banks[self.current]
+            lines = [self.upload.get(line, bank_line(current, line)) for line in range(TRAILER_LINE)] + [frame]
+            self.upload = None
+            if frame[SYSEX_HEADER_LENGTH + 2] != batch_checksum(lines):
+                self.uploads_rejected += 1
+                return
+            self.banks[self.current] = b''.join(lines)
+            self.banks_uploaded += 1
+        elif line > 1:
+            self.upload[line] = frame
+
+    def dump(self, data: bytes):
+        for start, end in BANK_LINE_SPANS:
+            self.busy_until += self.delay
+            self.reply(data[start:end])
+
+    def bank(self, number: int) -> Bank:
+        """
+        Decodes one of the banks held
+        """
+        return next(iter_banks([bank_line(self.banks[number], line) for line in range(NUM_BANK_LINES)]))
+
+    def iter_pending(self):
+        """
+        The messages the device has sent since the last call, as for a mido port opened without a callback
+        """
+        messages = []
+        with self.lock:
+            now = time.monotonic()
+            while self.pending and self.pending[0][0] <= now:
+                messages.append(self.pending.popleft()[1])
+        return iter(messages)
+
+    def deliver(self):
+        while True:
+            with self.lock:
+                while not self.closed and (not self.pending or self.pending[0][0] > time.monotonic()):
+                    self.lock.wait(self.pending[0][0] - time.monotonic() if self.pending else None)
+                if self.closed:
+                    return
+                _, message = self.pending.popleft()
+            self.callback(message)
+
+    def stats(self) -> dict:
+        return {"frames_received": self.frames_received, "frames_dropped": self.frames_dropped,
+                "checksum_errors": self.checksum_errors, "banks_uploaded": self.banks_uploaded,
+                "uploads_rejected": self.uploads_rejected, "frames_sent": self.frames_sent}
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.lock.notify()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+
+def main(port_name=DEFAULT_PORT_NAME, delay=0.0, drop_rate=0.0, editor_mode=False):
+    """
+    Serves the emulator on a virtual MIDI port until interrupted
+    """
+    port = None
+
+    def send_to_port(message):
+        if port is not None:
+            port.send(message)
+
+    with Emulator(delay, drop_rate, callback=send_to_port, editor_mode=editor_mode) as emulator:
+        with mido.open_ioport(port_name, virtual=True, callback=emulator.send) as port:
+            print("Emulating an MC6 on virtual port '" + port_name + "'")
+            try:
+                while True:
+                    time.sleep(1)
+            except KeyboardInterrupt:
+                print(emulator.stats())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Emulate a Morningstar MC6 mk2 on a virtual MIDI port')
+    parser.add_argument('-n', '--name', type=str, default=DEFAULT_PORT_NAME,
+                        help='virtual port name (default "' + DEFAULT_PORT_NAME + '")')
+    parser.add_argument('--delay', type=float, default=0.0,
+                        help='seconds the device takes to handle each frame and send each line of a dump')
+    parser.add_argument('--drop-rate', dest='drop_rate', type=float, default=0.0,
+                        help='fraction of frames sent to the device which are lost (eg 0.01)')
+    parser.add_argument('--editor-mode', dest='editor_mode', action='store_true',
+                        help='start in editor mode, so that Ping is answered')
+    args = vars(parser.parse_args())
+    main(args["name"], args["delay"], args["drop_rate"], args["editor_mode"])
@@ -0,0 +1,95 @@
+import hashlib
+from typing import List
+
+from morningstar.model import Bank, ExpressionPreset, MemoizedLine, Preset, freeze, LINE_PRESET, NUM_PRESETS, \
+    NUM_EXPR_PRESETS
+from morningstar.utils import SYSEX_HEADER_LENGTH, SYSEX_FOOTER_LENGTH
+
+"""
+Shares presets between the banks of a library. Banks tend to repeat the same presets (a tuner, tap tempo or looper
+switch), so a store keeps a single frozen instance of each distinct preset, keyed by a hash of its encoded line, and
+banks hold that instance rather than a copy of their own. A shared preset is only decoded and encoded once, however
+many banks it is in. The switch a preset is on is part of its line, so presets are shared between the same switch of
+each bank.
+"""
+
+KEY_SIZE = 16
+
+
+def line_key(line) -> bytes:
+    return hashlib.blake2b(line, digest_size=KEY_SIZE).digest()
+
+
+class PresetStore:
+    """
+    One frozen preset or expression preset for each distinct encoded line. Banks given to share() (or decoded by
+    sysex_converter.iter_banks with the store) hold the store's presets, which can't be changed in place:
+    Bank.editable() replaces a shared preset with a copy belonging to just that bank.
+    """
+
+    def __init__(self):
+        self.presets = {}
+        self.blanks = None
+        self.lookups = 0
+
+    def __len__(self) -> int:
+        return len(set(map(id, self.presets.values())))
+
+    def key(self, preset: MemoizedLine) -> bytes:
+        return line_key(preset.encoded_line())
+
+    def intern(self, preset: MemoizedLine) -> MemoizedLine:
+        """
+        The shared preset with the same encoding, freezing and keeping this one if there isn't one yet
+        """
+        if preset._frozen:
+            return preset
+        self.lookups += 1
+        key = self.key(preset)
+        shared = self.presets.get(key)
+        if shared is None:
+            shared = self.presets[key] = freeze(preset)
+        return shared
+
+    def decode(self, line) -> MemoizedLine:
+        """
+        The shared preset for a preset or expression preset line, which is only decoded if the line hasn't been
+        seen before
+        """
+        self.lookups += 1
+        key = line_key(line)
+        shared = self.presets.get(key)
+        if shared is None:
+            data = line[SYSEX_HEADER_LENGTH:-SYSEX_FOOTER_LENGTH]
+            preset = Preset(data[3]) if tuple(data[0:2]) == LINE_PRESET else ExpressionPreset(data[3])
+            preset.from_sysex(data)
+            shared = self.intern(preset)
+            # the line may not have been encoded exactly as the model would, so it is a key of its own
+            self.presets[key] = shared
+        return shared
+
+    def blank_bank(self, name) -> Bank:
+        """
+        A bank of shared empty presets
+        """
+        if self.blanks is None:
+            self.blanks = ([self.intern(Preset(i)) for i in range(NUM_PRESETS)],
+                           [self.intern(ExpressionPreset(i)) for i in range(NUM_EXPR_PRESETS)])
+        return Bank(name, *self.blanks)
+
+    def share(self, bank: Bank) -> Bank:
+        """
+        Replaces each of a bank's presets with the shared one with the same encoding
+        """
+        for presets in (bank.presets, bank.expression_presets):
+            for i, preset in enumerate(presets):
+                shared = self.intern(preset)
+                if shared is not preset:
+                    presets[i] = shared
+        return bank
+
+    def keys(self, bank: Bank) -> List[bytes]:
+        """
+        The key of each of a bank's presets then expression presets, which refer to them in the store
+        """
+        return [self.key(preset) for preset in bank.presets + bank.expression_presets]
@@ -0,0 +1,66 @@
+import argparse
+import gc
+import os
+import tracemalloc
+
+import yaml
+
+from morningstar.delta import bank_line
+from morningstar.model import Action, Bank, Message, ACTIONS, MAX_MESSAGES, NUM_BANK_LINES
+from morningstar.codec import EXPRESSION_TYPES, MESSAGE_TYPES
+from morningstar.sysex_converter import iter_banks
+from morningstar.yaml_converter import YamlLoader, convert_to_bank
+
+"""
+Measures the memory held by the model for each loaded bank with tracemalloc, for a bank converted from YAML and for a
+bank decoded from sysex with every message slot in use
+"""
+
+DEFAULT_BANKS = 500
+DEFAULT_YAML = os.path.join(os.path.dirname(__file__), '..', 'yaml', 'debug.yml')
+
+
+def full_bank() -> Bank:
+    bank = Bank("FULL")
+    for preset in bank.presets:
+        preset.actions = [Action(ACTIONS[1 + i % (len(ACTIONS) - 1)], [Message(MESSAGE_TYPES[1 + i], i, i, i)])
+                          for i in range(MAX_MESSAGES - 1)]
+    for preset in bank.expression_presets:
+        preset.messages = [Message(EXPRESSION_TYPES[1], i, 0, 127) for i in range(MAX_MESSAGES - 1)]
+    return bank
+
+
+def measure(load, count: int) -> int:
+    """
+    The bytes allocated per bank by count calls to load, with the banks all kept alive
+    """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    banks = [load() for _ in range(count)]
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del banks
+    return used // count
+
+
+def main(count: int = DEFAULT_BANKS, yaml_filename: str = DEFAULT_YAML):
+    with open(yaml_filename, 'r') as yaml_file:
+        config = yaml.load(yaml_file, Loader=YamlLoader)["bank"]
+    data = full_bank().to_sysex_bytes()
+    frames = [bank_line(data, line) for line in range(NUM_BANK_LINES)]
+
+    results = [(os.path.basename(yaml_filename), lambda: convert_to_bank(config)),
+               ("every slot in use, from sysex", lambda: next(iter_banks(frames)))]
+    for name, load in results:
+        print(name + ": " + str(measure(load, count)) + " bytes per bank")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measure the memory used by each bank loaded into the model')
+    parser.add_argument('-n', '--banks', type=int, default=DEFAULT_BANKS, help='banks to load (default ' +
+                        str(DEFAULT_BANKS) + ')')
+    parser.add_argument('file', type=str, nargs='?', default=DEFAULT_YAML, help='YAML bank to load (default ' +
+                        'yaml/debug.yml)')
+    args = vars(parser.parse_args())
+    main(args["banks"], args["file"])
@@ -1,6 +1,25 @@
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Optional
+
+from morningstar.checksum import checksum
+from morningstar.delta import delta_frames
+from morningstar.model import LINE_BANK_HEADER1, LINE_BANK_TRAILER, NUM_BANK_LINES, BANK_SYSEX_LENGTH
+from morningstar.utils import sysex_command, SYSEX_HEADER_LENGTH
+
+DUMP_BANK = [0x10, 0x02]
+ACKNOWLEDGE = bytes([0x00, 0x7F])
+ACK_POLL_INTERVAL = 0.0005
+RECEIVED_LIMIT = 1024
 
 can_send = False
 device_name = 'Morningstar MC6MK2'
+# seconds to wait between frames, frames which may be sent ahead of the device's acknowledgements and how long to
+# wait for an acknowledgement before giving up on it. Set from the command line like device_name.
+default_frame_gap = 0.0
+default_window = 4
+default_ack_timeout = 0.5
 try:
     import mido
 
@@ -19,10 +38,210 @@ except ImportError:
     print("Could not load module mido- run 'pip install mido' if you wish to send midi commands directly")
 
 
-def send(data_bytes):
-    if can_send:
-        with mido.open_ioport(device_name) as device_port:
-            device_port.send(mido.Message('sysex', data=data_bytes[1:-1]))
+def function_bytes(frame) -> bytes:
+    return bytes(frame[SYSEX_HEADER_LENGTH:SYSEX_HEADER_LENGTH + 2])
+
+
+class DeviceSession:
+    """
+    A connection to the device which stays open for any number of frames. Frames are sent at least frame_gap seconds
+    apart, with at most window frames waiting for the device's Acknowledge. If no acknowledgement has ever arrived
+    when one times out, the device is assumed not to send them and frames are only paced from then on.
+    """
+
+    def __init__(self, port=None, frame_gap: Optional[float] = None, window: Optional[int] = None,
+                 ack_timeout: Optional[float] = None):
+        if port is None:
+            port = mido.open_ioport(device_name)
+        self.port = port
+        self.frame_gap = default_frame_gap if frame_gap is None else frame_gap
+        self.window = max(1, default_window if window is None else window)
+        self.ack_timeout = default_ack_timeout if ack_timeout is None else ack_timeout
+        self.acknowledges = None
+        self.in_flight = 0
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.acks_received = 0
+        self.acks_missed = 0
+        self.received = deque(maxlen=RECEIVED_LIMIT)
+        self.started = None
+        self.finished = None
+        self.last_sent = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.port is None:
+            return
+        try:
+            self.flush()
+        finally:
+            self.port.close()
+            self.port = None
+
+    def send(self, frame, expect_ack=True):
+        """
+        Sends a single complete F0...F7 frame, waiting first if the window is full or the frame gap hasn't passed.
+        Requests which the device answers with data rather than an Acknowledge don't take a place in the window.
+        """
+        while self.in_flight >= self.window and self.acknowledges is not False:
+            self.wait_for_ack()
+        delay = self.last_sent + self.frame_gap - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        self.port.send(mido.Message('sysex', data=frame[1:-1]))
+        self.last_sent = self.finished = time.monotonic()
+        if self.started is None:
+            self.started = self.last_sent
+        self.frames_sent += 1
+        self.bytes_sent += len(frame)
+        if expect_ack and self.acknowledges is not False:
+            self.in_flight += 1
+        self.poll()
+
+    def send_frames(self, frames):
+        for frame in frames:
+            self.send(frame)
+
+    def poll(self) -> int:
+        """
+        Handles any messages waiting from the device and returns the number of acknowledgements among them. Other
+        sysex frames are kept in received.
+        """
+        acks = 0
+        for message in self.port.iter_pending():
+            if message.type != 'sysex':
+                continue
+            frame = bytes([0xF0]) + bytes(message.data) + bytes([0xF7])
+            if function_bytes(frame) == ACKNOWLEDGE:
+                acks += 1
+            else:
+                self.received.append(frame)
+        if acks:
+            self.acknowledges = True
+            self.acks_received += acks
+            self.in_flight = max(0, self.in_flight - acks)
+            self.finished = time.monotonic()
+        return acks
+
+    def wait_for_ack(self):
+        deadline = time.monotonic() + self.ack_timeout
+        while time.monotonic() < deadline:
+            if self.poll():
+                return
+            time.sleep(ACK_POLL_INTERVAL)
+        if self.acknowledges is None:
+            self.acknowledges = False
+            self.in_flight = 0
+        else:
+            # presume the oldest frame arrived and its acknowledgement was lost
+            self.acks_missed += 1
+            self.in_flight -= 1
+
+    def flush(self):
+        """
+        Waits until every frame sent has been acknowledged (or timed out)
+        """
+        while self.in_flight and self.acknowledges is not False:
+            self.wait_for_ack()
+
+    def request_bank_dump(self, timeout=2.0) -> Optional[bytes]:
+        """
+        Asks the device to dump its current bank and returns the 18 lines received, or None if a complete bank with
+        valid checksums didn't arrive before the timeout
+        """
+        self.flush()
+        self.received.clear()
+        self.send(sysex_command(DUMP_BANK), expect_ack=False)
+        frames = []
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            self.poll()
+            if not self.received:
+                time.sleep(ACK_POLL_INTERVAL)
+                continue
+            frame = self.received.popleft()
+            if function_bytes(frame) == bytes(LINE_BANK_HEADER1):
+                frames = []
+            frames.append(frame)
+            if function_bytes(frame) == bytes(LINE_BANK_TRAILER):
+                break
+        data = b''.join(frames)
+        if len(frames) != NUM_BANK_LINES or len(data) != BANK_SYSEX_LENGTH or \
+                any(checksum(frame[:-2]) != frame[-2] for frame in frames):
+            return None
+        return data
+
+    def frames_per_second(self) -> float:
+        if self.started is None or self.finished <= self.started:
+            return 0.0
+        return self.frames_sent / (self.finished - self.started)
+
+    def summary(self) -> str:
+        return "Sent " + str(self.frames_sent) + " frames (" + str(self.bytes_sent) + " bytes) at " + \
+            "{:.1f}".format(self.frames_per_second()) + " frames/sec" + \
+            (", " + str(self.acks_missed) + " acknowledgements missed" if self.acks_missed else "")
+
+
+@contextmanager
+def open_session(enabled=True):
+    """
+    Opens a session with the device, yielding None instead if sending isn't enabled or possible. The achieved rate
+    is printed when the session closes.
+    """
+    if not enabled or not can_send:
+        yield None
+        return
+    with DeviceSession() as session:
+        yield session
+    if session.frames_sent:
+        print(session.summary())
+
+
+def send(data_bytes, session: Optional[DeviceSession] = None):
+    """
+    Sends a single frame, or a list of frames such as the lines from Bank.to_sysex
+    """
+    frames = [data_bytes] if data_bytes and isinstance(data_bytes[0], int) else data_bytes
+    send_frames(frames, session)
+
+
+def send_frames(frames, session: Optional[DeviceSession] = None) -> bool:
+    """
+    Sends each complete F0...F7 frame as a separate sysex message, over a new session if none is given
+    """
+    if session is None:
+        with open_session() as session:
+            return session is not None and send_frames(frames, session)
+    session.send_frames(frames)
+    return True
+
+
+def send_bank_lines(frames, data: bytes, session: DeviceSession) -> bool:
+    """
+    Sends lines of a bank (as from delta_frames) to the device's current bank, then dumps the bank back to confirm
+    the device took them, since it acknowledges every frame even if the trailer's batch checksum doesn't match. If
+    only some of the lines were sent the whole bank is sent instead. Returns whether the device is known to hold the
+    bank.
+    """
+    session.send_frames(frames)
+    if session.request_bank_dump() == data:
+        return True
+    if len(frames) == NUM_BANK_LINES:
+        return False
+    print("The device's current bank didn't take the changed lines, sending the whole bank")
+    return send_bank_lines(delta_frames(None, data), data, session)
+
+
+def request_bank_dump(timeout=2.0, session: Optional[DeviceSession] = None) -> Optional[bytes]:
+    if session is None:
+        with open_session() as session:
+            return session.request_bank_dump(timeout) if session else None
+    return session.request_bank_dump(timeout)
 
 
 if __name__ == "__main__":
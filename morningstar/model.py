@@ -1,10 +1,59 @@
-from math import floor
+import copy
 from typing import List
 
-from morningstar.utils import sysex_line, sysex_text, parse_string
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
+from morningstar.codec import MESSAGE_TYPES, MESSAGE_CODECS, EXPRESSION_CODECS, MESSAGE_CODECS_BY_ID, \
+    EXPRESSION_CODECS_BY_ID, MessageCodec, codec_for_id
+from morningstar.codec import EXPRESSION_TYPES
+from morningstar.utils import sysex_line, parse_string, sysex_line_length, finish_sysex_line, \
+    write_sysex_text, SYSEX_HEADER_LENGTH
+
+# bump whenever a change to the encoder alters the generated sysex, so that cached build outputs are discarded
+ENCODER_VERSION = 1
+
+NUM_BANKS = 30
 NUM_PRESETS = 12  # for MC 6
 NUM_EXPR_PRESETS = 2
+NUM_BANK_LINES = 3 + NUM_PRESETS + NUM_EXPR_PRESETS + 1
+
+# field offsets within the data section of a line (ie after the standard sysex header)
+MESSAGE_LENGTH = 6
+MAX_MESSAGES = 16
+COMMAND_DATA_LENGTH = 10
+BANK_NAME_OFFSET = 12
+BANK_NAME_LENGTH = 24
+BANK_SETTINGS_DATA_LENGTH = BANK_NAME_OFFSET + BANK_NAME_LENGTH
+PRESET_MESSAGES_OFFSET = 10
+PRESET_BIT_FIELD_OFFSET = PRESET_MESSAGES_OFFSET + MAX_MESSAGES * MESSAGE_LENGTH
+PRESET_NAME_OFFSET = PRESET_BIT_FIELD_OFFSET + 2
+PRESET_NAME_LENGTH = 8
+PRESET_TOGGLE_NAME_OFFSET = PRESET_NAME_OFFSET + PRESET_NAME_LENGTH
+PRESET_LONG_NAME_OFFSET = PRESET_TOGGLE_NAME_OFFSET + PRESET_NAME_LENGTH
+PRESET_LONG_NAME_LENGTH = 24
+PRESET_DATA_LENGTH = PRESET_LONG_NAME_OFFSET + PRESET_LONG_NAME_LENGTH
+PRESET_TOGGLE_MODE_BIT = 0x08
+PRESET_BLINK_MODE_BIT = 0x04
+
+# first two data bytes of each line, identifying what the line holds
+LINE_BANK_HEADER1 = (0x02, 0x02)
+LINE_BANK_HEADER2 = (0x01, 0x11)
+LINE_BANK_SETTINGS = (0x01, 0x06)
+LINE_PRESET = (0x01, 0x07)
+LINE_EXPRESSION_PRESET = (0x01, 0x08)
+LINE_BANK_TRAILER = (0x7E, 0x00)
+
+COMMAND_LINE_LENGTH = sysex_line_length(COMMAND_DATA_LENGTH)
+BANK_SETTINGS_LINE_LENGTH = sysex_line_length(BANK_SETTINGS_DATA_LENGTH)
+PRESET_LINE_LENGTH = sysex_line_length(PRESET_DATA_LENGTH)
+BANK_LINE_LENGTHS = (COMMAND_LINE_LENGTH, COMMAND_LINE_LENGTH, BANK_SETTINGS_LINE_LENGTH) + \
+                    (PRESET_LINE_LENGTH,) * (NUM_PRESETS + NUM_EXPR_PRESETS) + \
+                    (COMMAND_LINE_LENGTH,)
+BANK_LINE_SPANS = tuple((sum(BANK_LINE_LENGTHS[:i]), sum(BANK_LINE_LENGTHS[:i + 1])) for i in range(NUM_BANK_LINES))
+BANK_SYSEX_LENGTH = sum(BANK_LINE_LENGTHS)
 ACTIONS = [
     "no_action",
     "press",
@@ -17,51 +66,211 @@ ACTIONS = [
     "long_double_tap_release",
     "release_all",
 ]
-MESSAGE_TYPES = [
-    "empty",
-    "program_change",
-    "control_change",
-    "note_on",
-    "note_off",
-    "realtime",
-    "sysex",
-    "midi_clock",
-    "pc_scroll_up",
-    "pc_scroll_down",
-    "device_bank_up",
-    "device_bank_down",
-    "device_bank_change_mode",
-    "device_set_bank",
-    "device_toggle_page",
-    "device_set_toggle",
-    "device_set_midi_thru",
-    "device_select_expression_pedal_message",
-    "device_looper_mode",
-    "strymon_bank_up",
-    "strymon_bank_down",
-    "axefx_tuner",
-    "toggle_preset",
-    "delay",
-    "midi_clock_tap",
-]
-EXPRESSION_TYPES = [
-    "empty",
-    "expression_cc",
-    "cc_toe_down",
-    "cc_heel_down",
-    "toe_down_toggle_channel",
-    "toe_down_toggle_cc",
-]
-
+ACTION_IDS = {action: i for i, action in enumerate(ACTIONS)}
+# messages hold their type as an index into every message and expression type name, message types first as they take
+# precedence where a name is both
+MESSAGE_TYPE_NAMES = MESSAGE_TYPES + [name for name in EXPRESSION_TYPES if name not in MESSAGE_CODECS]
+MESSAGE_TYPE_IDS = {name: i for i, name in enumerate(MESSAGE_TYPE_NAMES)}
+MESSAGE_TYPE_CODECS = [MESSAGE_CODECS.get(name) or EXPRESSION_CODECS[name] for name in MESSAGE_TYPE_NAMES]
+# the action byte holds the action id doubled, plus one for the second toggle position or 32 for both
+ACTION_TOGGLE_BOTH = 32
+
+
+class TrackedList(list):
+    """
+    A list which tells its owner whenever it is modified, and makes the owner the parent of each item added to it
+    """
+    _owner = None
+
+    def __init__(self, items=(), owner=None):
+        super().__init__(items)
+        self._owner = owner
+        for item in self:
+            self._adopt(item)
+
+    def __reduce__(self):
+        # copied or pickled without the owner, which adopts the copy once it has been restored itself
+        return TrackedList, (list(self),)
+
+    def _adopt(self, item):
+        # shared objects belong to no one in particular
+        if isinstance(item, ModelObject) and not item._frozen:
+            object.__setattr__(item, '_parent', self._owner)
+
+    def _changed(self):
+        if self._owner is not None:
+            self._owner.changed()
+
+    def append(self, item):
+        super().append(item)
+        self._adopt(item)
+        self._changed()
+
+    def insert(self, index, item):
+        super().insert(index, item)
+        self._adopt(item)
+        self._changed()
+
+    def extend(self, items):
+        super().extend(items)
+        for item in self:
+            self._adopt(item)
+        self._changed()
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
 
-class Action:
+    def __setitem__(self, index, item):
+        super().__setitem__(index, item)
+        for item in self:
+            self._adopt(item)
+        self._changed()
+
+    def __delitem__(self, index):
+        super().__delitem__(index)
+        self._changed()
 
-    def __init__(self):
-        self.action_type = ACTIONS[0]
-        self.messages = []
+    def pop(self, index=-1):
+        item = super().pop(index)
+        self._changed()
+        return item
+
+    def remove(self, item):
+        super().remove(item)
+        self._changed()
+
+    def clear(self):
+        super().clear()
+        self._changed()
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self._changed()
+
+    def reverse(self):
+        super().reverse()
+        self._changed()
+
+
+class ModelObject:
+    """
+    Base for the bank model. Setting a public attribute, or modifying a list held in one, calls changed() on the
+    object and then on each of its parents so that memoized sysex can be discarded. Model classes declare their
+    fields in __slots__, as a loaded library holds a great many of them.
+    """
+    __slots__ = ('_parent',)
+    _frozen = False
+
+    def __setattr__(self, name, value):
+        value_type = type(value)
+        if value_type is list or (value_type is TrackedList and value._owner is not self):
+            value = TrackedList(value, self)
+        object.__setattr__(self, name, value)
+        if name[0] != '_':
+            self.changed()
+
+    def _initialise(self, **fields):
+        """
+        Sets the initial value of each field without treating it as a change
+        """
+        object.__setattr__(self, '_parent', None)
+        for name, value in fields.items():
+            if type(value) is list:
+                value = TrackedList(value, self)
+            object.__setattr__(self, name, value)
+
+    def __setstate__(self, state):
+        """
+        Restores a pickled or copied object without treating it as a change, making it the parent of the items of
+        its lists again
+        """
+        for fields in state:
+            for name, value in (fields or {}).items():
+                if type(value) is TrackedList:
+                    value = TrackedList(value, self)
+                object.__setattr__(self, name, value)
+
+    def changed(self):
+        if self._parent is not None:
+            self._parent.changed()
+
+
+SHARED_ERROR = "Shared presets can't be changed, edit the copy Bank.editable() gives instead"
+
+
+class FrozenList(TrackedList):
+    """
+    The list held by a frozen model object, which can't be modified
+    """
+
+    def _refuse(self, *args, **kwargs):
+        raise Exception(SHARED_ERROR)
+
+    append = insert = extend = __iadd__ = __setitem__ = __delitem__ = pop = remove = clear = sort = reverse = _refuse
+
+
+class Frozen:
+    """
+    Mixed in to a model class to give a read only version of it, which can be shared between banks. Copies and
+    pickles of a frozen object are of the original class, so can be changed.
+    """
+    __slots__ = ()
+    _frozen = True
+    _thawed_class = None
+
+    def __setattr__(self, name, value):
+        raise Exception(SHARED_ERROR)
+
+    def __reduce_ex__(self, protocol):
+        return (object.__new__, (self._thawed_class,)) + super().__reduce_ex__(protocol)[2:]
+
+
+_frozen_classes = {}
+
+
+def freeze(model_object: ModelObject) -> ModelObject:
+    """
+    Makes a model object, and everything it holds, read only in place. It is left with no parent, so it can be held by
+    any number of banks.
+    """
+    cls = type(model_object)
+    if cls not in _frozen_classes:
+        _frozen_classes[cls] = type('Frozen' + cls.__name__, (Frozen, cls), {'__slots__': (), '_thawed_class': cls})
+    for base in cls.__mro__:
+        for name in getattr(base, '__slots__', ()):
+            value = getattr(model_object, name, None)
+            if type(value) is TrackedList:
+                for item in value:
+                    if isinstance(item, ModelObject) and not item._frozen:
+                        freeze(item)
+                value.__class__ = FrozenList
+    object.__setattr__(model_object, '_parent', None)
+    model_object.__class__ = _frozen_classes[cls]
+    return model_object
+
+
+class Action(ModelObject):
+    __slots__ = ('_action_id', 'messages')
+
+    def __init__(self, action_type=ACTIONS[0], messages=None):
+        # set directly rather than through _initialise, as there are up to 16 actions to each preset
+        object.__setattr__(self, '_parent', None)
+        Action.action_type.fset(self, action_type)
+        object.__setattr__(self, 'messages', TrackedList(messages if messages is not None else (), self))
+
+    @property
+    def action_type(self) -> str:
+        return ACTIONS[self._action_id]
+
+    @action_type.setter
+    def action_type(self, action_type: str):
+        if action_type not in ACTION_IDS:
+            raise Exception("Unknown action type: " + str(action_type))
+        object.__setattr__(self, '_action_id', ACTION_IDS[action_type])
 
     def id(self):
-        return ACTIONS.index(self.action_type)
+        return self._action_id
 
     def to_dict(self):
         return {
@@ -70,126 +279,190 @@ class Action:
         }
 
     def to_sysex(self):
-        for message in self.messages:
-            # this bit makes no sense but seems to work!?
-            if message.toggle_mode == "both":
-                action_byte = self.id() * 2 + 32
-            elif message.toggle_mode == 2:
-                action_byte = (self.id() * 2 + 1)
-            else:
-                action_byte = self.id() * 2
+        data = bytearray(MESSAGE_LENGTH)
+        self.encode_into(data, 0)
+        return list(data)
+
+    def encode_into(self, buffer: bytearray, offset: int):
+        if not self.messages:
+            raise Exception("Action has no messages: " + str(self.action_type))
+        # only the first message of an action is encoded
+        message = self.messages[0]
+        # this bit makes no sense but seems to work!?
+        if message.toggle_mode == "both":
+            action_byte = self.id() * 2 + 32
+        elif message.toggle_mode == 2:
+            action_byte = (self.id() * 2 + 1)
+        else:
+            action_byte = self.id() * 2
 
-            return [message.id(), message.data1, message.data2, message.data3, action_byte, message.channel - 1]
+        buffer[offset] = message.id()
+        buffer[offset + 1] = message.data1
+        buffer[offset + 2] = message.data2
+        buffer[offset + 3] = message.data3
+        buffer[offset + 4] = action_byte
+        buffer[offset + 5] = message.channel - 1
 
     def from_sysex(self, data):
-        self.action_type = max(len(ACTIONS) - 1, data[4])
-        # self.toggle_mode = 0
-
-        message = Message()
-        if data[0] >= len(MESSAGE_TYPES):
-            raise Exception("byte 0 was too large for expected: " + str(data[0]) +
-                            " (message_type should be one of " + str(MESSAGE_TYPES) + ")")
-        message.data1 = data[1]
-        message.data2 = data[2]
-        message.data3 = data[3]
-        message.message_type = MESSAGE_TYPES[data[0]]
-        message.channel = data[5]
+        """
+        Populates this action from a single 6 byte message slot, the reverse of encode_into
+        """
+        action_byte = data[4]
+        if action_byte >= ACTION_TOGGLE_BOTH:
+            toggle_mode = "both"
+            action_byte -= ACTION_TOGGLE_BOTH
+        else:
+            toggle_mode = 2 if action_byte & 1 else 1
+        if action_byte >> 1 >= len(ACTIONS):
+            raise Exception("byte 4 was too large for expected: " + str(data[4]) +
+                            " (action type should be one of " + str(ACTIONS) + ")")
+        self.action_type = ACTIONS[action_byte >> 1]
+        codec = codec_for_id(data[0], MESSAGE_CODECS_BY_ID)
+        self.messages.append(Message(codec.message_type, data[1], data[2], data[3], data[5] + 1, toggle_mode))
+        return self
 
-        self.messages.append(message)
 
-        return self
+class Message(ModelObject):
+    __slots__ = ('channel', '_type_id', 'data1', 'data2', 'data3', 'toggle_mode')
 
-    def can_merge(self, new_action):
-        return self. action_type != new_action.action_type
+    def __init__(self, message_type=MESSAGE_TYPES[0], data1=0, data2=0, data3=0, channel=1, toggle_mode=1):
+        # set directly rather than through _initialise, as messages are the most numerous objects in the model
+        set_field = object.__setattr__
+        set_field(self, '_parent', None)
+        set_field(self, 'channel', channel)
+        Message.message_type.fset(self, message_type)
+        set_field(self, 'data1', data1)
+        set_field(self, 'data2', data2)
+        set_field(self, 'data3', data3)
+        set_field(self, 'toggle_mode', toggle_mode)
 
+    @property
+    def message_type(self) -> str:
+        return MESSAGE_TYPE_NAMES[self._type_id]
 
-class Message:
+    @message_type.setter
+    def message_type(self, message_type: str):
+        if message_type not in MESSAGE_TYPE_IDS:
+            raise Exception("Unknown message type: " + str(message_type))
+        object.__setattr__(self, '_type_id', MESSAGE_TYPE_IDS[message_type])
 
-    def __init__(self):
-        self.channel = 1
-        self.message_type = MESSAGE_TYPES[0]
-        self.data1 = 0
-        self.data2 = 0
-        self.data3 = 0
-        self.toggle_mode = 1
+    def codec(self) -> MessageCodec:
+        return MESSAGE_TYPE_CODECS[self._type_id]
 
     def id(self):
-        return MESSAGE_TYPES.index(self.message_type) if self.message_type in MESSAGE_TYPES else \
-            EXPRESSION_TYPES.index(self.message_type)
+        return self.codec().id
 
     def to_dict(self):
-        return vars(self)
-    
-    def from_dict(self, message_type, config_dict):
-        config_value = config_dict.get(message_type)
-        self.toggle_mode = config_dict.get("toggle_position") or 1
-        self.message_type = message_type
-        if message_type == 'control_change':
-            self.data1 = config_value.get('number') or 0
-            self.data2 = config_value.get('value') or 0
-        elif message_type in ['note_on', 'note_off']:
-            self.data1 = config_value.get('number') or 0
-            self.data2 = config_value.get('velocity') or 0
-        elif message_type == 'sysex':
-            self.data1 = config_value[0] if len(config_value) > 0 else 0
-            self.data2 = config_value[1] if len(config_value) > 1 else 0
-            self.data3 = config_value[2] if len(config_value) > 2 else 0
-        elif message_type == 'realtime':
-            self.data1 = ['nothing', 'start', 'stop', 'continue'].index(config_value)
-        elif message_type == 'midi_clock':
-            self.data1 = floor(config_value.get('bpm') / 100)
-            self.data2 = config_value.get('bpm') - (100 * self.data1)
-            self.data3 = 1 if config_value.get("tap_menu") else 0
-        elif message_type == 'midi_clock_tap':
-            pass
-        elif message_type == 'pc_scroll_up':
-            self.data1 = (config_value.get('slot') - 1) + 16 if config_value.get("increment") else 0
-            self.data2 = config_value.get('lower_limit') or 0
-            self.data3 = config_value.get('upper_limit') or 0
-            pass
-        else:
-            self.data1 = config_value
+        return {
+            "channel": self.channel,
+            "message_type": self.message_type,
+            "data1": self.data1,
+            "data2": self.data2,
+            "data3": self.data3,
+            "toggle_mode": self.toggle_mode,
+        }
+
+    @classmethod
+    def from_config(cls, codec: MessageCodec, config_dict, default_channel=1):
+        """
+        Creates a message from the config dict containing it (eg an action), using the codec for its type
+        """
+        config_value = config_dict.get(codec.message_type)
+        data1, data2, data3 = codec.encode(config_value)
         if isinstance(config_value, dict) and config_value.get("channel"):
-            self.channel = config_value["channel"]
+            channel = config_value["channel"]
         else:
-            self.channel = config_dict.get("channel") or 1
+            channel = config_dict.get("channel") or default_channel
+        return cls(codec.message_type, data1, data2, data3, channel, config_dict.get("toggle_position") or 1)
+
+    def from_dict(self, message_type, config_dict):
+        for name, value in self.from_config(MESSAGE_CODECS[message_type], config_dict).to_dict().items():
+            setattr(self, name, value)
         return self
 
+    def to_config(self) -> dict:
+        """
+        The reverse of from_config, giving the message in the form it is written in YAML
+        """
+        config = {self.message_type: self.codec().decode(self.data1, self.data2, self.data3), "channel": self.channel}
+        if self.toggle_mode != 1:
+            config["toggle_position"] = self.toggle_mode
+        return config
+
+
+class MemoizedLine(ModelObject):
+    """
+    A model object which encodes to a single sysex line of PRESET_LINE_LENGTH. The encoded line is kept until this
+    object or anything it contains changes. Subclasses implement _encode_into.
+    """
+    __slots__ = ('_line',)
+
+    def _initialise(self, **fields):
+        object.__setattr__(self, '_line', None)
+        super()._initialise(**fields)
+
+    def changed(self):
+        # a preset without an encoding has already told its parent, which stays dirty until it re-encodes us
+        if self._line is not None:
+            object.__setattr__(self, '_line', None)
+            super().changed()
 
-class Preset:
+    def to_sysex(self) -> List[int]:
+        return list(self.encoded_line())
+
+    def encoded_line(self) -> bytes:
+        if self._line is None:
+            self.encode_into(bytearray(PRESET_LINE_LENGTH), 0)
+        return self._line
+
+    def encode_into(self, buffer: bytearray, offset: int) -> int:
+        """
+        Writes the complete sysex line into buffer at offset, reusing the previous encoding if nothing has changed.
+        Returns the offset of the next line.
+        """
+        end = offset + PRESET_LINE_LENGTH
+        if self._line is None:
+            self._encode_into(buffer, offset)
+            self._line = bytes(buffer[offset:end])
+        else:
+            buffer[offset:end] = self._line
+        return end
 
-    def __init__(self, id):
-        self.id = id
-        self.name = " EMPTY"
-        self.long_name = ""
-        self.toggle_name = " EMPTY"
-        self.toggle_mode = False
-        self.blink_mode = False
-        self.actions = []
+    def _encode_into(self, buffer: bytearray, offset: int):
+        raise NotImplementedError()
 
-    def to_sysex(self) -> List[int]:
-        data = [0x01, 0x07, 0x00, self.id, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00]
 
-        for action in self.actions:
-            data += action.to_sysex()
+class Preset(MemoizedLine):
+    __slots__ = ('id', 'name', 'long_name', 'toggle_name', 'toggle_mode', 'blink_mode', 'actions')
 
-        max_packet_size = 10 + 16 * 6
-        if len(data) >= max_packet_size:
+    def __init__(self, id):
+        self._initialise(id=id, name=" EMPTY", long_name="", toggle_name=" EMPTY", toggle_mode=False,
+                         blink_mode=False, actions=[])
+
+    def _encode_into(self, buffer: bytearray, offset: int):
+        if len(self.actions) >= MAX_MESSAGES:
             raise Exception("More than 16 messages specified for preset: " + str(self))
-        data += [0] * (max_packet_size - len(data))
+
+        data = offset + SYSEX_HEADER_LENGTH
+        buffer[data:data + PRESET_MESSAGES_OFFSET] = bytes((0x01, 0x07, 0x00, self.id, 0, 0, 0, 0, 0, 0))
+        message_offset = data + PRESET_MESSAGES_OFFSET
+        for action in self.actions:
+            action.encode_into(buffer, message_offset)
+            message_offset += MESSAGE_LENGTH
+        buffer[message_offset:data + PRESET_BIT_FIELD_OFFSET] = bytes(data + PRESET_BIT_FIELD_OFFSET - message_offset)
 
         bit_field = 0
         if self.toggle_mode:
-            bit_field |= 0x08
+            bit_field |= PRESET_TOGGLE_MODE_BIT
         if self.blink_mode:
-            bit_field |= 0x04
-
-        data += [bit_field, 0x00]
+            bit_field |= PRESET_BLINK_MODE_BIT
+        buffer[data + PRESET_BIT_FIELD_OFFSET] = bit_field
+        buffer[data + PRESET_BIT_FIELD_OFFSET + 1] = 0x00
 
-        data += sysex_text(self.name, 8)
-        data += sysex_text(self.toggle_name, 8)
-        data += sysex_text(self.long_name, 24)
-        return sysex_line(data)
+        write_sysex_text(buffer, data + PRESET_NAME_OFFSET, self.name, PRESET_NAME_LENGTH)
+        write_sysex_text(buffer, data + PRESET_TOGGLE_NAME_OFFSET, self.toggle_name, PRESET_NAME_LENGTH)
+        write_sysex_text(buffer, data + PRESET_LONG_NAME_OFFSET, self.long_name, PRESET_LONG_NAME_LENGTH)
+        finish_sysex_line(buffer, offset, PRESET_DATA_LENGTH)
 
     def letter(self):
         return chr(self.id + ord('A'))
@@ -207,52 +480,47 @@ class Preset:
         return data
 
     def from_sysex(self, data_bytes):
-        self.name = parse_string(data_bytes[-40:-32])
-        self.toggle_name = parse_string(data_bytes[-32:-24])
-        self.long_name = parse_string(data_bytes[-24:])
-
-        offset = 14
-        action = Action()
-        for i in range(0, 16):
-            data = data_bytes[offset:offset + 6]
-            if data != [0, 0, 0, 0, 0, 0]:
-                new_action = Action().from_sysex(data)
-                if action.can_merge(new_action):
-                    action.messages += action.messages
-                else:
-                    action = new_action
-                if action not in self.actions:
-                    self.actions.append(action)
-            offset += 6
+        """
+        Populates this preset from the data section of a preset line (ie without the sysex header and footer)
+        """
+        self.name = parse_string(data_bytes[PRESET_NAME_OFFSET:PRESET_TOGGLE_NAME_OFFSET])
+        self.toggle_name = parse_string(data_bytes[PRESET_TOGGLE_NAME_OFFSET:PRESET_LONG_NAME_OFFSET])
+        self.long_name = parse_string(data_bytes[PRESET_LONG_NAME_OFFSET:PRESET_DATA_LENGTH])
+        bit_field = data_bytes[PRESET_BIT_FIELD_OFFSET]
+        self.toggle_mode = bool(bit_field & PRESET_TOGGLE_MODE_BIT)
+        self.blink_mode = bool(bit_field & PRESET_BLINK_MODE_BIT)
+
+        # each action is encoded to a single slot, so each slot decodes to a separate action
+        for offset in range(PRESET_MESSAGES_OFFSET, PRESET_BIT_FIELD_OFFSET, MESSAGE_LENGTH):
+            data = data_bytes[offset:offset + MESSAGE_LENGTH]
+            if any(data):
+                self.actions.append(Action().from_sysex(data))
         return self
 
 
-class ExpressionPreset:
+class ExpressionPreset(MemoizedLine):
+    __slots__ = ('id', 'name', 'long_name', 'toggle_name', 'messages')
 
     def __init__(self, id: int):
-        self.id = id
-        self.name = " EXPRN"
-        self.long_name = ""
-        self.toggle_name = " EXPRN"
-        self.messages = []
+        self._initialise(id=id, name=" EXPRN", long_name="", toggle_name=" EXPRN", messages=[])
 
-    def to_sysex(self) -> List[int]:
-        data = [0x01, 0x08, 0x00, self.id, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00]
-
-        for message in self.messages:
-            data += [message.id(), message.data1, message.data2, message.data3, 0, message.channel - 1]
-
-        max_packet_size = 10 + 16 * 6
-        if len(data) >= max_packet_size:
+    def _encode_into(self, buffer: bytearray, offset: int):
+        if len(self.messages) >= MAX_MESSAGES:
             raise Exception("More than 16 messages specified for expression preset: " + str(self))
 
-        data += [0] * (max_packet_size - len(data))
+        data = offset + SYSEX_HEADER_LENGTH
+        buffer[data:data + PRESET_MESSAGES_OFFSET] = bytes((0x01, 0x08, 0x00, self.id, 0, 0, 0, 0, 0, 0))
+        message_offset = data + PRESET_MESSAGES_OFFSET
+        for message in self.messages:
+            buffer[message_offset:message_offset + MESSAGE_LENGTH] = bytes((
+                message.id(), message.data1, message.data2, message.data3, 0, message.channel - 1))
+            message_offset += MESSAGE_LENGTH
+        buffer[message_offset:data + PRESET_NAME_OFFSET] = bytes(data + PRESET_NAME_OFFSET - message_offset)
 
-        data += [0, 0]
-        data += sysex_text(self.name, 8)
-        data += sysex_text(self.toggle_name, 8)
-        data += sysex_text(self.long_name, 24)
-        return sysex_line(data)
+        write_sysex_text(buffer, data + PRESET_NAME_OFFSET, self.name, PRESET_NAME_LENGTH)
+        write_sysex_text(buffer, data + PRESET_TOGGLE_NAME_OFFSET, self.toggle_name, PRESET_NAME_LENGTH)
+        write_sysex_text(buffer, data + PRESET_LONG_NAME_OFFSET, self.long_name, PRESET_LONG_NAME_LENGTH)
+        finish_sysex_line(buffer, offset, PRESET_DATA_LENGTH)
 
     def to_dict(self):
         data = {
@@ -263,39 +531,122 @@ class ExpressionPreset:
         }
         return data
 
+    def from_sysex(self, data_bytes):
+        """
+        Populates this expression preset from the data section of an expression preset line
+        """
+        self.name = parse_string(data_bytes[PRESET_NAME_OFFSET:PRESET_TOGGLE_NAME_OFFSET])
+        self.toggle_name = parse_string(data_bytes[PRESET_TOGGLE_NAME_OFFSET:PRESET_LONG_NAME_OFFSET])
+        self.long_name = parse_string(data_bytes[PRESET_LONG_NAME_OFFSET:PRESET_DATA_LENGTH])
+
+        for offset in range(PRESET_MESSAGES_OFFSET, PRESET_BIT_FIELD_OFFSET, MESSAGE_LENGTH):
+            data = data_bytes[offset:offset + MESSAGE_LENGTH]
+            if any(data):
+                codec = codec_for_id(data[0], EXPRESSION_CODECS_BY_ID)
+                self.messages.append(Message(codec.message_type, data[1], data[2], data[3], data[5] + 1))
+        return self
+
 
-class Bank:
+class Bank(ModelObject):
     # it's not really clear what these do yet -potentially just 'bank upload'?
     header1 = sysex_line([0x02, 0x02, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
     header2 = sysex_line([0x01, 0x11, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
-
-    def __init__(self, name):
-        self.presets = []
-        self.expression_presets = []
-        for i in range(0, NUM_PRESETS):
-            self.presets.append(Preset(i))
-        for i in range(0, NUM_EXPR_PRESETS):
-            self.expression_presets.append(ExpressionPreset(i))
-        self.name = name
+    header_bytes = bytes(header1 + header2)
+
+    # the last encoding of the whole bank, along with the preset lines it was built from and its (unmasked) batch
+    # checksum, so that only presets which have changed since need to be re-encoded
+    __slots__ = ('presets', 'expression_presets', 'name', '_buffer', '_encoded_lines', '_batch_checksum', '_dirty')
+
+    def __init__(self, name, presets: List[Preset] = None, expression_presets: List[ExpressionPreset] = None):
+        self._initialise(_buffer=None, _encoded_lines=None, _batch_checksum=0, _dirty=True,
+                         presets=list(presets) if presets is not None else
+                         [Preset(i) for i in range(0, NUM_PRESETS)],
+                         expression_presets=list(expression_presets) if expression_presets is not None else
+                         [ExpressionPreset(i) for i in range(0, NUM_EXPR_PRESETS)],
+                         name=name)
+
+    def changed(self):
+        object.__setattr__(self, '_dirty', True)
+
+    def editable(self, preset):
+        """
+        Returns a preset or expression preset of this bank ready to be changed. A preset shared with other banks (see
+        library.PresetStore) is copied first, and the copy takes its place in this bank only.
+        """
+        if not preset._frozen:
+            return preset
+        for presets in (self.presets, self.expression_presets):
+            for i, candidate in enumerate(presets):
+                if candidate is preset:
+                    presets[i] = copy.deepcopy(preset)
+                    return presets[i]
+        raise Exception("Preset is not in this bank: " + str(preset))
 
     def to_sysex(self) -> List[List[int]]:
-        lines = [self.header1, self.header2]
-        lines.append(sysex_line([0x01, 0x06, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00] +
-                                sysex_text(self.name, 24)))
-
-        for preset in self.presets:
-            lines.append(preset.to_sysex())
-
-        for preset in self.expression_presets:
-            lines.append(preset.to_sysex())
+        data = self.to_sysex_bytes()
+        return [list(data[start:end]) for start, end in BANK_LINE_SPANS]
+
+    def to_sysex_bytes(self) -> bytes:
+        """
+        Encodes all 18 lines of the bank back to back into a single preallocated buffer. After the first call only
+        the lines of presets which have changed are re-encoded, with the batch checksum updated to match.
+        """
+        if self._buffer is None:
+            self._encode_all()
+        elif self._dirty:
+            self._encode_changes()
+        self._dirty = False
+        return bytes(self._buffer)
+
+    def _encode_name_into(self, buffer: bytearray) -> int:
+        offset = len(self.header_bytes)
+        data = offset + SYSEX_HEADER_LENGTH
+        buffer[data:data + 2] = b'\x01\x06'
+        write_sysex_text(buffer, data + BANK_NAME_OFFSET, self.name, BANK_NAME_LENGTH)
+        return finish_sysex_line(buffer, offset, BANK_SETTINGS_DATA_LENGTH)
+
+    def _encode_trailer_into(self, buffer: bytearray):
+        offset = BANK_LINE_SPANS[-1][0]
+        data = offset + SYSEX_HEADER_LENGTH
+        buffer[data] = 0x7E
+        buffer[data + 2] = self._batch_checksum & 127
+        finish_sysex_line(buffer, offset, COMMAND_DATA_LENGTH)
+
+    def _encode_all(self):
+        buffer = bytearray(BANK_SYSEX_LENGTH)
+        buffer[0:len(self.header_bytes)] = self.header_bytes
+        offset = self._encode_name_into(buffer)
+
+        presets = self.presets + self.expression_presets
+        for preset in presets:
+            offset = preset.encode_into(buffer, offset)
 
         batch_checksum = 240
-        for line in lines:
-            batch_checksum ^= line[-2]
-        batch_checksum &= 127
-
-        lines.append(sysex_line([0x7E, 0x00, batch_checksum, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 00]))
-        return lines
+        for start, end in BANK_LINE_SPANS[:-1]:
+            batch_checksum ^= buffer[end - 2]
+
+        self._batch_checksum = batch_checksum
+        self._encode_trailer_into(buffer)
+        self._buffer = buffer
+        self._encoded_lines = [preset.encoded_line() for preset in presets]
+
+    def _encode_changes(self):
+        buffer = self._buffer
+        name_checksum = BANK_LINE_SPANS[2][1] - 2
+        previous = buffer[name_checksum]
+        self._encode_name_into(buffer)
+        self._batch_checksum ^= previous ^ buffer[name_checksum]
+
+        for i, preset in enumerate(self.presets + self.expression_presets):
+            # a new encoding is always a new bytes object, so identity tells us whether this line needs rewriting
+            if preset._line is None or preset._line is not self._encoded_lines[i]:
+                start, end = BANK_LINE_SPANS[3 + i]
+                previous = buffer[end - 2]
+                preset.encode_into(buffer, start)
+                self._batch_checksum ^= previous ^ buffer[end - 2]
+                self._encoded_lines[i] = preset.encoded_line()
+
+        self._encode_trailer_into(buffer)
 
     def to_dict(self):
         builder = {
@@ -309,3 +660,106 @@ class Bank:
         return builder
 
 
+_batch_template = None
+_batch_packed_columns = None
+
+
+def _prepare_batch_template():
+    global _batch_template, _batch_packed_columns
+    if _batch_template is None:
+        # every field which varies between banks is overwritten, so a blank bank gives the fixed parts of each line
+        blank = Bank(None).to_sysex_bytes()
+        template = numpy.zeros((NUM_BANK_LINES, PRESET_LINE_LENGTH), dtype=numpy.uint8)
+        columns = []
+        for line, (start, end) in enumerate(BANK_LINE_SPANS):
+            template[line, :end - start - 2] = numpy.frombuffer(blank[start:end - 2], dtype=numpy.uint8)
+            columns.extend(range(line * PRESET_LINE_LENGTH, line * PRESET_LINE_LENGTH + end - start))
+        _batch_template = template
+        _batch_packed_columns = numpy.array(columns)
+    return _batch_template
+
+
+def encode_banks(banks: List[Bank]):
+    """
+    Encodes many banks at once into an (N, NUM_BANK_LINES, PRESET_LINE_LENGTH) uint8 numpy array. Lines shorter than
+    a preset line are zero padded after their footer. Requires numpy.
+    """
+    if numpy is None:
+        raise Exception("Batch encoding requires numpy- run 'pip install numpy'")
+    template = _prepare_batch_template()
+    count = len(banks)
+    preset_lines = slice(3, 3 + NUM_PRESETS)
+    all_preset_lines = slice(3, 3 + NUM_PRESETS + NUM_EXPR_PRESETS)
+    trailer_line = NUM_BANK_LINES - 1
+    data = SYSEX_HEADER_LENGTH
+
+    lines = numpy.empty((count, NUM_BANK_LINES, PRESET_LINE_LENGTH), dtype=numpy.uint8)
+    lines[:] = template
+
+    bank_names = ''.join([(bank.name or '')[:BANK_NAME_LENGTH].ljust(BANK_NAME_LENGTH) for bank in banks])
+    lines[:, 2, data + BANK_NAME_OFFSET:data + BANK_SETTINGS_DATA_LENGTH] = numpy.frombuffer(
+        bank_names.encode('latin-1'), dtype=numpy.uint8).reshape(count, BANK_NAME_LENGTH)
+
+    preset_names = ''.join([(preset.name or '')[:PRESET_NAME_LENGTH].ljust(PRESET_NAME_LENGTH) +
+                            (preset.toggle_name or '')[:PRESET_NAME_LENGTH].ljust(PRESET_NAME_LENGTH) +
+                            (preset.long_name or '')[:PRESET_LONG_NAME_LENGTH].ljust(PRESET_LONG_NAME_LENGTH)
+                            for bank in banks for preset in bank.presets + bank.expression_presets])
+    lines[:, all_preset_lines, data + PRESET_NAME_OFFSET:data + PRESET_DATA_LENGTH] = numpy.frombuffer(
+        preset_names.encode('latin-1'), dtype=numpy.uint8).reshape(count, NUM_PRESETS + NUM_EXPR_PRESETS, -1)
+
+    lines[:, preset_lines, data + PRESET_BIT_FIELD_OFFSET] = numpy.array(
+        [[(PRESET_TOGGLE_MODE_BIT if preset.toggle_mode else 0) | (PRESET_BLINK_MODE_BIT if preset.blink_mode else 0)
+          for preset in bank.presets] for bank in banks], dtype=numpy.uint8).reshape(count, NUM_PRESETS)
+
+    # gather every message slot into one buffer, then scatter them all into place with a single indexed write
+    slots = bytearray()
+    slot_banks = []
+    slot_lines = []
+    slot_columns = []
+    for n, bank in enumerate(banks):
+        for i, preset in enumerate(bank.presets):
+            if len(preset.actions) >= MAX_MESSAGES:
+                raise Exception("More than 16 messages specified for preset: " + str(preset))
+            for k, action in enumerate(preset.actions):
+                slots += bytes(MESSAGE_LENGTH)
+                action.encode_into(slots, len(slots) - MESSAGE_LENGTH)
+                slot_banks.append(n)
+                slot_lines.append(3 + i)
+                slot_columns.append(data + PRESET_MESSAGES_OFFSET + k * MESSAGE_LENGTH)
+        for i, preset in enumerate(bank.expression_presets):
+            if len(preset.messages) >= MAX_MESSAGES:
+                raise Exception("More than 16 messages specified for expression preset: " + str(preset))
+            for k, message in enumerate(preset.messages):
+                slots += bytes((message.id(), message.data1, message.data2, message.data3, 0, message.channel - 1))
+                slot_banks.append(n)
+                slot_lines.append(3 + NUM_PRESETS + i)
+                slot_columns.append(data + PRESET_MESSAGES_OFFSET + k * MESSAGE_LENGTH)
+    if slots:
+        columns = numpy.array(slot_columns)[:, None] + numpy.arange(MESSAGE_LENGTH)
+        lines[numpy.array(slot_banks)[:, None], numpy.array(slot_lines)[:, None], columns] = numpy.frombuffer(
+            slots, dtype=numpy.uint8).reshape(-1, MESSAGE_LENGTH)
+
+    # checksum and footer bytes are still zero here so they drop out of the xor
+    checksums = numpy.bitwise_xor.reduce(lines, axis=2) & 127
+    lines[:, trailer_line, data + 2] = (240 ^ numpy.bitwise_xor.reduce(checksums[:, :trailer_line], axis=1)) & 127
+    checksums[:, trailer_line] = numpy.bitwise_xor.reduce(lines[:, trailer_line], axis=1) & 127
+
+    line_numbers = numpy.arange(NUM_BANK_LINES)
+    footer_columns = numpy.array(BANK_LINE_LENGTHS) - 2
+    lines[:, line_numbers, footer_columns] = checksums
+    lines[:, line_numbers, footer_columns + 1] = 0xF7
+    return lines
+
+
+def banks_to_sysex_bytes(banks: List[Bank]) -> List[bytes]:
+    """
+    Batch equivalent of calling Bank.to_sysex_bytes on each bank. Falls back to encoding one bank at a time when
+    numpy is unavailable.
+    """
+    if numpy is None:
+        return [bank.to_sysex_bytes() for bank in banks]
+    if not banks:
+        return []
+    lines = encode_banks(banks)
+    packed = lines.reshape(len(banks), -1)[:, _batch_packed_columns]
+    return [row.tobytes() for row in packed]
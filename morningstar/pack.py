@@ -0,0 +1,129 @@
+import mmap
+import os
+import struct
+from typing import List, Optional
+
+from morningstar.model import BANK_LINE_SPANS, BANK_SYSEX_LENGTH, NUM_BANK_LINES
+from morningstar.view import BankView
+
+"""
+A library of encoded banks in a single file. A fixed header is followed by an index giving the offset of every line of
+every bank, then the lines themselves back to back, exactly as they are sent to the device. The file is read through
+mmap and only the index entry and lines of the bank asked for are touched, however many banks the pack holds.
+"""
+
+MAGIC = b'MSPK'
+PACK_VERSION = 1
+PACK_EXTENSION = '.mspk'
+# looked for in a directory of YAML banks when converting a single bank with -b
+DEFAULT_PACK_FILENAME = 'library' + PACK_EXTENSION
+# magic, version, lines per bank and number of banks
+FILE_HEADER = struct.Struct('<4sBBH')
+# the offset in the file of each line of a bank, then of the end of its last line. A bank not in the pack is all zeros.
+BANK_INDEX = struct.Struct('<' + 'I' * (NUM_BANK_LINES + 1))
+
+
+def is_pack_filename(filename: str) -> bool:
+    return os.path.splitext(filename)[1].lower() == PACK_EXTENSION
+
+
+def write_pack(output_file, banks: List[Optional[bytes]]):
+    """
+    Writes banks encoded as by Bank.to_sysex_bytes to an open binary file, numbered by their position in the list. A
+    bank may be None to leave its number empty.
+    """
+    offset = FILE_HEADER.size + BANK_INDEX.size * len(banks)
+    index = bytearray()
+    for data in banks:
+        if data is None:
+            index += BANK_INDEX.pack(*[0] * (NUM_BANK_LINES + 1))
+            continue
+        if len(data) != BANK_SYSEX_LENGTH:
+            raise Exception("Encoded bank is " + str(len(data)) + " bytes, expected " + str(BANK_SYSEX_LENGTH))
+        index += BANK_INDEX.pack(*[offset + start for start, _ in BANK_LINE_SPANS] + [offset + BANK_SYSEX_LENGTH])
+        offset += BANK_SYSEX_LENGTH
+    output_file.write(FILE_HEADER.pack(MAGIC, PACK_VERSION, NUM_BANK_LINES, len(banks)) + index)
+    for data in banks:
+        if data is not None:
+            output_file.write(data)
+
+
+class PackReader:
+    """
+    Reads banks from a pack file by number, counting from 0. Lines are given as memoryviews of the mapped file, so
+    they aren't copied.
+    """
+
+    def __init__(self, path: str):
+        self.file = open(path, 'rb')
+        try:
+            header = self.file.read(FILE_HEADER.size)
+            if len(header) < FILE_HEADER.size:
+                raise Exception("Pack file is too short to have a header")
+            magic, version, lines, self.bank_count = FILE_HEADER.unpack(header)
+            if magic != MAGIC:
+                raise Exception("Not a pack file")
+            if version > PACK_VERSION:
+                raise Exception("Pack file version " + str(version) + " is newer than supported")
+            if lines != NUM_BANK_LINES:
+                raise Exception("Pack file has " + str(lines) + " lines per bank, expected " + str(NUM_BANK_LINES))
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self.file.close()
+            raise
+        self.data = memoryview(self.map)
+        if len(self.data) < FILE_HEADER.size + BANK_INDEX.size * self.bank_count:
+            self.close()
+            raise Exception("Pack file is too short for its index")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self) -> int:
+        return self.bank_count
+
+    def offsets(self, number: int) -> Optional[tuple]:
+        """
+        The offsets of each line of a bank and of its end, or None if the pack doesn't have the bank
+        """
+        if not 0 <= number < self.bank_count:
+            return None
+        offsets = BANK_INDEX.unpack_from(self.data, FILE_HEADER.size + BANK_INDEX.size * number)
+        if not offsets[-1]:
+            return None
+        if offsets[-1] > len(self.data):
+            raise Exception("Bank " + str(number + 1) + " runs past the end of the pack file")
+        return offsets
+
+    def __contains__(self, number: int) -> bool:
+        return self.offsets(number) is not None
+
+    def bank_bytes(self, number: int):
+        """
+        All the lines of a bank back to back, as from Bank.to_sysex_bytes
+        """
+        offsets = self.offsets(number)
+        if offsets is None:
+            raise Exception("Bank " + str(number + 1) + " is not in the pack")
+        return self.data[offsets[0]:offsets[-1]]
+
+    def frames(self, number: int) -> List[memoryview]:
+        offsets = self.offsets(number)
+        if offsets is None:
+            raise Exception("Bank " + str(number + 1) + " is not in the pack")
+        return [self.data[offsets[line]:offsets[line + 1]] for line in range(NUM_BANK_LINES)]
+
+    def view(self, number: int) -> BankView:
+        return BankView(self.frames(number))
+
+    def close(self):
+        self.data.release()
+        try:
+            self.map.close()
+        except BufferError:
+            # lines are still referenced elsewhere, the map closes once they are garbage collected
+            pass
+        self.file.close()
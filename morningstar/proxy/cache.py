@@ -0,0 +1,189 @@
+import logging
+import time
+from typing import List, Optional
+
+from morningstar.delta import line_number
+from morningstar.model import LINE_BANK_TRAILER, LINE_PRESET, LINE_EXPRESSION_PRESET, NUM_BANKS, NUM_BANK_LINES
+from morningstar.sysex_converter import iter_banks, validate_frame
+from morningstar.utils import COMMAND_HEADER, COMMAND_LENGTH, STANDARD_HEADER, SYSEX_HEADER_LENGTH
+
+"""
+A cache of the device's answers to the editor's dump requests, learnt by watching them go through the proxy, so that
+repeated requests don't each make a round trip to the device. Anything which may change the device's banks clears it.
+"""
+
+log = logging.getLogger(__name__)
+
+DUMP_ALL = (0x10, 0x01)
+DUMP_BANK = (0x10, 0x02)
+SEND_NEXT = (0x03, 0x00)
+CACHEABLE = {DUMP_ALL, DUMP_BANK, SEND_NEXT}
+# commands which don't change anything on the device: copy bank, preset and expression preset, ping and acknowledge
+READ_ONLY = {(0x00, 0x12), (0x00, 0x14), (0x00, 0x16), (0x00, 0x7D), (0x00, 0x7F)}
+# a Dump All is over once the device has sent nothing for this long
+DUMP_ALL_QUIET = 0.5
+
+
+def command_key(frame) -> Optional[bytes]:
+    """
+    The function bytes and arguments of a valid command frame, or None if it isn't one
+    """
+    if len(frame) != SYSEX_HEADER_LENGTH + COMMAND_LENGTH + 2 or tuple(frame[:SYSEX_HEADER_LENGTH]) != COMMAND_HEADER \
+            or validate_frame(frame) is not None:
+        return None
+    return bytes(frame[SYSEX_HEADER_LENGTH:SYSEX_HEADER_LENGTH + COMMAND_LENGTH])
+
+
+class CacheEntry:
+    """
+    Everything the device sent in answer to a request, and the banks decoded from it
+    """
+
+    def __init__(self, frames: List[bytes], banks):
+        self.frames = frames
+        self.banks = banks
+
+
+class DeviceCache:
+    """
+    Watches requests going to the device and what comes back. A Dump Bank answer is complete at the bank trailer, a
+    Send Next answer at its preset line and a Dump All answer once every bank has been sent or the device goes quiet,
+    and each is only kept if every frame and bank checksum is valid. A Dump All answer is followed on its own, so other
+    requests may be sent while it is still coming in. Once loop is set (by the proxy) an answer which has gone quiet is
+    kept straight away, otherwise when the next request arrives.
+
+    Uploads and any command which may change the device clear everything. Channel messages and dumps the device sends
+    unprompted (eg buttons pressed in editor mode) may mean a different bank is current, so they clear the answer to
+    Dump Bank.
+    """
+
+    def __init__(self, quiet: float = DUMP_ALL_QUIET):
+        self.quiet = quiet
+        self.loop = None
+        self.entries = {}
+        self.pending = None
+        self.pending_frames = []
+        self.dump_all = None
+        self.dump_all_frames = []
+        self.dump_all_timer = None
+        self.last_received = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def request(self, frame) -> Optional[List[bytes]]:
+        """
+        Called with each sysex frame on its way to the device. Returns the answer if it is a request the cache can
+        answer, in which case the frame shouldn't be sent on.
+        """
+        key = command_key(frame)
+        if key is None or tuple(key[:2]) not in READ_ONLY:
+            if self.dump_all is not None and time.monotonic() - self.last_received >= self.quiet:
+                self.finish_dump_all()
+            if self.pending is not None:
+                self.finish_pending()
+        if key is None:
+            if tuple(frame[:SYSEX_HEADER_LENGTH]) == STANDARD_HEADER:
+                self.invalidate("upload")
+            return None
+        function = tuple(key[:2])
+        if function in CACHEABLE:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.hits += 1
+                return entry.frames
+            self.misses += 1
+            if function != DUMP_ALL:
+                self.pending = key
+                self.pending_frames = []
+            elif self.dump_all is None:
+                self.dump_all = key
+                self.dump_all_frames = []
+                self.last_received = time.monotonic()
+        elif function not in READ_ONLY:
+            self.invalidate("command " + " ".join("{:02X}".format(b) for b in function))
+        return None
+
+    def channel_message(self):
+        """
+        Called for non-realtime messages to the device, which may change its current bank
+        """
+        self.forget(DUMP_BANK)
+
+    def response(self, frame):
+        """
+        Called with each sysex frame from the device
+        """
+        if self.dump_all is not None and line_number(frame) == len(self.dump_all_frames) % NUM_BANK_LINES:
+            self.dump_all_frames.append(bytes(frame))
+            self.last_received = time.monotonic()
+            if len(self.dump_all_frames) == NUM_BANKS * NUM_BANK_LINES:
+                self.finish_dump_all()
+            elif self.loop is not None:
+                if self.dump_all_timer is not None:
+                    self.dump_all_timer.cancel()
+                self.dump_all_timer = self.loop.call_later(self.quiet, self.finish_dump_all)
+            return
+        if self.pending is None:
+            if tuple(frame[:SYSEX_HEADER_LENGTH]) == STANDARD_HEADER:
+                self.forget(DUMP_BANK)
+            return
+        self.pending_frames.append(bytes(frame))
+        line_type = tuple(frame[SYSEX_HEADER_LENGTH:SYSEX_HEADER_LENGTH + 2])
+        function = tuple(self.pending[:2])
+        if function == DUMP_BANK and line_type == LINE_BANK_TRAILER or \
+                function == SEND_NEXT and line_type in (LINE_PRESET, LINE_EXPRESSION_PRESET):
+            self.finish_pending()
+
+    def finish_pending(self):
+        key, frames = self.pending, self.pending_frames
+        self.pending = None
+        self.pending_frames = []
+        self.store(key, frames)
+
+    def finish_dump_all(self):
+        if self.dump_all_timer is not None:
+            self.dump_all_timer.cancel()
+            self.dump_all_timer = None
+        if self.dump_all is None:
+            return
+        key, frames = self.dump_all, self.dump_all_frames
+        self.dump_all = None
+        self.dump_all_frames = []
+        self.store(key, frames)
+
+    def store(self, key: bytes, frames: List[bytes]):
+        """
+        Keeps the answer to a request if it is complete and valid
+        """
+        if any(validate_frame(frame) for frame in frames):
+            return
+        lines = [frame for frame in frames if tuple(frame[:SYSEX_HEADER_LENGTH]) == STANDARD_HEADER and
+                 tuple(frame[SYSEX_HEADER_LENGTH:SYSEX_HEADER_LENGTH + 2]) != (0x00, 0x7F)]
+        banks = []
+        if tuple(key[:2]) != SEND_NEXT:
+            banks = list(iter_banks(lines, on_error=lambda error: None))
+            if not banks or len(banks) * NUM_BANK_LINES != len(lines):
+                return
+        elif not lines:
+            return
+        self.entries[key] = CacheEntry(frames, banks)
+        log.info("Cached %d frames answering %s", len(frames), " ".join("{:02X}".format(b) for b in key[:4]))
+
+    def forget(self, function):
+        for key in [key for key in self.entries if tuple(key[:2]) == function]:
+            del self.entries[key]
+
+    def invalidate(self, reason: str):
+        if self.entries or self.pending is not None or self.dump_all is not None:
+            log.info("Clearing the device cache after %s", reason)
+            self.invalidations += 1
+        self.entries.clear()
+        self.pending = None
+        self.pending_frames = []
+        self.dump_all = None
+        self.finish_dump_all()
+
+    def stats(self) -> dict:
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses,
+                "invalidations": self.invalidations}
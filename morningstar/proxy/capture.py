@@ -0,0 +1,144 @@
+import mmap
+import os
+import struct
+import time
+from typing import Iterator, Optional, Tuple
+
+from morningstar.proxy.stats import DIRECTIONS
+
+"""
+An append-only binary log of the messages going through the proxy in each direction, with the time each one was seen,
+so that real traffic can be replayed later. The log is a header followed by one record per message, and is read
+through mmap so that a long capture never has to fit in memory.
+"""
+
+MAGIC = b'MSCP'
+CAPTURE_VERSION = 1
+# magic, version and the wall clock time in seconds that timestamps count from
+FILE_HEADER = struct.Struct('<4sBd')
+# microseconds since the start of the file, direction and length of the message which follows
+RECORD_HEADER = struct.Struct('<QBH')
+FLUSH_INTERVAL = 1.0
+
+
+class CaptureWriter:
+    """
+    Appends messages to a capture file, starting the file if it is new. Records are written through a buffer which is
+    flushed at least every flush_interval seconds, so a capture cut short loses at most that much. A record left
+    incomplete at the end of an existing file (eg by the proxy being killed mid write) is removed before appending.
+    """
+
+    def __init__(self, path: str, flush_interval: float = FLUSH_INTERVAL):
+        self.file = open(path, 'a+b')
+        size = self.file.seek(0, os.SEEK_END)
+        if size < FILE_HEADER.size:
+            # a new file, or one whose header was never completely written
+            self.file.truncate(0)
+            self.start = time.time()
+            self.file.write(FILE_HEADER.pack(MAGIC, CAPTURE_VERSION, self.start))
+        else:
+            try:
+                self.file.seek(0)
+                self.start = read_header(self.file.read(FILE_HEADER.size))
+                with mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    end = records_end(data)
+                if end < size:
+                    self.file.truncate(end)
+            except Exception:
+                self.file.close()
+                raise
+        # timestamps follow the monotonic clock, counted from the wall clock time in the header
+        self.offset = time.time() - self.start - time.monotonic()
+        self.flush_interval = flush_interval
+        self.flushed = time.monotonic()
+        self.records = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, direction: str, data, timestamp: Optional[float] = None):
+        """
+        Records a message in the given direction (TO_DEVICE or TO_CLIENTS), seen at the given time.monotonic() time,
+        or now
+        """
+        now = time.monotonic()
+        if timestamp is None:
+            timestamp = now
+        # anything seen just before the file was started is recorded as at the start
+        microseconds = max(int((timestamp + self.offset) * 1e6), 0)
+        self.file.write(RECORD_HEADER.pack(microseconds, DIRECTIONS.index(direction), len(data)) + bytes(data))
+        self.records += 1
+        if now - self.flushed >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.file.flush()
+        self.flushed = time.monotonic()
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+
+def read_header(data) -> float:
+    if len(data) < FILE_HEADER.size:
+        raise Exception("Capture file is too short to have a header")
+    magic, version, start = FILE_HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise Exception("Not a capture file")
+    if version > CAPTURE_VERSION:
+        raise Exception("Capture file version " + str(version) + " is newer than supported")
+    return start
+
+
+def records_end(data) -> int:
+    """
+    The offset just past the last complete record of a capture
+    """
+    offset = FILE_HEADER.size
+    while offset + RECORD_HEADER.size <= len(data):
+        length = RECORD_HEADER.unpack_from(data, offset)[2]
+        if offset + RECORD_HEADER.size + length > len(data):
+            break
+        offset += RECORD_HEADER.size + length
+    return offset
+
+
+class CaptureReader:
+    """
+    Reads a capture file through mmap. Iterating gives (microseconds, direction, data) for each message. A record cut
+    short at the end of the file (eg by the proxy being killed mid write) is ignored.
+    """
+
+    def __init__(self, path: str):
+        self.file = open(path, 'rb')
+        try:
+            self.start = read_header(self.file.read(FILE_HEADER.size))
+        except Exception:
+            self.file.close()
+            raise
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self) -> Iterator[Tuple[int, str, bytes]]:
+        data = self.map
+        offset = FILE_HEADER.size
+        while offset + RECORD_HEADER.size <= len(data):
+            timestamp, direction, length = RECORD_HEADER.unpack_from(data, offset)
+            offset += RECORD_HEADER.size
+            if offset + length > len(data):
+                return
+            yield timestamp, DIRECTIONS[direction], data[offset:offset + length]
+            offset += length
+
+    def close(self):
+        self.map.close()
+        self.file.close()
@@ -0,0 +1,152 @@
+import argparse
+import logging
+import sys
+import threading
+import time
+
+import mido
+
+from morningstar.proxy.capture import CaptureReader
+from morningstar.proxy.stats import Histogram, configure_logging, TO_DEVICE, TO_CLIENTS, DIRECTIONS
+from morningstar.proxy.wire import Connection, DEFAULT_COALESCE_WINDOW
+
+"""
+Replays a capture made by the proxy server (see --capture) into a MIDI port, a proxy server or a mock port, as fast
+as it was captured, some multiple of that, or as fast as the port will take it. Reports the throughput, how late each
+message was sent compared to the capture and how long the port took to send it.
+"""
+
+log = logging.getLogger(__name__)
+
+# bits on the wire for each byte at the DIN MIDI rate of 31250 baud, including start and stop bits
+BITS_PER_BYTE = 10
+MIDI_BAUD = 31250
+
+
+class MockPort:
+    """
+    A port which counts what it is sent and throws it away, taking as long as a MIDI cable at the given baud rate
+    would if baud is set
+    """
+
+    def __init__(self, baud: int = None):
+        self.byte_time = BITS_PER_BYTE / baud if baud else 0
+        self.messages = 0
+        self.bytes = 0
+
+    def send(self, message):
+        length = len(message.bin())
+        self.messages += 1
+        self.bytes += length
+        if self.byte_time:
+            time.sleep(length * self.byte_time)
+
+
+def replay(path: str, port, speed: float = 1.0, directions=(TO_DEVICE,)) -> dict:
+    """
+    Sends the messages captured in the given directions to the port, keeping the gaps between them divided by speed,
+    or without waiting if speed is 0. Returns the counts and histograms in microseconds.
+    """
+    messages = 0
+    length = 0
+    lateness = Histogram()
+    send_time = Histogram()
+    started = time.perf_counter()
+    with CaptureReader(path) as reader:
+        first = None
+        for timestamp, direction, data in reader:
+            if direction not in directions:
+                continue
+            message = mido.Message.from_bytes(data)
+            if first is None:
+                first = timestamp
+            due = started + (timestamp - first) / 1e6 / speed if speed else time.perf_counter()
+            wait = due - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            sending = time.perf_counter()
+            port.send(message)
+            sent = time.perf_counter()
+            lateness.record((sending - due) * 1e6)
+            send_time.record((sent - sending) * 1e6)
+            messages += 1
+            length += len(data)
+    elapsed = time.perf_counter() - started
+    return {
+        "messages": messages,
+        "bytes": length,
+        "elapsed_s": round(elapsed, 3),
+        "messages_per_s": round(messages / elapsed, 1) if elapsed else 0.0,
+        "bytes_per_s": round(length / elapsed, 1) if elapsed else 0.0,
+        "late_us": lateness.to_dict(),
+        "send_us": send_time.to_dict(),
+    }
+
+
+def report(result: dict):
+    log.info("Replayed %d messages (%d bytes) in %.3fs: %.1f msgs/s, %.1f bytes/s", result["messages"],
+             result["bytes"], result["elapsed_s"], result["messages_per_s"], result["bytes_per_s"])
+    for name in ("late_us", "send_us"):
+        histogram = result[name]
+        log.info("%s: mean %s p50 %s p99 %s max %s", name, histogram["mean"], histogram["p50"], histogram["p99"],
+                 histogram["max"])
+
+
+def drain(connection: Connection):
+    """
+    Reads everything the server sends back, so that it doesn't disconnect us for falling behind
+    """
+    received = 0
+    try:
+        for _ in connection:
+            received += 1
+    except OSError:
+        pass
+    log.info("Received %d messages from the server", received)
+
+
+def main(path, speed=1.0, directions=(TO_DEVICE,), device_name=None, hostname=None, port=None, binary=True,
+         mock_baud=None):
+    if hostname:
+        target = Connection(hostname, port, binary, DEFAULT_COALESCE_WINDOW)
+        threading.Thread(target=drain, args=(target,), daemon=True).start()
+        log.info("Replaying to proxy server %s:%d", hostname, port)
+    elif device_name:
+        target = mido.open_output(device_name)
+        log.info("Replaying to %s", device_name)
+    else:
+        target = MockPort(mock_baud)
+        log.info("Replaying to a mock port")
+    try:
+        report(replay(path, target, speed, directions))
+    except KeyboardInterrupt:
+        sys.exit(0)
+    finally:
+        if hasattr(target, 'close'):
+            target.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Replay traffic captured by the proxy server')
+    parser.add_argument('capture', type=str, help='capture file written by the server with --capture')
+    parser.add_argument('-s', '--speed', type=float, default=1.0,
+                        help='multiple of the captured speed to replay at (default 1)')
+    parser.add_argument('--max', action='store_true', help='replay as fast as the port will take it')
+    parser.add_argument('--direction', choices=DIRECTIONS + ('both',), default=TO_DEVICE,
+                        help='which direction of the capture to replay (default ' + TO_DEVICE + ')')
+    parser.add_argument('-d', '--midi-device', dest='device', type=str, default=None,
+                        help='replay to this midi output port')
+    parser.add_argument('--connect', nargs=2, metavar=('HOST', 'PORT'), default=None,
+                        help='replay to a proxy server using the binary transport')
+    parser.add_argument('--mock-baud', dest='mock_baud', type=int, default=None,
+                        help='when replaying to the mock port, take as long as a MIDI cable at this rate would '
+                             '(eg ' + str(MIDI_BAUD) + ')')
+    parser.add_argument('-v', '--verbose', action='count', default=0, help='log more')
+    args = vars(parser.parse_args())
+    configure_logging(args["verbose"])
+    if args["speed"] <= 0:
+        parser.error("--speed must be above 0, use --max to replay without waiting")
+    host, tcp_port = args["connect"] or (None, None)
+    main(args["capture"], 0 if args["max"] else args["speed"],
+         (TO_DEVICE, TO_CLIENTS) if args["direction"] == 'both' else (args["direction"],), args["device"], host,
+         int(tcp_port) if tcp_port else None, mock_baud=args["mock_baud"])
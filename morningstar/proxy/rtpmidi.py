@@ -0,0 +1,558 @@
+import asyncio
+import logging
+import random
+import struct
+import threading
+import time
+from typing import List, Optional
+
+import mido
+from mido.messages.specs import SPEC_BY_STATUS
+
+"""
+RTP-MIDI (RFC 6295) over an AppleMIDI session, for the realtime and channel messages where a late message is worse
+than a lost one. Each packet carries a recovery journal of the state the receiver would otherwise lose with a
+packet: the sequencer state (chapter Q: start/stop and the clock count) and the program (chapter P) and controllers
+(chapter C) of each channel. Sysex is left to the reliable TCP transport.
+
+An AppleMIDI session uses two UDP ports, control and data (control + 1). The initiator invites the listener on
+both, then they exchange clock synchronisation (CK) packets which also measure the latency between them. Receivers
+send feedback (RS) every so often so that senders can drop what has been received from their journals.
+"""
+
+log = logging.getLogger(__name__)
+
+SIGNATURE = 0xFFFF
+INVITATION = b'IN'
+ACCEPT = b'OK'
+REJECT = b'NO'
+END = b'BY'
+SYNC = b'CK'
+FEEDBACK = b'RS'
+APPLEMIDI_VERSION = 2
+SESSION_PACKET = struct.Struct('>H2sIII')
+SYNC_PACKET = struct.Struct('>H2sIB3xQQQ')
+FEEDBACK_PACKET = struct.Struct('>H2sIH2x')
+
+RTP_HEADER = struct.Struct('>BBHII')
+RTP_VERSION = 0x80
+PAYLOAD_TYPE = 0x61
+# timestamps are in units of 100us, as used by AppleMIDI
+CLOCK_RATE = 10000
+
+# MIDI command section header flags
+LONG_LENGTH = 0x80
+JOURNAL_PRESENT = 0x40
+# recovery journal header flags
+JOURNAL_SYSTEM = 0x40
+JOURNAL_CHANNELS = 0x20
+# system journal chapter Q, and its flags
+SYSTEM_Q = 0x1000
+Q_RUNNING = 0x40
+Q_CLOCK = 0x10
+CLOCK_MASK = 0x7FFFF
+# channel journal chapters
+CHAPTER_P = 0x80
+CHAPTER_C = 0x40
+
+INVITE_TIMEOUT = 1.0
+INVITE_ATTEMPTS = 3
+SYNC_INTERVAL = 10.0
+# packets received before telling the sender it can drop them from its journal
+FEEDBACK_INTERVAL = 16
+
+
+def session_packet(command: bytes, token: int, ssrc: int, name: str = None) -> bytes:
+    packet = SESSION_PACKET.pack(SIGNATURE, command, APPLEMIDI_VERSION, token, ssrc)
+    return packet + name.encode() + b'\0' if name is not None else packet
+
+
+def timestamp() -> int:
+    return int(time.monotonic() * CLOCK_RATE)
+
+
+def encode_commands(messages) -> bytes:
+    """
+    A MIDI command section with a zero delta time before every command but the first
+    """
+    commands = bytearray()
+    for message in messages:
+        if commands:
+            commands.append(0)
+        commands += message.bin()
+    if len(commands) < 16:
+        return bytes([len(commands)]) + commands
+    if len(commands) > 0xFFF:
+        raise Exception("Too many MIDI commands (" + str(len(commands)) + " bytes) for one RTP-MIDI packet")
+    return bytes([LONG_LENGTH | len(commands) >> 8, len(commands) & 0xFF]) + commands
+
+
+def decode_commands(data, offset: int, end: int) -> List[mido.Message]:
+    messages = []
+    status = None
+    while offset < end:
+        if messages:
+            # skip the delta time
+            while data[offset] & 0x80:
+                offset += 1
+            offset += 1
+        if data[offset] & 0x80:
+            status = data[offset]
+            offset += 1
+        if status == 0xF0:
+            length = data.index(0xF7, offset) + 1 - offset
+        else:
+            length = SPEC_BY_STATUS[status]['length'] - 1
+        messages.append(mido.Message.from_bytes([status] + list(data[offset:offset + length])))
+        offset += length
+    return messages
+
+
+def encode_packet(sequence: int, ssrc: int, messages, journal: bytes = b'') -> bytes:
+    commands = encode_commands(messages)
+    if journal:
+        commands = bytes([commands[0] | JOURNAL_PRESENT]) + commands[1:]
+    return RTP_HEADER.pack(RTP_VERSION, PAYLOAD_TYPE, sequence & 0xFFFF, timestamp() & 0xFFFFFFFF, ssrc) + \
+        commands + journal
+
+
+def decode_packet(data):
+    """
+    Returns the ssrc, sequence number, messages and the parsed journal (or None) of an RTP-MIDI packet
+    """
+    flags, payload_type, sequence, _, ssrc = RTP_HEADER.unpack_from(data)
+    offset = RTP_HEADER.size
+    header = data[offset]
+    if header & LONG_LENGTH:
+        length = (header & 0x0F) << 8 | data[offset + 1]
+        offset += 2
+    else:
+        length = header & 0x0F
+        offset += 1
+    messages = decode_commands(data, offset, offset + length)
+    journal = parse_journal(data, offset + length) if header & JOURNAL_PRESENT else None
+    return ssrc, sequence, messages, journal
+
+
+class MidiState:
+    """
+    The recoverable state of a MIDI stream: whether the sequencer is running, its clock count (the song position in
+    clocks), and the program and controller values of each channel
+    """
+
+    def __init__(self):
+        self.running = False
+        self.clocks = 0
+        self.programs = {}
+        self.controllers = {}
+
+    def record(self, message) -> Optional[tuple]:
+        """
+        Updates the state with a message, returning the key of what it changed (if anything)
+        """
+        message_type = message.type
+        if message_type == 'clock':
+            if not self.running:
+                return None
+            self.clocks = (self.clocks + 1) & CLOCK_MASK
+        elif message_type == 'start':
+            self.running = True
+            self.clocks = 0
+        elif message_type == 'continue':
+            self.running = True
+        elif message_type == 'stop':
+            self.running = False
+        elif message_type == 'songpos':
+            self.clocks = message.pos * 6
+        elif message_type == 'program_change':
+            self.programs[message.channel] = message.program
+            return 'program', message.channel
+        elif message_type == 'control_change':
+            self.controllers.setdefault(message.channel, {})[message.control] = message.value
+            return 'control', message.channel, message.control
+        else:
+            return None
+        return 'system',
+
+    def recover(self, journal: dict) -> List[mido.Message]:
+        """
+        The messages needed to bring this state up to date with a journal from the sender after packets were lost.
+        Missed clocks aren't replayed late, only the count is corrected.
+        """
+        messages = []
+        if journal["running"] is not None:
+            if journal["running"] != self.running:
+                if not journal["running"]:
+                    messages.append(mido.Message('stop'))
+                elif journal["clocks"]:
+                    messages.append(mido.Message('continue'))
+                else:
+                    messages.append(mido.Message('start'))
+            elif not journal["running"] and journal["clocks"] != self.clocks and journal["clocks"] % 6 == 0:
+                messages.append(mido.Message('songpos', pos=journal["clocks"] // 6))
+        for channel, program in journal["programs"].items():
+            if self.programs.get(channel) != program:
+                messages.append(mido.Message('program_change', channel=channel, program=program))
+        for channel, controllers in journal["controllers"].items():
+            for control, value in controllers.items():
+                if self.controllers.get(channel, {}).get(control) != value:
+                    messages.append(mido.Message('control_change', channel=channel, control=control, value=value))
+        for message in messages:
+            self.record(message)
+        if journal["running"] is not None:
+            self.clocks = journal["clocks"]
+        return messages
+
+
+class Journal(MidiState):
+    """
+    The sender's state, remembering which packet last changed each part of it so that only what changed since the
+    checkpoint (the oldest packet the receiver may not have) is journalled
+    """
+
+    def __init__(self, checkpoint: int = 0):
+        super().__init__()
+        self.checkpoint = checkpoint
+        self.changed = {}
+
+    def record(self, message, sequence: int = 0):
+        key = super().record(message)
+        if key is not None:
+            self.changed[key] = sequence
+        return key
+
+    def acknowledge(self, sequence: int):
+        self.checkpoint = sequence + 1
+        for key in [key for key, changed in self.changed.items() if changed < self.checkpoint]:
+            del self.changed[key]
+
+    def encode(self) -> bytes:
+        if not self.changed:
+            return b''
+        system = b''
+        if ('system',) in self.changed:
+            chapter = struct.pack('>BH', (Q_RUNNING if self.running else 0) | Q_CLOCK | self.clocks >> 16,
+                                  self.clocks & 0xFFFF)
+            system = struct.pack('>H', SYSTEM_Q | 2 + len(chapter)) + chapter
+        channels = []
+        for channel in range(16):
+            flags = 0
+            chapters = b''
+            if ('program', channel) in self.changed:
+                flags |= CHAPTER_P
+                chapters += bytes([self.programs[channel], 0, 0])
+            controllers = sorted((control, value) for control, value in self.controllers.get(channel, {}).items()
+                                 if ('control', channel, control) in self.changed)
+            if controllers:
+                flags |= CHAPTER_C
+                chapters += bytes([len(controllers) - 1] + [byte for controller in controllers for byte in controller])
+            if flags:
+                channels.append(struct.pack('>HB', channel << 11 | 3 + len(chapters), flags) + chapters)
+        header = (JOURNAL_SYSTEM if system else 0) | (JOURNAL_CHANNELS | len(channels) - 1 if channels else 0)
+        return struct.pack('>BH', header, self.checkpoint & 0xFFFF) + system + b''.join(channels)
+
+
+def parse_journal(data, offset: int) -> dict:
+    header, checkpoint = struct.unpack_from('>BH', data, offset)
+    offset += 3
+    journal = {"checkpoint": checkpoint, "running": None, "clocks": None, "programs": {}, "controllers": {}}
+    if header & JOURNAL_SYSTEM:
+        system, = struct.unpack_from('>H', data, offset)
+        if system & SYSTEM_Q:
+            flags, clock = struct.unpack_from('>BH', data, offset + 2)
+            journal["running"] = bool(flags & Q_RUNNING)
+            journal["clocks"] = (flags & 0x07) << 16 | clock if flags & Q_CLOCK else 0
+        offset += system & 0x3FF
+    if header & JOURNAL_CHANNELS:
+        for _ in range((header & 0x0F) + 1):
+            channel_header, flags = struct.unpack_from('>HB', data, offset)
+            channel = channel_header >> 11 & 0x0F
+            chapter = offset + 3
+            if flags & CHAPTER_P:
+                journal["programs"][channel] = data[chapter] & 0x7F
+                chapter += 3
+            if flags & CHAPTER_C:
+                count = (data[chapter] & 0x7F) + 1
+                journal["controllers"][channel] = {data[chapter + 1 + i * 2] & 0x7F: data[chapter + 2 + i * 2] & 0x7F
+                                                   for i in range(count)}
+            offset += channel_header & 0x3FF
+    return journal
+
+
+class Peer:
+    """
+    The other end of a session
+    """
+
+    def __init__(self, ssrc: int, name: str, control_address, initiator: bool):
+        self.ssrc = ssrc
+        self.name = name
+        self.control_address = control_address
+        self.data_address = None
+        self.initiator = initiator
+        self.sent = random.getrandbits(16)
+        self.journal = Journal(self.sent)
+        self.received = MidiState()
+        self.expected = None
+        self.since_feedback = 0
+        self.lost = 0
+        self.late = 0
+        self.recovered = 0
+        self.latency = None
+        self.synced = asyncio.Event()
+
+    def extend(self, sequence: int) -> int:
+        """
+        The full count of packets sent to this peer, given the 16 bit sequence number of a recent one
+        """
+        return self.sent - ((self.sent - sequence) & 0xFFFF)
+
+
+class Endpoint(asyncio.DatagramProtocol):
+
+    def __init__(self, session, data: bool):
+        self.session = session
+        self.data = data
+
+    def datagram_received(self, data, address):
+        try:
+            self.session.datagram_received(data, address, self.data)
+        except (IndexError, ValueError, struct.error) as e:
+            log.warning("Ignoring malformed packet from %s: %s", address, e)
+
+
+class RtpMidiSession:
+    """
+    One end of any number of AppleMIDI sessions, each with its own journal. The listening end accepts invitations,
+    the initiating end invites a listener with invite(). on_message(peer, message) is called for every message
+    received, including any recovered from a journal, and on_peer(peer, connected) as peers come and go.
+    """
+
+    def __init__(self, name: str, on_message=None, on_peer=None, accept: bool = True):
+        self.name = name
+        self.on_message = on_message
+        self.on_peer = on_peer
+        self.accept = accept
+        self.ssrc = random.getrandbits(32)
+        self.peers = {}
+        self.invitations = {}
+        self.control = None
+        self.data = None
+        self.sync_task = None
+
+    async def listen(self, host: str, port: int):
+        """
+        Binds the control port and the data port after it. Port 0 picks any free pair.
+        """
+        loop = asyncio.get_event_loop()
+        for _ in range(10):
+            self.control, _ = await loop.create_datagram_endpoint(lambda: Endpoint(self, False),
+                                                                  local_addr=(host, port))
+            control_port = self.control.get_extra_info('sockname')[1]
+            try:
+                self.data, _ = await loop.create_datagram_endpoint(lambda: Endpoint(self, True),
+                                                                   local_addr=(host, control_port + 1))
+                return control_port
+            except OSError:
+                self.control.close()
+                if port:
+                    raise
+        raise Exception("Couldn't find a free pair of UDP ports")
+
+    async def invite(self, host: str, port: int) -> Peer:
+        loop = asyncio.get_event_loop()
+        token = random.getrandbits(32)
+        peer = None
+        for transport, address in ((self.control, (host, port)), (self.data, (host, port + 1))):
+            for _ in range(INVITE_ATTEMPTS):
+                reply = self.invitations[token] = loop.create_future()
+                transport.sendto(session_packet(INVITATION, token, self.ssrc, self.name), address)
+                try:
+                    command, ssrc, name = await asyncio.wait_for(reply, INVITE_TIMEOUT)
+                    break
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                raise Exception("No reply to RTP-MIDI invitation from " + host + ":" + str(address[1]))
+            if command != ACCEPT:
+                raise Exception("RTP-MIDI invitation was rejected by " + host + ":" + str(address[1]))
+            if peer is None:
+                peer = self.peers[ssrc] = Peer(ssrc, name, address, initiator=False)
+            else:
+                peer.data_address = address
+        del self.invitations[token]
+        self.sync(peer)
+        await asyncio.wait_for(peer.synced.wait(), INVITE_TIMEOUT)
+        if self.sync_task is None:
+            self.sync_task = asyncio.ensure_future(self.keep_in_sync())
+        log.info("Joined RTP-MIDI session with %s, latency %.0fus", name, peer.latency * 1e6)
+        return peer
+
+    def sync(self, peer: Peer):
+        self.data.sendto(SYNC_PACKET.pack(SIGNATURE, SYNC, self.ssrc, 0, timestamp(), 0, 0), peer.data_address)
+
+    async def keep_in_sync(self):
+        while True:
+            await asyncio.sleep(SYNC_INTERVAL)
+            for peer in list(self.peers.values()):
+                if not peer.initiator and peer.data_address is not None:
+                    self.sync(peer)
+
+    def datagram_received(self, data, address, is_data: bool):
+        if data[:2] == b'\xff\xff':
+            self.command_received(data, address, is_data)
+        elif is_data:
+            self.rtp_received(data)
+
+    def command_received(self, data, address, is_data: bool):
+        command = data[2:4]
+        transport = self.data if is_data else self.control
+        if command in (INVITATION, ACCEPT, REJECT, END):
+            _, _, version, token, ssrc = SESSION_PACKET.unpack_from(data)
+            name = data[SESSION_PACKET.size:].split(b'\0')[0].decode(errors='replace')
+            if command == INVITATION:
+                self.invited(transport, address, token, ssrc, name, is_data)
+            elif command == END:
+                self.ended(ssrc)
+            elif token in self.invitations and not self.invitations[token].done():
+                self.invitations[token].set_result((command, ssrc, name))
+        elif command == SYNC:
+            self.sync_received(data, address)
+        elif command == FEEDBACK:
+            _, _, ssrc, sequence = FEEDBACK_PACKET.unpack_from(data)
+            peer = self.peers.get(ssrc)
+            if peer is not None:
+                peer.journal.acknowledge(peer.extend(sequence))
+
+    def invited(self, transport, address, token: int, ssrc: int, name: str, is_data: bool):
+        if not self.accept:
+            transport.sendto(session_packet(REJECT, token, self.ssrc, self.name), address)
+            return
+        transport.sendto(session_packet(ACCEPT, token, self.ssrc, self.name), address)
+        peer = self.peers.get(ssrc)
+        if not is_data:
+            if peer is None:
+                self.peers[ssrc] = Peer(ssrc, name, address, initiator=True)
+        elif peer is not None and peer.data_address is None:
+            peer.data_address = address
+            log.info("Accepted RTP-MIDI session from %s at %s", name, address[0])
+            if self.on_peer:
+                self.on_peer(peer, True)
+
+    def ended(self, ssrc: int):
+        peer = self.peers.pop(ssrc, None)
+        if peer is not None:
+            log.info("RTP-MIDI session with %s ended", peer.name)
+            if peer.data_address is not None and self.on_peer:
+                self.on_peer(peer, False)
+
+    def sync_received(self, data, address):
+        # the initiator sends count 0, the listener replies with count 1 and the initiator finishes with count 2.
+        # Both then know the round trip time in the initiator's clock.
+        _, _, ssrc, count, sent, replied, finished = SYNC_PACKET.unpack_from(data)
+        peer = self.peers.get(ssrc)
+        if peer is None:
+            return
+        now = timestamp()
+        if count == 0:
+            self.data.sendto(SYNC_PACKET.pack(SIGNATURE, SYNC, self.ssrc, 1, sent, now, 0), address)
+            return
+        if count == 1:
+            finished = now
+            self.data.sendto(SYNC_PACKET.pack(SIGNATURE, SYNC, self.ssrc, 2, sent, replied, finished), address)
+        peer.latency = (finished - sent) / 2.0 / CLOCK_RATE
+        peer.synced.set()
+
+    def rtp_received(self, data):
+        ssrc, sequence, messages, journal = decode_packet(data)
+        peer = self.peers.get(ssrc)
+        if peer is None:
+            return
+        recovered = []
+        if peer.expected is not None and sequence != peer.expected:
+            gap = (sequence - peer.expected) & 0xFFFF
+            if gap >= 0x8000:
+                # late or duplicated, and the journal of a later packet has already covered it
+                peer.late += 1
+                return
+            peer.lost += gap
+            if journal is not None:
+                recovered = peer.received.recover(journal)
+                peer.recovered += len(recovered)
+            log.info("Lost %d packets from %s, recovered %d messages from the journal", gap, peer.name,
+                     len(recovered))
+        peer.expected = (sequence + 1) & 0xFFFF
+        for message in messages:
+            peer.received.record(message)
+        if self.on_message:
+            for message in recovered + messages:
+                self.on_message(peer, message)
+        peer.since_feedback += 1
+        if peer.since_feedback >= FEEDBACK_INTERVAL:
+            peer.since_feedback = 0
+            self.control.sendto(FEEDBACK_PACKET.pack(SIGNATURE, FEEDBACK, self.ssrc, sequence), peer.control_address)
+
+    def send(self, message, peer: Peer = None):
+        """
+        Sends a message to one peer, or every connected peer, journalling it for the next packet
+        """
+        for peer in [peer] if peer else list(self.peers.values()):
+            if peer.data_address is None:
+                continue
+            packet = encode_packet(peer.sent, self.ssrc, [message], peer.journal.encode())
+            peer.journal.record(message, peer.sent)
+            peer.sent += 1
+            self.data.sendto(packet, peer.data_address)
+
+    def stats(self) -> dict:
+        return {peer.name: {"lost": peer.lost, "late": peer.late, "recovered": peer.recovered,
+                            "latency_us": round((peer.latency or 0) * 1e6)} for peer in self.peers.values()}
+
+    def close(self):
+        for peer in list(self.peers.values()):
+            self.control.sendto(session_packet(END, 0, self.ssrc), peer.control_address)
+        self.peers.clear()
+        if self.sync_task is not None:
+            self.sync_task.cancel()
+        for transport in (self.control, self.data):
+            if transport is not None:
+                transport.close()
+
+
+class SessionThread:
+    """
+    An initiating session run on its own event loop thread, for programs which block. Messages may be sent from any
+    thread, and on_message(message) is called from the session thread.
+    """
+
+    def __init__(self, hostname: str, port: int, name: str, on_message):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.session = RtpMidiSession(name, on_message=lambda peer, message: on_message(message), accept=False)
+        try:
+            self.peer = self.run(self.connect(hostname, port))
+        except Exception:
+            self.close()
+            raise
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def connect(self, hostname: str, port: int) -> Peer:
+        await self.session.listen('0.0.0.0', 0)
+        return await self.session.invite(hostname, port)
+
+    def send(self, message):
+        self.loop.call_soon_threadsafe(self.session.send, message)
+
+    async def finish(self):
+        self.session.close()
+        if self.session.sync_task is not None:
+            await asyncio.gather(self.session.sync_task, return_exceptions=True)
+
+    def close(self):
+        self.run(self.finish())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
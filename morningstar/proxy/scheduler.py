@@ -0,0 +1,138 @@
+import asyncio
+import time
+from collections import deque
+from typing import Tuple
+
+from morningstar.proxy.stats import Histogram
+
+"""
+Strict priority scheduling for proxied messages, so that realtime and clock messages are never stuck behind bulk
+sysex transfers. Messages are only reordered between whole messages, so a sysex frame is never split.
+"""
+
+REALTIME = 0
+CHANNEL = 1
+SYSEX = 2
+CLASS_NAMES = ("realtime", "channel", "sysex")
+
+# everything timing related: clock, start, continue, stop, active sensing and reset are the single byte realtime
+# messages, song position and song select are needed to start clock in the right place
+REALTIME_TYPES = {'clock', 'start', 'continue', 'stop', 'active_sensing', 'reset', 'songpos', 'song_select'}
+REALTIME_STATUS = {0xF2, 0xF3}
+
+
+def classify_message(message) -> int:
+    if message.type == 'sysex':
+        return SYSEX
+    return REALTIME if message.type in REALTIME_TYPES else CHANNEL
+
+
+def classify_bytes(data) -> int:
+    status = data[0]
+    if status == 0xF0:
+        return SYSEX
+    return REALTIME if status >= 0xF8 or status in REALTIME_STATUS else CHANNEL
+
+
+class LatencyStats:
+    """
+    Time spent queued by the messages of one class. Jitter is the RFC 3550 interarrival jitter estimate, ie the
+    smoothed variation in latency from one message to the next. The histogram gives percentiles in microseconds.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+        self.jitter = 0.0
+        self.last = None
+        self.histogram = Histogram()
+
+    def record(self, latency: float):
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+        self.min = latency if self.min is None else min(self.min, latency)
+        if self.last is not None:
+            self.jitter += (abs(latency - self.last) - self.jitter) / 16
+        self.last = latency
+        self.histogram.record(latency * 1e6)
+
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "mean_us": round(self.mean() * 1e6, 1),
+            "min_us": round((self.min or 0.0) * 1e6, 1),
+            "max_us": round(self.max * 1e6, 1),
+            "jitter_us": round(self.jitter * 1e6, 1),
+            "p50_us": self.histogram.percentile(50),
+            "p99_us": self.histogram.percentile(99),
+        }
+
+
+def new_stats() -> Tuple[LatencyStats, ...]:
+    return tuple(LatencyStats() for _ in CLASS_NAMES)
+
+
+class Scheduler:
+    """
+    An asyncio queue which always gives out the oldest message of the highest priority class waiting, recording how
+    long each waited in stats (which may be shared between schedulers). A maxsize above zero bounds the number of
+    messages waiting: put_nowait raises asyncio.QueueFull and put waits, except for realtime messages.
+    """
+
+    def __init__(self, maxsize: int = 0, stats: Tuple[LatencyStats, ...] = None):
+        self.maxsize = maxsize
+        self.queues = tuple(deque() for _ in CLASS_NAMES)
+        self.stats = stats or new_stats()
+        self.count = 0
+        self.ready = asyncio.Event()
+        self.not_full = asyncio.Event()
+        self.not_full.set()
+
+    def qsize(self) -> int:
+        return self.count
+
+    def empty(self) -> bool:
+        return self.count == 0
+
+    def full(self) -> bool:
+        return 0 < self.maxsize <= self.count
+
+    def put_nowait(self, item, priority: int):
+        if self.full() and priority != REALTIME:
+            raise asyncio.QueueFull()
+        self._put(item, priority)
+
+    async def put(self, item, priority: int):
+        while self.full() and priority != REALTIME:
+            self.not_full.clear()
+            await self.not_full.wait()
+        self._put(item, priority)
+
+    def _put(self, item, priority: int):
+        self.queues[priority].append((time.perf_counter(), item))
+        self.count += 1
+        self.ready.set()
+
+    def get_nowait(self) -> Tuple[object, int]:
+        for priority, queue in enumerate(self.queues):
+            if queue:
+                enqueued, item = queue.popleft()
+                self.count -= 1
+                if not self.count:
+                    self.ready.clear()
+                if not self.full():
+                    self.not_full.set()
+                self.stats[priority].record(time.perf_counter() - enqueued)
+                return item, priority
+        raise asyncio.QueueEmpty()
+
+    async def get(self) -> Tuple[object, int]:
+        while not self.count:
+            await self.ready.wait()
+        return self.get_nowait()
@@ -1,60 +1,362 @@
 import argparse
+import asyncio
+import logging
+import socket
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import mido
-from mido.sockets import PortServer
+
+from morningstar.emulator import Emulator
+from morningstar.proxy.wire import FrameDecoder, FrameEncoder, RawDecoder, hello, parse_hello, may_be_hello, \
+    negotiate, HELLO_LENGTH, DEFAULT_COALESCE_WINDOW, COALESCE_LIMIT, READ_SIZE
+from morningstar.proxy.cache import DeviceCache
+from morningstar.proxy.capture import CaptureWriter
+from morningstar.proxy.rtpmidi import RtpMidiSession
+from morningstar.proxy.scheduler import Scheduler, classify_bytes, classify_message, new_stats, REALTIME, CHANNEL, \
+    SYSEX, CLASS_NAMES
+from morningstar.proxy.stats import ProxyStats, configure_logging, serve_stats, summary, TO_DEVICE, TO_CLIENTS
 
 """
-This is a network server which will forward sysex messages from a TCP socket to the MC6
+This is a network server which will forward sysex messages between any number of TCP clients and the MC6. Each client
+uses either the binary transport, if it asks for it when connecting, or raw MIDI bytes as used by mido.sockets.
 """
 
+DEFAULT_QUEUE_SIZE = 1024
+# messages from clients which may be waiting for the device before clients have to wait (realtime messages never do)
+DEVICE_QUEUE_SIZE = 64
+# how long to wait for a client to say hello before assuming it only speaks raw MIDI (and may never send anything)
+NEGOTIATE_TIMEOUT = 0.25
+
+log = logging.getLogger(__name__)
 
-def main(device_name, port):
+
+def choose_device(device_name):
     port_names = mido.get_output_names()
-    print("Available ports: " + ", ".join(port_names))
+    log.info("Available ports: %s", ", ".join(port_names))
 
     if device_name and device_name not in port_names:
         raise Exception("Requested device name '" + device_name + "' is not available")
 
     if len(port_names) == 1:
         device_name = port_names[0]
-        print("Using only available port: " + device_name)
+        log.info("Using only available port: %s", device_name)
 
     for port_name in port_names:
         if port_name.startswith('Morningstar MC6MK2'):
-            print("Using " + port_name)
+            log.info("Using %s", port_name)
             device_name = port_name
             break
 
     if not device_name:
-        print("Found multiple ports but none matching default name. Please specify which port name to forward to.")
+        log.error("Found multiple ports but none matching default name. Please specify which port name to forward to.")
+    return device_name
 
-    client = None
 
-    def device_message(message):
-        if client:
-            print("Proxying message from device to network: " + str(message))
-            client.send(message)
-        else:
-            print("No network clients connected for " + str(message))
+class Client:
+    """
+    A connected network client, with its own bounded queue of data from the device waiting to be written to it
+    """
 
-    with PortServer('0.0.0.0', port) as server:
-        print("Listening on port " + str(port))
-        while True:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, queue_size: int, stats):
+        self.reader = reader
+        self.writer = writer
+        self.queue = Scheduler(queue_size, stats)
+        self.address = writer.get_extra_info('peername')
+        self.name = str(self.address)
+        self.version = None
+        self.encoder = None
+        # set while the client receives realtime and channel messages over RTP-MIDI instead
+        self.sysex_only = False
+
+
+class ProxyServer:
+    """
+    Serves any number of clients over a single connection to the device. Messages from clients are queued for the
+    device, and each message from the device is queued for every client. A client whose queue fills up is
+    disconnected rather than holding up the others. Every queue gives out realtime messages first, then channel
+    messages, then sysex, and records how long each class waited. Clients may also join an RTP-MIDI session for
+    realtime and channel messages, keeping TCP for sysex. Unless cache is False, repeated dump requests are answered
+    from a DeviceCache rather than the device. If given a CaptureWriter, every message from clients and from the
+    device is recorded in it.
+    """
+
+    def __init__(self, device=None, queue_size: int = DEFAULT_QUEUE_SIZE,
+                 coalesce_window: float = DEFAULT_COALESCE_WINDOW, cache: bool = True, capture: CaptureWriter = None):
+        self.device = device
+        self.queue_size = queue_size
+        self.coalesce_window = coalesce_window
+        self.clients = set()
+        self.loop = None
+        self.device_queue = None
+        self.device_writer = None
+        self.device_executor = ThreadPoolExecutor(max_workers=1)
+        self.client_stats = new_stats()
+        self.counters = ProxyStats()
+        self.rtp = None
+        self.cache = DeviceCache() if cache else None
+        self.capture = capture
+
+    def device_message(self, message):
+        """
+        Callback for messages from the device, which may be called from the MIDI thread
+        """
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.fan_out, message)
+
+    def fan_out(self, message):
+        if self.capture is not None:
+            self.capture.write(TO_CLIENTS, message.bin())
+        data = bytes(message.bin())
+        priority = classify_bytes(data)
+        # the cache sees every answer, even if the client which asked has gone
+        if self.cache is not None and priority == SYSEX:
+            self.cache.response(data)
+        rtp_peers = len(self.rtp.peers) if self.rtp is not None else 0
+        if not self.clients and not rtp_peers:
+            log.debug("No network clients connected for %s", message)
+            return
+        log.debug("Proxying message from device to network: %s", message)
+        if rtp_peers and priority != SYSEX:
+            self.rtp.send(message)
+            for _ in range(rtp_peers):
+                self.counters.count(TO_CLIENTS, len(data))
+        for client in list(self.clients):
+            if client.sysex_only and priority != SYSEX:
+                continue
+            try:
+                client.queue.put_nowait(data, priority)
+            except asyncio.QueueFull:
+                log.warning("Disconnecting %s: more than %d messages behind", client.name, self.queue_size)
+                self.counters.disconnected_slow += 1
+                self.disconnect(client)
+                continue
+            self.counters.count(TO_CLIENTS, len(data))
+            self.counters.client_queue_depth.record(client.queue.qsize())
+
+    def answer_from_cache(self, client: Client, message, priority: int) -> bool:
+        """
+        Queues the cached answer for the client if the message is a request the cache can answer
+        """
+        if priority != SYSEX:
+            if priority == CHANNEL:
+                self.cache.channel_message()
+            return False
+        frames = self.cache.request(message.bin())
+        if frames is None:
+            return False
+        log.debug("Answering %s from the cache", client.name)
+        for frame in frames:
             try:
-                client = server.accept()
-                print('Accepted connection from ' + str(client))
-                with mido.open_ioport(device_name, callback=device_message) as device:
-                    for message in client:
-                        print("Proxying message from network to device: " + str(message))
-                        device.send(message)
-            except KeyboardInterrupt:
-                sys.exit(0)
-            except Exception as e:
-                client = None
-                print("Caught exception: " + str(e))
-                time.sleep(1)
+                client.queue.put_nowait(frame, SYSEX)
+            except asyncio.QueueFull:
+                log.warning("Disconnecting %s: more than %d messages behind", client.name, self.queue_size)
+                self.counters.disconnected_slow += 1
+                self.disconnect(client)
+                break
+            self.counters.count(TO_CLIENTS, len(frame))
+        return True
+
+    def disconnect(self, client: Client):
+        self.clients.discard(client)
+        client.writer.close()
+
+    async def write_to_client(self, client: Client):
+        while True:
+            data, priority = await client.queue.get()
+            if client.version:
+                # give other messages the coalesce window to arrive, then write them all at once. Realtime messages
+                # don't wait.
+                if self.coalesce_window > 0 and priority != REALTIME and \
+                        client.queue.qsize() * len(data) < COALESCE_LIMIT:
+                    await asyncio.sleep(self.coalesce_window)
+                frames = [client.encoder.encode(data)]
+                while not client.queue.empty():
+                    frames.append(client.encoder.encode(client.queue.get_nowait()[0]))
+                client.writer.write(b''.join(frames))
+            else:
+                client.writer.write(data)
+                # write everything else already queued before waiting for the socket
+                while not client.queue.empty():
+                    client.writer.write(client.queue.get_nowait()[0])
+            await client.writer.drain()
+
+    async def write_to_device(self):
+        """
+        Sends queued messages to the device one at a time from a separate thread, so that the next message is only
+        chosen once the device has taken the previous one
+        """
+        while True:
+            message, _ = await self.device_queue.get()
+            elapsed = await self.loop.run_in_executor(self.device_executor, self.send_to_device, message)
+            self.counters.device_send_us.record(elapsed * 1e6)
+
+    def send_to_device(self, message) -> float:
+        started = time.perf_counter()
+        self.device.send(message)
+        return time.perf_counter() - started
+
+    async def negotiate(self, client: Client) -> bytes:
+        """
+        Reads the start of the stream, choosing the binary transport if it begins with a hello. Returns anything read
+        which is not part of the hello.
+        """
+        try:
+            data = await asyncio.wait_for(client.reader.read(READ_SIZE), NEGOTIATE_TIMEOUT)
+        except asyncio.TimeoutError:
+            return b''
+        while data and len(data) < HELLO_LENGTH and may_be_hello(data):
+            more = await client.reader.read(READ_SIZE)
+            if not more:
+                break
+            data += more
+        version = parse_hello(data)
+        if version is None:
+            return data
+        client.version = negotiate(version)
+        client.encoder = FrameEncoder(client.version)
+        client.writer.write(hello(client.version))
+        log.info("Using binary transport version %d for %s", client.version, client.name)
+        return data[HELLO_LENGTH:]
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        client = Client(reader, writer, self.queue_size, self.client_stats)
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        log.info("Accepted connection from %s", client.name)
+        self.counters.connections += 1
+        writer_task = None
+        try:
+            data = await self.negotiate(client)
+            decoder = FrameDecoder(client.version) if client.version else RawDecoder()
+            self.clients.add(client)
+            writer_task = asyncio.ensure_future(self.write_to_client(client))
+            while True:
+                for message in decoder.feed(data):
+                    if self.capture is not None:
+                        self.capture.write(TO_DEVICE, message.bin())
+                    priority = classify_message(message)
+                    if self.cache is not None and self.answer_from_cache(client, message, priority):
+                        continue
+                    log.debug("Proxying message from network to device: %s", message)
+                    self.counters.count(TO_DEVICE, len(message.bin()))
+                    await self.device_queue.put(message, priority)
+                    self.counters.device_queue_depth.record(self.device_queue.qsize())
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    break
+        except (ConnectionError, OSError) as e:
+            log.warning("Caught exception from %s: %s", client.name, e)
+        finally:
+            if writer_task:
+                writer_task.cancel()
+            self.disconnect(client)
+            log.info("Closed connection from %s", client.name)
+
+    async def start(self, host: str, port: int):
+        self.loop = asyncio.get_event_loop()
+        if self.cache is not None:
+            self.cache.loop = self.loop
+        self.device_queue = Scheduler(DEVICE_QUEUE_SIZE)
+        self.device_writer = asyncio.ensure_future(self.write_to_device())
+        return await asyncio.start_server(self.handle_client, host, port)
+
+    async def start_rtp(self, host: str, port: int) -> int:
+        """
+        Listens for RTP-MIDI sessions on the given UDP port and the one after it
+        """
+        self.rtp = RtpMidiSession("Morningstar MC6 proxy", on_message=self.rtp_message, on_peer=self.rtp_peer)
+        return await self.rtp.listen(host, port)
+
+    def rtp_message(self, peer, message):
+        log.debug("Proxying message from RTP-MIDI to device: %s", message)
+        if self.capture is not None:
+            self.capture.write(TO_DEVICE, message.bin())
+        self.counters.count(TO_DEVICE, len(message.bin()))
+        priority = classify_message(message)
+        if self.cache is not None and priority == CHANNEL:
+            self.cache.channel_message()
+        try:
+            self.device_queue.put_nowait(message, priority)
+            self.counters.device_queue_depth.record(self.device_queue.qsize())
+        except asyncio.QueueFull:
+            log.warning("Dropping %s from %s: too many messages waiting for the device", message, peer.name)
+
+    def rtp_peer(self, peer, connected: bool):
+        """
+        A virtual port names its session after the address of its TCP connection, which then only needs sysex
+        """
+        for client in self.clients:
+            if client.address and peer.name == client.address[0] + ":" + str(client.address[1]):
+                client.sysex_only = connected
+                log.info("%s %s realtime and channel messages over RTP-MIDI", client.name,
+                         "receives" if connected else "no longer receives")
+        if connected:
+            self.counters.connections += 1
+
+    def stats(self) -> dict:
+        """
+        The counters, plus how long each class of message has spent queued for the device and for clients
+        """
+        stats = self.counters.to_dict()
+        stats["clients"] = len(self.clients)
+        if self.rtp is not None:
+            stats["rtp_midi"] = self.rtp.stats()
+        if self.cache is not None:
+            stats["cache"] = self.cache.stats()
+        stats["queued"] = {
+            TO_DEVICE: {name: latency.to_dict() for name, latency in zip(CLASS_NAMES, self.device_queue.stats)},
+            TO_CLIENTS: {name: latency.to_dict() for name, latency in zip(CLASS_NAMES, self.client_stats)},
+        }
+        return stats
+
+    async def report_stats(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            stats = self.stats()
+            log.info("%s", summary(stats))
+            for direction, classes in stats["queued"].items():
+                queued = ", ".join(name + " " + str(latency["count"]) + " msgs p50 " + str(latency["p50_us"]) +
+                                   "us p99 " + str(latency["p99_us"]) + "us jitter " + str(latency["jitter_us"]) +
+                                   "us" for name, latency in classes.items() if latency["count"])
+                if queued:
+                    log.info("Queued %s: %s", direction, queued)
+
+    async def serve(self, host: str, port: int, stats_interval: float = 0, stats_port: int = None, rtp=False):
+        server = await self.start(host, port)
+        log.info("Listening on port %d", port)
+        if rtp:
+            await self.start_rtp(host, port)
+            log.info("Listening for RTP-MIDI sessions on UDP ports %d and %d", port, port + 1)
+        if stats_interval:
+            asyncio.ensure_future(self.report_stats(stats_interval))
+        if stats_port is not None:
+            await serve_stats('127.0.0.1', stats_port, self.stats)
+            log.info("Serving stats on http://127.0.0.1:%d/", stats_port)
+        async with server:
+            await server.serve_forever()
+
+
+def main(device_name, port, queue_size=DEFAULT_QUEUE_SIZE, coalesce_window=DEFAULT_COALESCE_WINDOW,
+         stats_interval=0, stats_port=None, rtp=False, cache=True, capture_path=None, emulate=False):
+    capture = CaptureWriter(capture_path) if capture_path else None
+    if capture is not None:
+        log.info("Capturing traffic to %s", capture_path)
+    proxy = ProxyServer(queue_size=queue_size, coalesce_window=coalesce_window, cache=cache, capture=capture)
+    if emulate:
+        log.info("Proxying to an emulated MC6")
+        device = Emulator(callback=proxy.device_message)
+    else:
+        device = mido.open_ioport(choose_device(device_name), callback=proxy.device_message)
+    with device:
+        proxy.device = device
+        try:
+            asyncio.run(proxy.serve('0.0.0.0', port, stats_interval, stats_port, rtp))
+        except KeyboardInterrupt:
+            sys.exit(0)
+        finally:
+            if capture is not None:
+                capture.close()
 
 
 if __name__ == "__main__":
@@ -63,5 +365,30 @@ if __name__ == "__main__":
     parser.add_argument('-d', '--midi-device', dest='device', type=str, default=None,
                         help='alternate midi device name '
                              '(default is "Morningstar MC6MK2" or any solitary connected device)')
+    parser.add_argument('--queue-size', dest='queue_size', type=int, default=DEFAULT_QUEUE_SIZE,
+                        help='messages from the device which may be waiting for a client before it is disconnected '
+                             '(default ' + str(DEFAULT_QUEUE_SIZE) + ')')
+    parser.add_argument('--coalesce', type=int, default=int(DEFAULT_COALESCE_WINDOW * 1e6),
+                        help='microseconds to wait for more messages to send together to binary transport clients '
+                             '(default ' + str(int(DEFAULT_COALESCE_WINDOW * 1e6)) + ', 0 to send immediately)')
+    parser.add_argument('--stats', type=float, default=0,
+                        help='log a summary of the counters and queue latencies every this many seconds')
+    parser.add_argument('--stats-port', dest='stats_port', type=int, default=None,
+                        help='serve the counters and histograms as JSON over HTTP on this local port')
+    parser.add_argument('--rtp', action='store_true',
+                        help='also accept RTP-MIDI (AppleMIDI) sessions on UDP ports PORT and PORT + 1')
+    parser.add_argument('--passthrough', action='store_true',
+                        help='always send dump requests to the device rather than answering repeats from the cache')
+    parser.add_argument('--capture', type=str, default=None,
+                        help='append every message in both directions, with the time it was seen, to this file '
+                             '(replay it with morningstar.proxy.replay)')
+    parser.add_argument('--emulate', action='store_true',
+                        help='proxy to an emulated MC6 instead of a MIDI device, eg to benchmark without one')
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help='log every proxied message (rate limited)')
+    parser.add_argument('-q', '--quiet', action='store_true', help='only log warnings and errors')
     args = vars(parser.parse_args())
-    main(args["device"], args["port"])
+    configure_logging(-1 if args["quiet"] else args["verbose"])
+    main(args["device"], args["port"], args["queue_size"], args["coalesce"] / 1e6, args["stats"],
+         args["stats_port"], args["rtp"], not args["passthrough"], args["capture"],
+         args["emulate"])
@@ -0,0 +1,195 @@
+import asyncio
+import json
+import logging
+import time
+
+"""
+Counters, latency histograms and logging for the proxy. Nothing here is printed per message unless debug logging is
+turned on, and even then it is rate limited so that logging can't become the bottleneck.
+"""
+
+# values below 64 are recorded exactly, above that in 32 linear sub-buckets for each power of two, so any value is
+# recorded to within about 3%
+SUB_BUCKET_BITS = 6
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+HALF_SUB_BUCKETS = SUB_BUCKETS >> 1
+PERCENTILES = (50, 90, 99, 99.9)
+
+TO_DEVICE = "to_device"
+TO_CLIENTS = "to_clients"
+DIRECTIONS = (TO_DEVICE, TO_CLIENTS)
+
+DEFAULT_LOG_RATE = 20
+
+
+def bucket_index(value: int) -> int:
+    if value < SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS
+    return shift * HALF_SUB_BUCKETS + (value >> shift)
+
+
+def bucket_range(index: int):
+    if index < SUB_BUCKETS:
+        return index, index
+    shift = index // HALF_SUB_BUCKETS - 1
+    lowest = (index - shift * HALF_SUB_BUCKETS) << shift
+    return lowest, lowest + (1 << shift) - 1
+
+
+class Histogram:
+    """
+    A HDR style histogram of integer values (eg microseconds): buckets are linear within each power of two, so it
+    needs a few hundred buckets at most whatever the range, and records in constant time
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def record(self, value: int):
+        value = max(int(value), 0)
+        index = bucket_index(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent: float) -> int:
+        """
+        The highest value equivalent to the one at the given percentile, ie the top of its bucket
+        """
+        if not self.count:
+            return 0
+        target = max(self.count * percent / 100.0, 1)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= target:
+                return min(bucket_range(index)[1], self.max)
+        return self.max
+
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def to_dict(self) -> dict:
+        result = {"count": self.count, "min": self.min or 0, "mean": round(self.mean(), 1), "max": self.max}
+        for percent in PERCENTILES:
+            result["p" + str(percent).replace(".", "_")] = self.percentile(percent)
+        return result
+
+
+class ProxyStats:
+    """
+    What the proxy has done since it started: messages and bytes in each direction, connections, how deep the queues
+    got and how long the device took to send each message
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.messages = dict.fromkeys(DIRECTIONS, 0)
+        self.bytes = dict.fromkeys(DIRECTIONS, 0)
+        self.connections = 0
+        self.reconnects = 0
+        self.disconnected_slow = 0
+        self.device_send_us = Histogram()
+        self.device_queue_depth = Histogram()
+        self.client_queue_depth = Histogram()
+
+    def count(self, direction: str, length: int):
+        self.messages[direction] += 1
+        self.bytes[direction] += length
+
+    def to_dict(self) -> dict:
+        elapsed = time.monotonic() - self.started
+        return {
+            "uptime_s": round(elapsed, 1),
+            "messages": dict(self.messages),
+            "bytes": dict(self.bytes),
+            "messages_per_s": {direction: round(count / elapsed, 1) for direction, count in self.messages.items()},
+            "connections": self.connections,
+            "reconnects": self.reconnects,
+            "disconnected_slow": self.disconnected_slow,
+            "device_send_us": self.device_send_us.to_dict(),
+            "device_queue_depth": self.device_queue_depth.to_dict(),
+            "client_queue_depth": self.client_queue_depth.to_dict(),
+        }
+
+
+def summary(stats: dict) -> str:
+    """
+    One line of the headline numbers from a stats dict
+    """
+    text = ", ".join(direction + " " + str(stats["messages"][direction]) + " msgs " +
+                     str(stats["bytes"][direction]) + " bytes" for direction in DIRECTIONS)
+    text += ", " + str(stats["connections"]) + " connections, " + str(stats["reconnects"]) + " reconnects"
+    if "device_send_us" in stats and stats["device_send_us"]["count"]:
+        send = stats["device_send_us"]
+        text += ", device send p50 " + str(send["p50"]) + "us p99 " + str(send["p99"]) + "us"
+    return text
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through at most rate records a second for each message format, then notes how many were dropped on the
+    next one let through
+    """
+
+    def __init__(self, rate: int = DEFAULT_LOG_RATE):
+        super().__init__()
+        self.rate = rate
+        self.windows = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        key = record.msg
+        second = int(record.created)
+        window, allowed, suppressed = self.windows.get(key, (second, 0, 0))
+        if window != second:
+            window, allowed = second, 0
+        if allowed >= self.rate:
+            self.windows[key] = (window, allowed, suppressed + 1)
+            return False
+        self.windows[key] = (window, allowed + 1, 0)
+        if suppressed:
+            record.msg = str(key) + " (" + str(suppressed) + " similar messages suppressed)"
+        return True
+
+
+def configure_logging(verbosity: int = 0, rate: int = DEFAULT_LOG_RATE):
+    """
+    Logs to stderr at info level, or debug (which includes every proxied message) if verbosity is above zero, or
+    warnings only if it is below
+    """
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    handler.addFilter(RateLimitFilter(rate))
+    level = logging.DEBUG if verbosity > 0 else logging.WARNING if verbosity < 0 else logging.INFO
+    logging.basicConfig(level=level, handlers=[handler])
+
+
+async def serve_stats(host: str, port: int, get_stats):
+    """
+    Answers any HTTP request with get_stats() as JSON
+    """
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            # the request itself doesn't matter, but read the headers so the client sees a clean response
+            while (await reader.readline()).strip():
+                pass
+            body = json.dumps(get_stats(), indent=2).encode()
+            writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: application/json\r\nContent-Length: ' +
+                         str(len(body)).encode() + b'\r\n\r\n' + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+    return await asyncio.start_server(handle, host, port)
@@ -1,44 +1,89 @@
 import argparse
+import logging
 import sys
+import threading
 import time
 
 import mido
-from mido.sockets import connect
+
+from morningstar.proxy.rtpmidi import SessionThread
+from morningstar.proxy.stats import ProxyStats, configure_logging, summary, TO_DEVICE, TO_CLIENTS
+from morningstar.proxy.wire import Connection, DEFAULT_COALESCE_WINDOW
 
 """
 This is a utility to create a local virtual MIDI port which will forward
 sysex data across the network to a running proxy server
 """
 
+log = logging.getLogger(__name__)
+
+
+def report_stats(stats: ProxyStats, interval: float):
+    while True:
+        time.sleep(interval)
+        log.info("%s", summary(stats.to_dict()))
 
-def main(hostname='localhost', port=8081):
+
+def main(hostname='localhost', port=8081, binary=False, coalesce_window=DEFAULT_COALESCE_WINDOW, stats_interval=0,
+         rtp=False, compress=True):
     device_name = 'Morningstar MC6MK2 proxy'
     client_port = None
+    rtp_session = None
+    stats = ProxyStats()
+    if stats_interval:
+        threading.Thread(target=report_stats, args=(stats, stats_interval), daemon=True).start()
 
     def virtual_message(message):
         if client_port:
-            print("Proxying message to MC6: " + str(message))
-            client_port.send(message)
+            log.debug("Proxying message to MC6: %s", message)
+            stats.count(TO_DEVICE, len(message.bin()))
+            if rtp_session and message.type != 'sysex':
+                rtp_session.send(message)
+            else:
+                client_port.send(message)
         else:
-            print("No network connection to proxy message to " + str(message))
+            log.warning("No network connection to proxy message to %s", message)
 
     with mido.open_ioport(device_name, virtual=True, callback=virtual_message) as virtual_port:
-        print("Created virtual port '" + device_name + "'")
+        log.info("Created virtual port '%s'", device_name)
+
+        def from_network(message):
+            log.debug("Proxying message from MC6: %s", message)
+            stats.count(TO_CLIENTS, len(message.bin()))
+            virtual_port.send(message)
+
         while True:
             try:
-                print("Connecting to " + hostname + ":" + str(port))
-                with connect(hostname, port) as client:
+                log.info("Connecting to %s:%d", hostname, port)
+                with Connection(hostname, port, binary, coalesce_window, compress) as client:
                     client_port = client
-                    print('Connected to proxy server')
+                    if stats.connections:
+                        stats.reconnects += 1
+                    stats.connections += 1
+                    log.info("Connected to proxy server using %s",
+                             'binary transport version ' + str(client.version) if client.version else 'raw MIDI')
+                    if rtp:
+                        # named after the TCP connection so that the server stops sending it anything but sysex
+                        address = client.socket.getsockname()
+                        try:
+                            rtp_session = SessionThread(hostname, port, address[0] + ":" + str(address[1]),
+                                                        from_network)
+                        except Exception as e:
+                            log.warning("Sending everything over TCP, couldn't join RTP-MIDI session: %s", e)
                     for message in client:
-                        print("Proxying message from MC6: " + str(message))
-                        virtual_port.send(message)
+                        if rtp_session and message.type != 'sysex':
+                            continue
+                        from_network(message)
             except KeyboardInterrupt:
                 sys.exit(0)
             except Exception as e:
                 client_port = None
-                print("Caught exception: " + str(e))
+                log.warning("Caught exception: %s", e)
                 time.sleep(1)
+            finally:
+                if rtp_session:
+                    rtp_session.close()
+                    rtp_session = None
 
 
 if __name__ == "__main__":
@@ -47,5 +92,22 @@ if __name__ == "__main__":
                         help='hostname to connect to')
     parser.add_argument('port', type=int, default=8081,
                         help='TCP port number to connect to')
+    parser.add_argument('-b', '--binary', action='store_true',
+                        help='use the binary transport if the server supports it')
+    parser.add_argument('--coalesce', type=int, default=int(DEFAULT_COALESCE_WINDOW * 1e6),
+                        help='with --binary, microseconds to wait for more messages to send together '
+                             '(default ' + str(int(DEFAULT_COALESCE_WINDOW * 1e6)) + ', 0 to send immediately)')
+    parser.add_argument('--no-compress', dest='compress', action='store_false',
+                        help="with --binary, don't compress bank lines and other large sysex messages")
+    parser.add_argument('--stats', type=float, default=0,
+                        help='log a summary of the counters every this many seconds')
+    parser.add_argument('--rtp', action='store_true',
+                        help='send realtime and channel messages over RTP-MIDI if the server was started with --rtp, '
+                             'and sysex over TCP')
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help='log every proxied message (rate limited)')
+    parser.add_argument('-q', '--quiet', action='store_true', help='only log warnings and errors')
     args = vars(parser.parse_args())
-    main(args["hostname"], args["port"])
+    configure_logging(-1 if args["quiet"] else args["verbose"])
+    main(args["hostname"], args["port"], args["binary"], args["coalesce"] / 1e6, args["stats"], args["rtp"],
+         args["compress"])
@@ -0,0 +1,245 @@
+import socket
+import struct
+import threading
+import time
+import zlib
+from typing import List, Optional
+
+import mido
+from mido.parser import Parser
+
+from morningstar.proxy.scheduler import classify_bytes, REALTIME
+
+"""
+Transports for proxying MIDI over TCP. The raw transport is the stream of MIDI bytes used by mido.sockets. The binary
+transport is negotiated when a client connects: each message is sent as a length-prefixed frame, and messages sent
+within a short window of each other are coalesced into a single write. From version 2 large frames are compressed.
+"""
+
+MAGIC = b'MSMP'
+PROTOCOL_VERSION = 2
+COMPRESSION_VERSION = 2
+HELLO_LENGTH = len(MAGIC) + 1
+FRAME_HEADER = struct.Struct('>H')
+MAX_FRAME_LENGTH = 0xFFFF
+# from version 2 the top bit of the frame length marks a compressed frame
+COMPRESSED = 0x8000
+# frames smaller than this (eg realtime, channel and command messages) are never compressed
+COMPRESS_THRESHOLD = 32
+# every sync flush ends with these bytes, so they are left out of compressed frames and put back before decompressing
+SYNC_FLUSH_TAIL = b'\x00\x00\xff\xff'
+DEFAULT_COALESCE_WINDOW = 0.0005
+# bytes which may be waiting for the coalesce window before they are written anyway
+COALESCE_LIMIT = 8192
+HANDSHAKE_TIMEOUT = 1.0
+READ_SIZE = 65536
+
+
+def hello(version: int = PROTOCOL_VERSION) -> bytes:
+    """
+    Sent by a client on connect, offering the highest version it supports, and echoed by the server with the version
+    chosen. It contains no status byte, so a raw MIDI server ignores it.
+    """
+    return MAGIC + bytes([version])
+
+
+def parse_hello(data) -> Optional[int]:
+    if len(data) < HELLO_LENGTH or data[:len(MAGIC)] != MAGIC:
+        return None
+    return data[len(MAGIC)]
+
+
+def may_be_hello(data) -> bool:
+    return MAGIC.startswith(bytes(data[:len(MAGIC)]))
+
+
+def negotiate(version: int) -> int:
+    return min(version, PROTOCOL_VERSION)
+
+
+def encode_frame(data, limit: int = MAX_FRAME_LENGTH) -> bytes:
+    if len(data) > limit:
+        raise Exception("Message of " + str(len(data)) + " bytes is too long for a frame")
+    return FRAME_HEADER.pack(len(data)) + bytes(data)
+
+
+class FrameEncoder:
+    """
+    Frames messages for the binary transport. From version 2, frames of COMPRESS_THRESHOLD bytes or more are
+    compressed with one zlib stream for the whole connection, so that each bank line can refer back to the ones
+    before it. Frames must be written in the order they were encoded.
+    """
+
+    def __init__(self, version: int = PROTOCOL_VERSION):
+        self.compressor = zlib.compressobj() if version >= COMPRESSION_VERSION else None
+
+    def encode(self, data) -> bytes:
+        if self.compressor is None:
+            return encode_frame(data)
+        if len(data) < COMPRESS_THRESHOLD:
+            return encode_frame(data, COMPRESSED - 1)
+        compressed = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        compressed = compressed[:-len(SYNC_FLUSH_TAIL)]
+        if len(compressed) >= COMPRESSED:
+            raise Exception("Message of " + str(len(data)) + " bytes is too long for a frame")
+        return FRAME_HEADER.pack(COMPRESSED | len(compressed)) + compressed
+
+
+class FrameDecoder:
+    """
+    Splits the binary transport into messages, whatever size of chunks it arrives in
+    """
+
+    def __init__(self, version: int = PROTOCOL_VERSION):
+        self.buffer = bytearray()
+        self.decompressor = zlib.decompressobj() if version >= COMPRESSION_VERSION else None
+
+    def feed(self, data) -> List[mido.Message]:
+        buffer = self.buffer
+        buffer += data
+        messages = []
+        offset = 0
+        while len(buffer) - offset >= FRAME_HEADER.size:
+            length, = FRAME_HEADER.unpack_from(buffer, offset)
+            compressed = self.decompressor is not None and length & COMPRESSED
+            if compressed:
+                length &= ~COMPRESSED
+            end = offset + FRAME_HEADER.size + length
+            if end > len(buffer):
+                break
+            frame = buffer[offset + FRAME_HEADER.size:end]
+            if compressed:
+                frame = self.decompressor.decompress(bytes(frame) + SYNC_FLUSH_TAIL)
+            messages.append(mido.Message.from_bytes(frame))
+            offset = end
+        del buffer[:offset]
+        return messages
+
+
+class RawDecoder:
+    """
+    Parses the raw transport, as written by mido.sockets
+    """
+
+    def __init__(self):
+        self.parser = Parser()
+
+    def feed(self, data) -> List[mido.Message]:
+        self.parser.feed(data)
+        return list(self.parser)
+
+
+class Connection:
+    """
+    A blocking client connection to the proxy server. If binary is set the binary transport is offered, falling back
+    to the raw transport if the server doesn't reply (eg a server using mido.sockets). Large frames are compressed
+    unless compress is False or the server is too old. Messages may be sent from any thread and are received by
+    iterating over the connection. Realtime messages are written straight away, ahead of anything waiting to be
+    coalesced.
+    """
+
+    def __init__(self, hostname: str, port: int, binary=True, coalesce_window: float = DEFAULT_COALESCE_WINDOW,
+                 compress=True):
+        self.socket = socket.create_connection((hostname, port))
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.received = b''
+        self.version = self.handshake(PROTOCOL_VERSION if compress else COMPRESSION_VERSION - 1) if binary else None
+        self.decoder = FrameDecoder(self.version) if self.version else RawDecoder()
+        self.encoder = FrameEncoder(self.version) if self.version else None
+        self.coalesce_window = coalesce_window if self.version else 0
+        self.bytes_sent = 0
+        self.closed = False
+        self.pending = bytearray()
+        self.pending_since = 0.0
+        self.condition = threading.Condition()
+        self.write_lock = threading.Lock()
+        self.sender = None
+        if self.coalesce_window > 0:
+            self.sender = threading.Thread(target=self.send_pending, daemon=True)
+            self.sender.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def handshake(self, version: int) -> Optional[int]:
+        self.socket.sendall(hello(version))
+        self.socket.settimeout(HANDSHAKE_TIMEOUT)
+        reply = b''
+        try:
+            while len(reply) < HELLO_LENGTH and may_be_hello(reply):
+                data = self.socket.recv(HELLO_LENGTH - len(reply))
+                if not data:
+                    break
+                reply += data
+        except socket.timeout:
+            pass
+        finally:
+            self.socket.settimeout(None)
+        version = parse_hello(reply)
+        if version is None:
+            # anything an old server sent meanwhile is raw MIDI
+            self.received = reply
+        return version
+
+    def send(self, message):
+        data = bytes(message.bin())
+        realtime = classify_bytes(data) == REALTIME
+        with self.condition:
+            if self.encoder is not None:
+                data = self.encoder.encode(data)
+            self.bytes_sent += len(data)
+            if self.sender is None or realtime:
+                # written before letting go of the condition, so that frames are written in the order compressed
+                self.write(data)
+                return
+            if not self.pending:
+                self.pending_since = time.monotonic()
+            self.pending += data
+            self.condition.notify()
+
+    def send_pending(self):
+        """
+        Writes whatever has been sent once the oldest message has waited coalesce_window, or enough has built up
+        """
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                while not self.closed and len(self.pending) < COALESCE_LIMIT:
+                    remaining = self.pending_since + self.coalesce_window - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                data = bytes(self.pending)
+                self.pending.clear()
+            if data:
+                self.write(data)
+            if self.closed:
+                return
+
+    def write(self, data: bytes):
+        with self.write_lock:
+            self.socket.sendall(data)
+
+    def __iter__(self):
+        if self.received:
+            yield from self.decoder.feed(self.received)
+            self.received = b''
+        while True:
+            data = self.socket.recv(READ_SIZE)
+            if not data:
+                return
+            yield from self.decoder.feed(data)
+
+    def close(self):
+        if self.closed:
+            return
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if self.sender is not None:
+            self.sender.join()
+        self.socket.close()
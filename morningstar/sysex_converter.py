@@ -1,42 +1,144 @@
 import argparse
 import os
+from typing import Iterable, Iterator, Callable, Optional
 
 import yaml
 
-from morningstar.model import Bank, NUM_PRESETS
-from morningstar.utils import parse_bytes, parse_string
+from morningstar.checksum import checksum
+from morningstar.model import Bank, NUM_PRESETS, NUM_EXPR_PRESETS, LINE_BANK_HEADER1, LINE_BANK_HEADER2, \
+    LINE_BANK_SETTINGS, LINE_PRESET, LINE_EXPRESSION_PRESET, LINE_BANK_TRAILER, BANK_NAME_OFFSET, \
+    BANK_SETTINGS_DATA_LENGTH
+from morningstar.sysex_file import read_frames, is_sysex_filename, FORMATS
+from morningstar.utils import parse_string, atomic_write, run_jobs, STANDARD_HEADER, SYSEX_HEADER_LENGTH, SYSEX_FOOTER_LENGTH
+from morningstar.view import iter_bank_views
 
+# the headers never change, so their checksums can be folded into the batch checksum up front
+BATCH_CHECKSUM_SEED = 240 ^ Bank.header1[-2] ^ Bank.header2[-2]
+BANK_CONTENT_LINES = 1 + NUM_PRESETS + NUM_EXPR_PRESETS
 
-def process_file(input_filename):
-    with open(input_filename, 'r') as input_file:
-        bank = None
-        count = 0
-        for line in input_file:
-            data_bytes = parse_bytes(line)
 
-            if data_bytes == Bank.header1:
-                if count != 0:
-                    print("Unexpected bank header 1 on line " + str(count))
-                count = 1
-                continue
-            if data_bytes == Bank.header2:
-                if count != 1:
-                    print("Unexpected bank header 2 in state " + str(count) + ". Assuming start of bank...")
-                count = 2
+def validate_frame(frame: bytes) -> Optional[str]:
+    if len(frame) < SYSEX_HEADER_LENGTH + 2 + SYSEX_FOOTER_LENGTH or frame[-1] != 0xF7:
+        return "Truncated sysex frame"
+    if tuple(frame[:4]) != STANDARD_HEADER[:4]:
+        return "Sysex frame is not from a Morningstar device"
+    if checksum(frame[:-2]) != frame[-2]:
+        return "Bad checksum in sysex frame"
+    return None
+
+
+def iter_banks(frames: Iterable[bytes], on_error: Callable[[str], None] = print,  # noqa: C901
+               store=None) -> Iterator[Bank]:
+    """
+    Decodes a stream of sysex frames (eg a "Dump All" capture) into banks, yielding each one as soon as its trailer
+    line arrives and its batch checksum has been verified. Corrupt frames cause the bank being decoded to be
+    discarded and the parser waits for the start of the next bank. Given a library.PresetStore, banks hold its
+    shared presets.
+    """
+    bank = None
+    batch_checksum = BATCH_CHECKSUM_SEED
+    lines_seen = 0
+
+    for frame_number, frame in enumerate(frames):
+        error = validate_frame(frame)
+        if error:
+            on_error(error + " (frame " + str(frame_number) + ")" +
+                     (", discarding bank " + repr(bank.name) if bank is not None else ""))
+            bank = None
+            continue
+
+        data = frame[SYSEX_HEADER_LENGTH:-SYSEX_FOOTER_LENGTH]
+        line_type = (data[0], data[1])
+
+        if line_type in (LINE_BANK_HEADER1, LINE_BANK_HEADER2):
+            if bank is not None:
+                on_error("Unexpected bank header (frame " + str(frame_number) + "), discarding bank " + repr(bank.name))
+                bank = None
+        elif line_type == LINE_BANK_SETTINGS:
+            if bank is not None:
+                on_error("Bank " + repr(bank.name) + " has no trailer (frame " + str(frame_number) + "), discarding")
+            name = parse_string(data[BANK_NAME_OFFSET:BANK_SETTINGS_DATA_LENGTH])
+            bank = Bank(name) if store is None else store.blank_bank(name)
+            batch_checksum = BATCH_CHECKSUM_SEED ^ frame[-2]
+            lines_seen = 1
+        elif bank is None:
+            # not part of a bank we are decoding, eg the remainder of a corrupted bank
+            continue
+        elif line_type in (LINE_PRESET, LINE_EXPRESSION_PRESET):
+            presets = bank.presets if line_type == LINE_PRESET else bank.expression_presets
+            if data[3] >= len(presets):
+                on_error("Preset number " + str(data[3]) + " out of range (frame " + str(frame_number) + ")")
+                bank = None
                 continue
+            if store is None:
+                presets[data[3]].from_sysex(data)
+            else:
+                presets[data[3]] = store.decode(frame)
+            batch_checksum ^= frame[-2]
+            lines_seen += 1
+        elif line_type == LINE_BANK_TRAILER:
+            if lines_seen != BANK_CONTENT_LINES:
+                on_error("Bank " + repr(bank.name) + " has " + str(lines_seen) + " lines, expected " +
+                         str(BANK_CONTENT_LINES) + ", discarding")
+            elif data[2] != batch_checksum & 127:
+                on_error("Bad batch checksum for bank " + repr(bank.name) + ", discarding")
+            else:
+                yield bank
+            bank = None
+
+
+def bank_to_yaml(bank: Bank) -> str:
+    return yaml.dump({
+        "bank": bank.to_dict()
+    }, sort_keys=False, default_flow_style=False)
 
-            # discard sysex header and footer
-            data_bytes = data_bytes[1:-2]
-            count += 1
-            if count == 3:
-                name = parse_string(data_bytes[-24:])
-                bank = Bank(name)
-            elif 4 <= count <= 3 + NUM_PRESETS:
-                bank.presets[count - 4].from_sysex(data_bytes)
 
-        return yaml.dump({
-            "bank": bank.to_dict()
-        }, sort_keys=False, default_flow_style=False)
+def process_file(input_filename, file_format=None) -> str:
+    return "---\n".join([bank_to_yaml(bank) for bank in iter_banks(read_frames(input_filename, file_format))])
+
+
+def list_banks(input_filename, file_format=None) -> str:
+    """
+    Lists the name of each bank in a sysex file and of its presets, decoding only the names
+    """
+    listing = []
+    for i, bank in enumerate(iter_bank_views(read_frames(input_filename, file_format))):
+        listing.append(str(i + 1).zfill(3) + " " + bank.name.strip())
+        for preset in bank.presets:
+            listing.append("    " + preset.letter() + " " + preset.name.ljust(8) + " " + preset.toggle_name.ljust(8) +
+                           " " + preset.long_name.strip())
+    return "\n".join(listing)
+
+
+def convert_to_file(input_filename, output_filename, file_format=None) -> Optional[str]:
+    """
+    Converts a sysex file to YAML, writing it to output_filename or returning it if there is no output file
+    """
+    output = process_file(input_filename, file_format)
+    if not output_filename:
+        return output
+    with atomic_write(output_filename) as output_file:
+        output_file.write(output)
+    return None
+
+
+def convert_file(input_filename, output, file_format=None):
+    """
+    Converts every bank in a sysex file, writing each one out as soon as it is decoded. Banks are written as
+    separate YAML documents to a single file, or as one file per bank if output is a directory.
+    """
+    banks = iter_banks(read_frames(input_filename, file_format))
+    if output and os.path.isdir(output):
+        for i, bank in enumerate(banks):
+            with atomic_write(os.path.join(output, "bank" + str(i + 1).zfill(3) + ".yml")) as output_file:
+                output_file.write(bank_to_yaml(bank))
+    elif output:
+        with atomic_write(output) as output_file:
+            for i, bank in enumerate(banks):
+                output_file.write(("---\n" if i else "") + bank_to_yaml(bank))
+    else:
+        for i, bank in enumerate(banks):
+            print(("---\n" if i else "") + bank_to_yaml(bank))
 
 
 if __name__ == "__main__":
@@ -45,23 +147,45 @@ if __name__ == "__main__":
                         help='sysex file')
     parser.add_argument('-o', '--output', type=str,
                         help='output as file')
+    parser.add_argument('-f', '--format', type=str, choices=FORMATS,
+                        help='input format (default is chosen by file extension, .syx files holding hex text are '
+                             'read as hex)')
+    parser.add_argument('-j', '--jobs', type=int, nargs='?', const=os.cpu_count(), default=1,
+                        help='number of files to convert in parallel when converting a directory '
+                             '(default 1, or one per CPU if no number is given)')
+    parser.add_argument('-l', '--list', action='store_true',
+                        help='just list the names of the banks and presets in each file')
 
     args = vars(parser.parse_args())
 
-    if os.path.isdir(args["file"]):
-        files = os.listdir(args["file"])
+    if args["list"]:
+        filenames = [os.path.join(args["file"], filename) for filename in sorted(os.listdir(args["file"]))
+                     if is_sysex_filename(filename)] if os.path.isdir(args["file"]) else [args["file"]]
+        for inputfilename in filenames:
+            if len(filenames) > 1:
+                print(inputfilename)
+            print(list_banks(inputfilename, args["format"]))
+    elif os.path.isdir(args["file"]):
         if args["output"] and not os.path.isdir(args["output"]):
             print("Input file is a directory, but output file is not")
             exit(2)
 
-        for inputfilename in files:
-            if '.yml' not in inputfilename:
+        tasks = []
+        for inputfilename in sorted(os.listdir(args["file"])):
+            if not is_sysex_filename(inputfilename):
                 continue
+            output_filename = os.path.join(args["output"], os.path.splitext(inputfilename)[0] + '.yml') \
+                if args["output"] else None
+            tasks.append((os.path.join(args["file"], inputfilename), output_filename, args["format"]))
 
-            output_filename = inputfilename.replace('.yml', '.syx')
-
-            output = process_file(os.path.join(args["file"], inputfilename))
-            with open(os.path.join(args["output"], output_filename), 'w') as outputfile:
-                outputfile.write(output)
+        failed = False
+        for (inputfilename, _, _), result in zip(tasks, run_jobs(convert_to_file, tasks, args["jobs"])):
+            if isinstance(result, Exception):
+                print("Failed to convert " + inputfilename + ": " + str(result))
+                failed = True
+            elif result is not None:
+                print(result)
+        if failed:
+            exit(1)
     else:
-        print(process_file(args["file"]))
+        convert_file(args["file"], args["output"], args["format"])
@@ -0,0 +1,205 @@
+import mmap
+import os
+from typing import Iterable, Iterator, Optional
+
+from morningstar.utils import format_data, atomic_write, STANDARD_HEADER
+
+"""
+Readers and writers for the on-disk sysex formats: hex text (one frame per line), raw binary .syx (F0...F7 frames
+back to back) and a Standard MIDI File with the frames in a single track
+"""
+
+FORMAT_HEX = 'hex'
+FORMAT_SYX = 'syx'
+FORMAT_MIDI = 'mid'
+FORMATS = [FORMAT_HEX, FORMAT_SYX, FORMAT_MIDI]
+EXTENSIONS = {
+    '.txt': FORMAT_HEX,
+    '.hex': FORMAT_HEX,
+    '.syx': FORMAT_SYX,
+    '.mid': FORMAT_MIDI,
+    '.midi': FORMAT_MIDI,
+}
+
+SYSEX_START = STANDARD_HEADER[0]
+SYSEX_END = 0xF7
+MIDI_FILE_DIVISION = 480
+
+
+def format_for_filename(filename: Optional[str], default: str = FORMAT_HEX) -> str:
+    if not filename:
+        return default
+    return EXTENSIONS.get(os.path.splitext(filename)[1].lower(), default)
+
+
+def extension_for_format(file_format: str) -> str:
+    return '.txt' if file_format == FORMAT_HEX else '.' + file_format
+
+
+def is_sysex_filename(filename: str) -> bool:
+    return os.path.splitext(filename)[1].lower() in EXTENSIONS
+
+
+def iter_frames(lines: Iterable[str]) -> Iterator[bytes]:
+    """
+    Splits hex text into sysex frames running from F0 to F7, regardless of how they are spread across lines.
+    Unterminated frames or frames containing bad hex are still yielded so that they fail validation.
+    """
+    frame = None
+    for line in lines:
+        for token in line.split():
+            try:
+                value = int(token, 16)
+            except ValueError:
+                if frame is not None:
+                    yield bytes(frame)
+                frame = None
+                continue
+
+            if value == SYSEX_START:
+                if frame is not None:
+                    yield bytes(frame)
+                frame = bytearray([value])
+            elif frame is not None:
+                frame.append(value)
+                if value == SYSEX_END:
+                    yield bytes(frame)
+                    frame = None
+    if frame is not None:
+        yield bytes(frame)
+
+
+def iter_binary_frames(data) -> Iterator[memoryview]:
+    """
+    Yields each F0...F7 frame in data as a memoryview slice, without copying. Bytes between frames are skipped and a
+    frame which is interrupted by the start of another is yielded as it stands.
+    """
+    view = memoryview(data)
+    start_byte = bytes((SYSEX_START,))
+    end_byte = bytes((SYSEX_END,))
+    try:
+        start = data.find(start_byte)
+        while start != -1:
+            end = data.find(end_byte, start)
+            next_start = data.find(start_byte, start + 1)
+            if end == -1 or (next_start != -1 and next_start < end):
+                yield view[start:next_start if next_start != -1 else len(data)]
+                start = next_start
+            else:
+                yield view[start:end + 1]
+                start = data.find(start_byte, end)
+    finally:
+        view.release()
+
+
+def read_variable_length(data, offset: int):
+    value = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value = (value << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            return value, offset
+
+
+def write_variable_length(value: int) -> bytes:
+    data = [value & 0x7F]
+    value >>= 7
+    while value:
+        data.append((value & 0x7F) | 0x80)
+        value >>= 7
+    return bytes(reversed(data))
+
+
+def iter_midi_file_frames(data) -> Iterator[bytes]:
+    """
+    Yields every sysex event in every track of a Standard MIDI File as a complete F0...F7 frame
+    """
+    if data[0:4] != b'MThd':
+        raise Exception("Not a Standard MIDI File")
+    offset = 0
+    while offset + 8 <= len(data):
+        chunk_type = data[offset:offset + 4]
+        chunk_end = offset + 8 + int.from_bytes(data[offset + 4:offset + 8], 'big')
+        offset += 8
+        if chunk_type == b'MTrk':
+            status = 0
+            while offset < chunk_end:
+                delta, offset = read_variable_length(data, offset)
+                if data[offset] & 0x80:
+                    status = data[offset]
+                    offset += 1
+                if status == 0xFF:
+                    offset += 1
+                    length, offset = read_variable_length(data, offset)
+                    offset += length
+                elif status == SYSEX_START:
+                    length, offset = read_variable_length(data, offset)
+                    # SMF stores the data after the F0 status byte, so this is the one place a frame gets copied
+                    yield bytes((SYSEX_START,)) + data[offset:offset + length]
+                    offset += length
+                elif status == SYSEX_END:
+                    length, offset = read_variable_length(data, offset)
+                    offset += length
+                elif 0xC0 <= status <= 0xDF:
+                    offset += 1
+                else:
+                    offset += 2
+        offset = chunk_end
+
+
+def read_frames(filename: str, file_format: Optional[str] = None) -> Iterator:
+    """
+    Yields the sysex frames stored in a file. Binary files are memory mapped rather than read. A .syx file which
+    turns out to hold hex text is read as hex.
+    """
+    file_format = file_format or format_for_filename(filename, FORMAT_SYX)
+    if file_format != FORMAT_HEX:
+        with open(filename, 'rb') as input_file:
+            if os.fstat(input_file.fileno()).st_size == 0:
+                return
+            data = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if file_format == FORMAT_MIDI:
+                yield from iter_midi_file_frames(data)
+                return
+            if data[0] == SYSEX_START:
+                yield from iter_binary_frames(data)
+                return
+        finally:
+            try:
+                data.close()
+            except BufferError:
+                # frames are still referenced elsewhere, the map closes once they are garbage collected
+                pass
+
+    with open(filename, 'r') as input_file:
+        yield from iter_frames(input_file)
+
+
+def midi_file_bytes(frames: Iterable) -> bytes:
+    track = bytearray()
+    for frame in frames:
+        track += b'\x00\xF0'
+        track += write_variable_length(len(frame) - 1)
+        track += frame[1:]
+    track += b'\x00\xFF\x2F\x00'
+    return b'MThd' + (6).to_bytes(4, 'big') + (0).to_bytes(2, 'big') + (1).to_bytes(2, 'big') + \
+        MIDI_FILE_DIVISION.to_bytes(2, 'big') + b'MTrk' + len(track).to_bytes(4, 'big') + track
+
+
+def write_sysex(output_file, data: bytes, file_format: str):
+    """
+    Writes back to back sysex frames (eg from Bank.to_sysex_bytes) to an open file with a single write. Hex output
+    expects a file opened in text mode, the other formats binary mode.
+    """
+    if file_format == FORMAT_SYX:
+        output_file.write(data)
+    elif file_format == FORMAT_MIDI:
+        output_file.write(midi_file_bytes(iter_binary_frames(data)))
+    else:
+        output_file.write(format_data(iter_binary_frames(data)) + "\n")
+
+
+def open_output(filename: str, file_format: str):
+    return atomic_write(filename, 'w' if file_format == FORMAT_HEX else 'wb')
@@ -0,0 +1,92 @@
+import os
+import tempfile
+import unittest
+
+from morningstar.backup import Backup, send_next
+from morningstar.midi import DeviceSession
+from morningstar.model import Bank, NUM_BANKS, NUM_BANK_LINES
+from morningstar.sysex_converter import bank_to_yaml
+
+try:
+    import mido
+    from morningstar.emulator import Emulator
+except ImportError:
+    mido = None
+
+
+class LossyPort:
+    """
+    Wraps a port, losing or corrupting the replies at the given positions
+    """
+
+    def __init__(self, port, lost=(), corrupt=()):
+        self.port = port
+        self.lost = set(lost)
+        self.corrupt = set(corrupt)
+        self.replies = 0
+
+    def send(self, message):
+        self.port.send(message)
+
+    def iter_pending(self):
+        for message in self.port.iter_pending():
+            self.replies += 1
+            if self.replies in self.lost:
+                continue
+            if self.replies in self.corrupt:
+                data = list(message.data)
+                data[-1] ^= 1
+                message = mido.Message('sysex', data=data)
+            yield message
+
+    def close(self):
+        self.port.close()
+
+
+@unittest.skipIf(mido is None, "mido is not installed")
+class TestBackup(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        bank = Bank("BACKED UP")
+        bank.presets[2].name = "THREE"
+        bank.expression_presets[1].name = "PEDAL"
+        self.device = Emulator(banks=[Bank("FIRST"), bank])
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def backup(self, port, window=4) -> Backup:
+        with DeviceSession(port, ack_timeout=0.05) as session:
+            backup = Backup(session, self.directory.name, window=window, timeout=0.05)
+            self.assertTrue(backup.run())
+        for number in range(NUM_BANKS):
+            with open(os.path.join(self.directory.name, "bank" + str(number + 1).zfill(3) + ".yml")) as bank_file:
+                self.assertEqual(bank_file.read(), bank_to_yaml(self.device.bank(number)))
+        return backup
+
+    def test_backup_from_a_single_dump(self):
+        backup = self.backup(self.device)
+        self.assertEqual((backup.requests, backup.frames_received), (1, NUM_BANKS * NUM_BANK_LINES))
+
+    def test_only_missing_and_corrupt_lines_are_requested_again(self):
+        # the name line of the second bank is lost, so it takes a second dump, and so is a header, which isn't needed
+        port = LossyPort(self.device, lost=[NUM_BANK_LINES + 3, 40, 41, 200], corrupt=[7, 100, 539])
+        backup = self.backup(port)
+        self.assertEqual(backup.corrupt_frames, 3)
+        self.assertEqual((backup.requests, backup.retried), (2 + 5, 5))
+
+    def test_lost_send_next_replies_are_retried(self):
+        # the first bank's name and first three presets are lost, then the reply to the first Send Next and to its
+        # first retry
+        port = LossyPort(self.device, lost=[3, 4, 5, 6, 540 + 1, 540 + 4])
+        backup = self.backup(port, window=3)
+        self.assertEqual(backup.retried, 4 + 1)
+
+    def test_send_next_requests(self):
+        self.assertEqual(list(send_next(4, 3)[6:11]), [3, 0, 4, 0, 0])
+        self.assertEqual(list(send_next(4, 16)[6:11]), [3, 0, 4, 1, 1])
+
+
+if __name__ == "__main__":
+    unittest.main()
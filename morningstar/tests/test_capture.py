@@ -0,0 +1,134 @@
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+
+try:
+    import mido
+    from morningstar.proxy import capture, replay, server, wire
+    from morningstar.proxy.stats import TO_DEVICE, TO_CLIENTS
+except ImportError:
+    mido = None
+
+from morningstar.model import Bank
+
+
+@unittest.skipIf(mido is None, "mido is not installed")
+class TestCapture(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.cap')
+        os.close(handle)
+        os.remove(self.path)
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_round_trip_and_append(self):
+        line = bytes(Bank("CAPTURE").to_sysex()[2])
+        with capture.CaptureWriter(self.path) as writer:
+            now = time.monotonic()
+            writer.write(TO_DEVICE, [0xF8], now)
+            writer.write(TO_CLIENTS, line, now + 0.25)
+        with capture.CaptureWriter(self.path) as writer:
+            writer.write(TO_DEVICE, [0xFA])
+
+        with capture.CaptureReader(self.path) as reader:
+            records = list(reader)
+        self.assertEqual([(direction, data) for _, direction, data in records],
+                         [(TO_DEVICE, b'\xf8'), (TO_CLIENTS, line), (TO_DEVICE, b'\xfa')])
+        self.assertAlmostEqual(records[1][0] - records[0][0], 250000, delta=1)
+
+    def test_record_cut_short_is_ignored(self):
+        with capture.CaptureWriter(self.path) as writer:
+            writer.write(TO_DEVICE, [0xF8])
+            writer.write(TO_DEVICE, [0xC0, 0x05])
+        with open(self.path, 'r+b') as file:
+            file.truncate(os.path.getsize(self.path) - 1)
+        with capture.CaptureReader(self.path) as reader:
+            self.assertEqual([data for _, _, data in reader], [b'\xf8'])
+
+    def test_restart_after_a_record_cut_short(self):
+        line = bytes(Bank("CAPTURE").to_sysex()[2])
+        with capture.CaptureWriter(self.path) as writer:
+            writer.write(TO_DEVICE, [0xC0, 0x05])
+            writer.write(TO_CLIENTS, line)
+        # killed part way through writing the sysex line
+        with open(self.path, 'r+b') as file:
+            file.truncate(os.path.getsize(self.path) - len(line) // 2)
+        with capture.CaptureWriter(self.path) as writer:
+            for _ in range(5):
+                writer.write(TO_CLIENTS, [0xF8])
+        with capture.CaptureReader(self.path) as reader:
+            self.assertEqual([data for _, _, data in reader], [b'\xc0\x05'] + [b'\xf8'] * 5)
+
+        # or killed before the header was written
+        with open(self.path, 'wb') as file:
+            file.write(capture.MAGIC)
+        with capture.CaptureWriter(self.path) as writer:
+            writer.write(TO_DEVICE, [0xFA])
+        with capture.CaptureReader(self.path) as reader:
+            self.assertEqual([data for _, _, data in reader], [b'\xfa'])
+
+    def test_not_a_capture(self):
+        with open(self.path, 'wb') as file:
+            file.write(b'not a capture file')
+        with self.assertRaises(Exception):
+            capture.CaptureReader(self.path)
+
+    def test_replay_keeps_the_gaps_divided_by_speed(self):
+        with capture.CaptureWriter(self.path) as writer:
+            now = time.monotonic()
+            writer.write(TO_DEVICE, [0xFA], now)
+            writer.write(TO_CLIENTS, [0xF8], now + 0.1)
+            writer.write(TO_DEVICE, [0xFC], now + 0.5)
+        port = replay.MockPort()
+        result = replay.replay(self.path, port, speed=10)
+        self.assertEqual((result["messages"], result["bytes"], port.messages), (2, 2, 2))
+        self.assertGreaterEqual(result["elapsed_s"], 0.05)
+        self.assertLess(result["elapsed_s"], 0.4)
+
+        result = replay.replay(self.path, replay.MockPort(), speed=0, directions=(TO_DEVICE, TO_CLIENTS))
+        self.assertEqual(result["messages"], 3)
+        self.assertLess(result["elapsed_s"], 0.05)
+
+
+@unittest.skipIf(mido is None, "mido is not installed")
+class TestServerCapture(unittest.IsolatedAsyncioTestCase):
+
+    async def test_server_captures_both_directions(self):
+        handle, path = tempfile.mkstemp(suffix='.cap')
+        os.close(handle)
+        os.remove(path)
+        writer = capture.CaptureWriter(path)
+        device = replay.MockPort()
+        proxy = server.ProxyServer(device, capture=writer)
+        tcp_server = await proxy.start('127.0.0.1', 0)
+        loop = asyncio.get_event_loop()
+        connection = await loop.run_in_executor(None, lambda: wire.Connection(
+            '127.0.0.1', tcp_server.sockets[0].getsockname()[1]))
+        try:
+            connection.send(mido.Message('program_change', program=3))
+            for _ in range(100):
+                if device.messages:
+                    break
+                await asyncio.sleep(0.01)
+            proxy.fan_out(mido.Message('clock'))
+        finally:
+            await loop.run_in_executor(None, connection.close)
+            proxy.device_writer.cancel()
+            tcp_server.close()
+            await tcp_server.wait_closed()
+            writer.close()
+        try:
+            with capture.CaptureReader(path) as reader:
+                self.assertEqual([(direction, data) for _, direction, data in reader],
+                                 [(TO_DEVICE, b'\xc0\x03'), (TO_CLIENTS, b'\xf8')])
+        finally:
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    unittest.main()
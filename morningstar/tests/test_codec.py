@@ -0,0 +1,77 @@
+import os
+import unittest
+
+import yaml
+
+from morningstar import sysex_converter, sysex_file, yaml_converter
+from morningstar.codec import MESSAGE_CODECS, EXPRESSION_CODECS, MESSAGE_TYPES, EXPRESSION_TYPES
+from morningstar.model import Action, Message, Bank
+
+
+class TestCodec(unittest.TestCase):
+
+    def test_message_configs_round_trip(self):
+        configs = {
+            "program_change": 5,
+            "control_change": {"number": 5, "value": 6},
+            "note_on": {"number": 8, "velocity": 9},
+            "realtime": "start",
+            "sysex": [1, 2, 3],
+            "midi_clock": {"bpm": 250, "tap_menu": True},
+            "pc_scroll_up": {"increment": True, "slot": 15, "lower_limit": 1, "upper_limit": 2},
+            "device_set_bank": 12,
+            "midi_clock_tap": True,
+        }
+        for message_type, config in configs.items():
+            codec = MESSAGE_CODECS[message_type]
+            self.assertEqual(codec.decode(*codec.encode(config)), config, message_type)
+
+    def test_expression_configs_round_trip(self):
+        configs = {
+            "expression_cc": {"cc_number": 4, "cc_min_value": 1, "cc_max_value": 127},
+            "cc_heel_down": {"cc_number": 5, "cc_value": 6},
+            "toe_down_toggle_channel": {"number": 2, "channel1": 3, "channel2": 4},
+            "toe_down_toggle_cc": {"number": 2, "cc_number1": 3, "cc_number2": 4},
+        }
+        for message_type, config in configs.items():
+            codec = EXPRESSION_CODECS[message_type]
+            self.assertEqual(codec.decode(*codec.encode(config)), config, message_type)
+
+    def test_codec_ids_match_type_order(self):
+        self.assertEqual([MESSAGE_CODECS[name].id for name in MESSAGE_TYPES], list(range(len(MESSAGE_TYPES))))
+        self.assertEqual([EXPRESSION_CODECS[name].id for name in EXPRESSION_TYPES],
+                         list(range(len(EXPRESSION_TYPES))))
+
+    def test_matches_previous_encoding(self):
+        message = Message.from_config(MESSAGE_CODECS["pc_scroll_up"], {
+            "channel": 3, "pc_scroll_up": {"slot": 15, "lower_limit": 1, "upper_limit": 2, "increment": True}})
+        self.assertEqual([message.data1, message.data2, message.data3, message.channel], [30, 1, 2, 3])
+        message = Message().from_dict("midi_clock", {"midi_clock": {"bpm": 250, "tap_menu": True}})
+        self.assertEqual([message.data1, message.data2, message.data3], [2, 50, 1])
+
+    def test_message_to_config(self):
+        config = {"control_change": {"number": 5, "value": 6}, "channel": 7, "toggle_position": 2}
+        message = Message.from_config(MESSAGE_CODECS["control_change"], config)
+        self.assertEqual(message.to_config(), config)
+
+    def test_action_sysex_round_trip(self):
+        for toggle_mode in [1, 2, "both"]:
+            action = Action("long_press", [Message("note_on", 8, 9, 0, 10, toggle_mode)])
+            decoded = Action().from_sysex(action.to_sysex())
+            self.assertEqual(decoded.action_type, "long_press")
+            self.assertEqual(decoded.messages[0].to_dict(), action.messages[0].to_dict())
+
+    def test_debug_bank_round_trips_through_sysex(self):
+        with open(os.path.dirname(__file__) + '/../../yaml/debug.yml', 'r') as input_file:
+            bank = yaml_converter.convert_to_bank(yaml.safe_load(input_file)["bank"])
+        data = bank.to_sysex_bytes()
+
+        decoded = list(sysex_converter.iter_banks(sysex_file.iter_binary_frames(data)))
+
+        self.assertEqual(len(decoded), 1)
+        self.assertIsInstance(decoded[0], Bank)
+        self.assertEqual(decoded[0].to_sysex_bytes(), data)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,46 @@
+import tempfile
+import unittest
+
+from morningstar.delta import DeviceState, delta_frames
+from morningstar.model import Bank, NUM_BANK_LINES
+
+
+class TestDelta(unittest.TestCase):
+
+    def test_unknown_state_sends_whole_bank(self):
+        data = Bank("DELTA").to_sysex_bytes()
+        self.assertEqual(b''.join(delta_frames(None, data)), data)
+        self.assertEqual(len(delta_frames(None, data)), NUM_BANK_LINES)
+
+    def test_unchanged_bank_sends_nothing(self):
+        data = Bank("DELTA").to_sysex_bytes()
+        self.assertEqual(delta_frames(data, data), [])
+
+    def test_one_preset_edit(self):
+        bank = Bank("DELTA")
+        previous = bank.to_sysex_bytes()
+        bank.presets[4].name = "EDITED"
+        current = bank.to_sysex_bytes()
+        lines = bank.to_sysex()
+
+        frames = delta_frames(previous, current)
+
+        self.assertEqual([list(frame) for frame in frames], [lines[0], lines[1], lines[7], lines[-1]])
+
+    def test_state_is_only_known_for_the_bank_last_uploaded(self):
+        with tempfile.TemporaryDirectory() as directory:
+            state = DeviceState('test', directory)
+            first, second = Bank("FIRST").to_sysex_bytes(), Bank("SECOND").to_sysex_bytes()
+            self.assertIsNone(state.current())
+            state.save("first", first)
+            self.assertEqual(state.previous("first"), first)
+            state.save("second", second)
+            self.assertEqual(state.current(), "second")
+            self.assertIsNone(state.previous("first"))
+            self.assertEqual(state.load("first"), first)
+            state.set_current(None)
+            self.assertIsNone(state.previous("second"))
+
+
+if __name__ == "__main__":
+    unittest.main()
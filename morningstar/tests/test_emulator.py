@@ -0,0 +1,125 @@
+import asyncio
+import time
+import unittest
+
+import morningstar.midi
+from morningstar.delta import delta_frames
+from morningstar.midi import DeviceSession
+from morningstar.model import Bank, NUM_BANK_LINES
+from morningstar.sysex_converter import iter_banks
+from morningstar.utils import sysex_command
+
+try:
+    import mido
+    from morningstar import emulator
+    from morningstar.proxy import server
+except ImportError:
+    mido = None
+
+
+def sysex(frame) -> 'mido.Message':
+    return mido.Message('sysex', data=frame[1:-1])
+
+
+@unittest.skipIf(mido is None, "mido is not installed")
+class TestEmulator(unittest.TestCase):
+
+    def setUp(self):
+        self.bank = Bank("EMULATED")
+        self.bank.presets[1].name = "TWO"
+        self.device = emulator.Emulator()
+
+    def tearDown(self):
+        self.device.close()
+
+    def received(self):
+        return [bytes(message.bin()) for message in self.device.iter_pending()]
+
+    def test_upload_then_dump(self):
+        with DeviceSession(self.device, ack_timeout=0.05) as session:
+            morningstar.midi.send(self.bank.to_sysex(), session)
+            self.assertEqual(session.acks_received, NUM_BANK_LINES)
+            self.assertEqual(session.request_bank_dump(), self.bank.to_sysex_bytes())
+        self.assertEqual(self.device.banks_uploaded, 1)
+        self.assertEqual(self.device.bank(0).presets[1].name.strip(), "TWO")
+
+    def test_delta_upload(self):
+        previous = self.device.banks[0]
+        self.bank.presets[1].name = "CHANGED"
+        for frame in delta_frames(previous, self.bank.to_sysex_bytes()):
+            self.device.send(sysex(frame))
+        self.assertEqual(self.device.banks[0], self.bank.to_sysex_bytes())
+
+    def test_bad_checksums_are_not_acknowledged_or_applied(self):
+        lines = self.bank.to_sysex()
+        lines[4][-2] ^= 1
+        for line in lines:
+            self.device.send(sysex(line))
+        self.assertEqual(len(self.received()), NUM_BANK_LINES - 1)
+        self.assertEqual(self.device.checksum_errors, 1)
+        # the trailer's batch checksum doesn't match the bank with the old line 4
+        self.assertEqual((self.device.banks_uploaded, self.device.uploads_rejected), (0, 1))
+        self.assertEqual(self.device.bank(0).name.strip(), "Bank 1")
+
+    def test_dump_all_and_send_next(self):
+        self.device.send(sysex(sysex_command([0x00, 0x10])))
+        self.assertEqual(self.received(), [emulator.ACKNOWLEDGE_FRAME])
+        for line in self.bank.to_sysex():
+            self.device.send(sysex(line))
+        self.received()
+
+        self.device.send(sysex(sysex_command(list(emulator.DUMP_ALL))))
+        banks = list(iter_banks(self.received()))
+        self.assertEqual([bank.name.strip() for bank in banks[:3]], ["Bank 1", "EMULATED", "Bank 3"])
+        self.assertEqual(len(banks), emulator.NUM_BANKS)
+
+        self.device.send(sysex(sysex_command([0x03, 0x00, 1, 1, 0])))
+        self.assertEqual(self.received(), [bytes(self.bank.to_sysex()[4])])
+
+    def test_ping_is_only_answered_in_editor_mode(self):
+        ping = sysex(sysex_command(list(emulator.PING)))
+        self.device.send(ping)
+        self.assertEqual(self.received(), [])
+        self.device.send(sysex(sysex_command(list(emulator.EDITOR_MODE))))
+        self.device.send(ping)
+        self.assertEqual(self.received(), [emulator.ACKNOWLEDGE_FRAME, emulator.PING_REPLY])
+
+    def test_delay(self):
+        device = emulator.Emulator(delay=0.005)
+        start = time.monotonic()
+        with DeviceSession(device) as session:
+            self.assertIsNotNone(session.request_bank_dump())
+        self.assertGreaterEqual(time.monotonic() - start, 0.005 * (NUM_BANK_LINES + 1))
+
+    def test_dropped_frames_are_not_acknowledged(self):
+        device = emulator.Emulator(drop_rate=0.5, seed=1)
+        with DeviceSession(device, ack_timeout=0.01) as session:
+            session.send_frames(self.bank.to_sysex())
+        self.assertGreater(device.frames_dropped, 0)
+        self.assertEqual(session.acks_received, NUM_BANK_LINES - device.frames_dropped)
+        self.assertEqual(session.acks_missed, device.frames_dropped)
+
+
+@unittest.skipIf(mido is None, "mido is not installed")
+class TestProxiedEmulator(unittest.IsolatedAsyncioTestCase):
+
+    async def test_dump_bank_through_the_proxy(self):
+        proxy = server.ProxyServer()
+        proxy.device = device = emulator.Emulator(callback=proxy.device_message)
+        tcp_server = await proxy.start('127.0.0.1', 0)
+        reader, writer = await asyncio.open_connection('127.0.0.1', tcp_server.sockets[0].getsockname()[1])
+        try:
+            writer.write(sysex_command(list(emulator.DUMP_BANK)))
+            data = await asyncio.wait_for(reader.readexactly(len(device.banks[0])), 1)
+            self.assertEqual(data, device.banks[0])
+        finally:
+            writer.close()
+            await asyncio.sleep(0.01)
+            device.close()
+            proxy.device_writer.cancel()
+            tcp_server.close()
+            await tcp_server.wait_closed()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+import pickle
+import unittest
+
+from morningstar.delta import bank_line
+from morningstar.library import PresetStore
+from morningstar.model import Action, Bank, Message, NUM_BANK_LINES
+from morningstar.sysex_converter import iter_banks
+
+
+def tuner_bank(name) -> Bank:
+    bank = Bank(name)
+    bank.presets[0].name = "TUNER"
+    bank.presets[0].actions.append(Action("press", [Message("control_change", 68, 127)]))
+    return bank
+
+
+class TestLibrary(unittest.TestCase):
+
+    def setUp(self):
+        self.store = PresetStore()
+
+    def test_identical_presets_are_shared(self):
+        first = self.store.share(tuner_bank("FIRST"))
+        second = self.store.share(tuner_bank("SECOND"))
+        self.assertIs(first.presets[0], second.presets[0])
+        self.assertIs(first.presets[1], second.presets[1])
+        # the same preset on a different switch encodes differently
+        self.assertIsNot(first.presets[0], first.presets[1])
+        self.assertEqual(len(self.store), 14)
+        self.assertEqual(first.to_sysex_bytes(), tuner_bank("FIRST").to_sysex_bytes())
+        self.assertEqual(self.store.keys(first), self.store.keys(second))
+
+    def test_shared_presets_are_copied_on_write(self):
+        first = self.store.share(tuner_bank("FIRST"))
+        second = self.store.share(tuner_bank("SECOND"))
+        second.to_sysex_bytes()
+        shared = first.presets[0]
+        with self.assertRaises(Exception):
+            shared.name = "CHANGED"
+        with self.assertRaises(Exception):
+            shared.actions.append(Action())
+        with self.assertRaises(Exception):
+            shared.actions[0].messages[0].data2 = 0
+
+        preset = first.editable(shared)
+        self.assertIsNot(preset, shared)
+        self.assertIs(first.presets[0], preset)
+        self.assertIs(first.editable(preset), preset)
+        preset.name = "CHANGED"
+        preset.actions[0].messages[0].data2 = 0
+
+        expected = tuner_bank("FIRST")
+        expected.presets[0].name = "CHANGED"
+        expected.presets[0].actions[0].messages[0].data2 = 0
+        self.assertEqual(first.to_sysex_bytes(), expected.to_sysex_bytes())
+        self.assertEqual(second.to_sysex_bytes(), tuner_bank("SECOND").to_sysex_bytes())
+        self.assertEqual(shared.name, "TUNER")
+
+    def test_decoded_banks_share_presets(self):
+        frames = []
+        for name in ["ONE", "TWO", "THREE"]:
+            data = tuner_bank(name).to_sysex_bytes()
+            frames += [bank_line(data, line) for line in range(NUM_BANK_LINES)]
+        banks = list(iter_banks(frames, store=self.store))
+        self.assertEqual([bank.to_sysex_bytes() for bank in banks], [bank.to_sysex_bytes()
+                                                                     for bank in iter_banks(frames)])
+        self.assertIs(banks[0].presets[0], banks[2].presets[0])
+        self.assertIs(banks[1].expression_presets[1], banks[2].expression_presets[1])
+        # a blank preset for each switch, and the tuner
+        self.assertEqual(len(self.store), 15)
+
+    def test_copies_of_shared_banks_can_be_changed(self):
+        bank = pickle.loads(pickle.dumps(self.store.share(tuner_bank("FIRST"))))
+        bank.presets[0].name = "CHANGED"
+        self.assertEqual(bank.presets[0].name, "CHANGED")
+
+
+if __name__ == "__main__":
+    unittest.main()
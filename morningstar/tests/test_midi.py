@@ -0,0 +1,92 @@
+import time
+import unittest
+
+import morningstar.midi
+from morningstar.delta import bank_line
+from morningstar.midi import DeviceSession, ACKNOWLEDGE, DUMP_BANK
+from morningstar.model import Bank, NUM_BANK_LINES
+from morningstar.utils import sysex_command
+
+
+class LoopbackPort:
+    """
+    Stands in for a mido port. Acknowledges frames after ack_delay further frames have been sent (or never if
+    ack_delay is None) and answers a bank dump request with dump_data.
+    """
+
+    def __init__(self, ack_delay=0, dump_data=None):
+        self.ack_delay = ack_delay
+        self.dump_data = dump_data
+        self.sent = []
+        self.pending = []
+        self.unacknowledged = 0
+        self.max_unacknowledged = 0
+        self.closed = False
+
+    def send(self, message):
+        frame = [0xF0] + list(message.data) + [0xF7]
+        self.sent.append(frame)
+        if frame[6:8] == DUMP_BANK:
+            self.pending += [morningstar.midi.mido.Message('sysex', data=bank_line(self.dump_data, line)[1:-1])
+                             for line in range(0, NUM_BANK_LINES)]
+            return
+        self.unacknowledged += 1
+        self.max_unacknowledged = max(self.max_unacknowledged, self.unacknowledged)
+        if self.ack_delay is not None and self.unacknowledged > self.ack_delay:
+            self.unacknowledged -= 1
+            self.pending.append(morningstar.midi.mido.Message('sysex', data=sysex_command(list(ACKNOWLEDGE))[1:-1]))
+
+    def iter_pending(self):
+        pending, self.pending = self.pending, []
+        return iter(pending)
+
+    def close(self):
+        self.closed = True
+
+
+@unittest.skipUnless(hasattr(morningstar.midi, 'mido'), "mido is not installed")
+class TestDeviceSession(unittest.TestCase):
+
+    def setUp(self):
+        self.lines = Bank("SESSION").to_sysex()
+
+    def test_bank_is_sent_as_separate_frames(self):
+        port = LoopbackPort()
+        with DeviceSession(port) as session:
+            morningstar.midi.send(self.lines, session)
+        self.assertEqual(port.sent, self.lines)
+        self.assertEqual(session.acks_received, NUM_BANK_LINES)
+        self.assertTrue(port.closed)
+
+    def test_single_frame(self):
+        port = LoopbackPort()
+        with DeviceSession(port) as session:
+            morningstar.midi.send(self.lines[0], session)
+        self.assertEqual(port.sent, [self.lines[0]])
+
+    def test_window_bounds_frames_in_flight(self):
+        port = LoopbackPort(ack_delay=2)
+        with DeviceSession(port, window=3, ack_timeout=0.05) as session:
+            session.send_frames(self.lines)
+            self.assertLessEqual(port.max_unacknowledged, 3)
+        self.assertEqual(len(port.sent), NUM_BANK_LINES)
+        self.assertTrue(session.acknowledges)
+
+    def test_device_without_acknowledgements_is_only_paced(self):
+        port = LoopbackPort(ack_delay=None)
+        start = time.monotonic()
+        with DeviceSession(port, window=2, ack_timeout=0.05) as session:
+            session.send_frames(self.lines * 3)
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual(len(port.sent), NUM_BANK_LINES * 3)
+        self.assertFalse(session.acknowledges)
+        self.assertGreater(session.frames_per_second(), 0)
+
+    def test_request_bank_dump(self):
+        data = Bank("DUMPED").to_sysex_bytes()
+        with DeviceSession(LoopbackPort(dump_data=data)) as session:
+            self.assertEqual(session.request_bank_dump(timeout=0.5), data)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+import copy
+import os
+import pickle
+import unittest
+
+import yaml
+
+import morningstar.model
+from morningstar import yaml_converter
+
+
+def load_debug_bank():
+    with open(os.path.dirname(__file__) + '/../../yaml/debug.yml', 'r') as input_file:
+        return yaml_converter.convert_to_bank(yaml.safe_load(input_file)["bank"])
+
+
+class TestModel(unittest.TestCase):
+
+    def test_sysex_bytes_matches_sysex_lines(self):
+        bank = load_debug_bank()
+        data = bank.to_sysex_bytes()
+        lines = bank.to_sysex()
+
+        self.assertEqual(len(data), morningstar.model.BANK_SYSEX_LENGTH)
+        self.assertEqual(len(lines), morningstar.model.NUM_BANK_LINES)
+        self.assertEqual(data, bytes([b for line in lines for b in line]))
+
+    def test_preset_encode_into_offset(self):
+        bank = load_debug_bank()
+        start, end = morningstar.model.BANK_LINE_SPANS[4]
+        buffer = bytearray(end)
+        self.assertEqual(bank.presets[1].encode_into(buffer, start), end)
+        self.assertEqual(list(buffer[start:end]), bank.presets[1].to_sysex())
+
+    def test_changes_are_re_encoded(self):
+        bank = load_debug_bank()
+        bank.to_sysex_bytes()
+
+        bank.presets[0].actions[0].messages[0].data1 = 9
+        bank.presets[5].name = "CHANGED"
+        bank.expression_presets[1].messages.append(morningstar.model.Message())
+        bank.name = "RENAMED"
+
+        expected = load_debug_bank()
+        expected.presets[0].actions[0].messages[0].data1 = 9
+        expected.presets[5].name = "CHANGED"
+        expected.expression_presets[1].messages.append(morningstar.model.Message())
+        expected.name = "RENAMED"
+        self.assertEqual(bank.to_sysex_bytes(), expected.to_sysex_bytes())
+
+    def test_unchanged_presets_are_not_re_encoded(self):
+        bank = load_debug_bank()
+        bank.to_sysex_bytes()
+        lines = [preset.encoded_line() for preset in bank.presets]
+
+        bank.presets[2].blink_mode = False
+        bank.to_sysex_bytes()
+
+        for i, preset in enumerate(bank.presets):
+            if i == 2:
+                self.assertIsNot(preset.encoded_line(), lines[i])
+            else:
+                self.assertIs(preset.encoded_line(), lines[i])
+
+    def test_model_objects_have_no_instance_dict(self):
+        bank = load_debug_bank()
+        action = bank.presets[0].actions[0]
+        for model_object in [bank, bank.presets[0], bank.expression_presets[0], action, action.messages[0]]:
+            self.assertFalse(hasattr(model_object, '__dict__'), type(model_object).__name__)
+        with self.assertRaises(AttributeError):
+            action.messages[0].unknown_field = 1
+
+    def test_types_are_held_as_ids(self):
+        action = load_debug_bank().presets[0].actions[2]
+        self.assertEqual((action.action_type, action.id()), ("long_press", 3))
+        self.assertEqual(action.messages[0].to_dict(), {"channel": 7, "message_type": "control_change", "data1": 5,
+                                                        "data2": 6, "data3": 0, "toggle_mode": 1})
+        self.assertEqual(morningstar.model.Message("expression_cc").codec().message_type, "expression_cc")
+        with self.assertRaises(Exception):
+            morningstar.model.Message("unknown")
+        with self.assertRaises(Exception):
+            action.action_type = "unknown"
+
+    def test_copied_banks_still_track_changes(self):
+        expected = load_debug_bank()
+        expected.presets[0].actions[0].messages[0].data1 = 9
+        for bank in [pickle.loads(pickle.dumps(load_debug_bank())), copy.deepcopy(load_debug_bank())]:
+            self.assertEqual(bank.to_sysex_bytes(), load_debug_bank().to_sysex_bytes())
+            bank.presets[0].actions[0].messages[0].data1 = 9
+            self.assertEqual(bank.to_sysex_bytes(), expected.to_sysex_bytes())
+
+    @unittest.skipIf(morningstar.model.numpy is None, "numpy not installed")
+    def test_batch_encoding_matches_single_bank(self):
+        banks = [load_debug_bank(), morningstar.model.Bank("SECOND")]
+        banks[1].presets[3].blink_mode = True
+        self.assertEqual(morningstar.model.banks_to_sysex_bytes(banks), [bank.to_sysex_bytes() for bank in banks])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from morningstar import yaml_converter
+from morningstar.model import Bank, NUM_BANK_LINES
+from morningstar.pack import PackReader, write_pack, DEFAULT_PACK_FILENAME
+
+YAML_DIRECTORY = os.path.dirname(__file__) + '/../../yaml'
+
+
+class TestPack(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, DEFAULT_PACK_FILENAME)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_banks_read_back(self):
+        banks = [Bank("BANK " + str(i)).to_sysex_bytes() for i in range(5)]
+        with open(self.path, 'wb') as pack_file:
+            write_pack(pack_file, banks[:3] + [None] + banks[4:])
+        with PackReader(self.path) as pack:
+            self.assertEqual(len(pack), 5)
+            self.assertEqual(bytes(pack.bank_bytes(4)), banks[4])
+            self.assertEqual([bytes(frame) for frame in pack.frames(1)],
+                             [bytes(line) for line in Bank("BANK 1").to_sysex()])
+            self.assertEqual(pack.view(2).name.strip(), "BANK 2")
+            self.assertNotIn(3, pack)
+            self.assertNotIn(5, pack)
+            with self.assertRaises(Exception):
+                pack.bank_bytes(3)
+
+    def test_bad_files_are_refused(self):
+        with open(self.path, 'wb') as pack_file:
+            write_pack(pack_file, [Bank("BANK").to_sysex_bytes()])
+        with open(self.path, 'rb') as pack_file:
+            data = pack_file.read()
+        for contents in [b'', b'XXXX' + data[4:], data[:20]]:
+            with open(self.path, 'wb') as pack_file:
+                pack_file.write(contents)
+            with self.assertRaises(Exception):
+                PackReader(self.path)
+
+    def test_directory_to_pack_and_back(self):
+        args = {"send": False, "bank": None, "format": "syx", "quiet": True}
+        self.assertTrue(yaml_converter.process_directory_to_pack(YAML_DIRECTORY, self.path, args))
+        filenames = yaml_converter.yaml_filenames(YAML_DIRECTORY)
+        with PackReader(self.path) as pack:
+            self.assertEqual(len(pack), len(filenames))
+        output = os.path.join(self.directory, 'bank.syx')
+        data_bytes = yaml_converter.process_pack_bank(self.path, output, dict(args, bank=2))
+        with open(filenames[1], 'r') as yaml_file:
+            expected = yaml_converter.main(yaml_file, quiet=True)
+        self.assertEqual(data_bytes, expected)
+        self.assertEqual(len(data_bytes), NUM_BANK_LINES)
+        with open(output, 'rb') as output_file:
+            self.assertEqual(output_file.read(), bytes([b for line in expected for b in line]))
+
+    def test_bank_of_a_directory_uses_an_up_to_date_pack(self):
+        input_directory = os.path.join(self.directory, 'yaml')
+        shutil.copytree(YAML_DIRECTORY, input_directory)
+        args = {"send": False, "bank": 3, "format": "syx", "quiet": True}
+        pack_path = os.path.join(input_directory, DEFAULT_PACK_FILENAME)
+        with open(pack_path, 'wb') as pack_file:
+            write_pack(pack_file, [Bank("PACKED " + str(i)).to_sysex_bytes() for i in range(3)])
+        data_bytes = yaml_converter.process_directory_bank(input_directory, None, args)
+        self.assertEqual(data_bytes, Bank("PACKED 2").to_sysex())
+
+        # once a YAML file is newer than the pack, the bank comes from its YAML file instead
+        os.utime(pack_path, (0, 0))
+        data_bytes = yaml_converter.process_directory_bank(input_directory, None, args)
+        with open(yaml_converter.yaml_filenames(input_directory)[2], 'r') as yaml_file:
+            self.assertEqual(data_bytes, yaml_converter.main(yaml_file, quiet=True))
+
+
+if __name__ == "__main__":
+    unittest.main()
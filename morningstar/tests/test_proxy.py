@@ -0,0 +1,534 @@
+import asyncio
+import json
+import logging
+import socket
+import threading
+import unittest
+
+try:
+    import mido
+    from morningstar.proxy import server, wire, scheduler, stats
+except ImportError:
+    mido = None
+
+from morningstar.model import Bank, NUM_BANKS
+from morningstar.proxy import cache
+from morningstar.utils import sysex_command
+
+
+class FakeDevice:
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, message):
+        self.sent.append(message)
+
+
+@unittest.skipIf(mido is None, "mido is not installed")
+class TestProxyServer(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.device = FakeDevice()
+        self.proxy = server.ProxyServer(self.device, queue_size=4)
+        self.server = await self.proxy.start('127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self):
+        self.proxy.device_writer.cancel()
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def wait_for_clients(self, count):
+        for _ in range(100):
+            if len(self.proxy.clients) == count:
+                return
+            await asyncio.sleep(0.01)
+        self.fail("expected " + str(count) + " clients but have " + str(len(self.proxy.clients)))
+
+    async def wait_for_device(self, count):
+        for _ in range(100):
+            if len(self.device.sent) >= count:
+                return
+            await asyncio.sleep(0.01)
+        self.fail("expected " + str(count) + " messages sent to device but have " + str(len(self.device.sent)))
+
+    async def test_device_messages_fan_out_to_every_client(self):
+        connections = [await asyncio.open_connection('127.0.0.1', self.port) for _ in range(3)]
+        await self.wait_for_clients(3)
+        message = mido.Message('sysex', data=Bank("FANOUT").to_sysex()[2][1:-1])
+
+        # the device calls back from its own thread
+        thread = threading.Thread(target=self.proxy.device_message, args=(message,))
+        thread.start()
+        thread.join()
+
+        for reader, writer in connections:
+            data = await asyncio.wait_for(reader.readexactly(len(message.bin())), 1)
+            self.assertEqual(data, bytes(message.bin()))
+            writer.close()
+
+    async def test_client_messages_are_sent_to_device(self):
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+        lines = Bank("UPLOAD").to_sysex()
+        # split mid-message to check messages are reassembled
+        data = bytes([b for line in lines for b in line])
+        writer.write(data[:100])
+        await writer.drain()
+        await asyncio.sleep(0.01)
+        writer.write(data[100:])
+        await writer.drain()
+        await self.wait_for_device(len(lines))
+        self.assertEqual([[0xF0] + list(message.data) + [0xF7] for message in self.device.sent], lines)
+        # the send time is recorded once the device thread hands back
+        for _ in range(100):
+            if self.proxy.counters.device_send_us.count == len(lines):
+                break
+            await asyncio.sleep(0.01)
+        counters = self.proxy.stats()
+        self.assertEqual(counters["messages"]["to_device"], len(lines))
+        self.assertEqual(counters["bytes"]["to_device"], len(data))
+        self.assertEqual(counters["device_send_us"]["count"], len(lines))
+        self.assertEqual(counters["connections"], 1)
+        writer.close()
+
+    async def test_slow_client_is_disconnected(self):
+        slow_reader, slow_writer = await asyncio.open_connection('127.0.0.1', self.port)
+        await self.wait_for_clients(1)
+        slow = next(iter(self.proxy.clients))
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+        await self.wait_for_clients(2)
+        while not slow.queue.full():
+            slow.queue.put_nowait(b'', scheduler.SYSEX)
+
+        message = mido.Message('program_change', program=5)
+        self.proxy.fan_out(message)
+
+        self.assertEqual(await asyncio.wait_for(reader.readexactly(2), 1), bytes(message.bin()))
+        self.assertNotIn(slow, self.proxy.clients)
+        self.assertEqual(len(self.proxy.clients), 1)
+        writer.close()
+        slow_writer.close()
+
+    async def test_binary_transport(self):
+        lines = Bank("BINARY").to_sysex()
+        connection = await self.binary_round_trip(lines, compress=False)
+        self.assertEqual(connection.version, wire.COMPRESSION_VERSION - 1)
+        # every frame was coalesced into a few writes but carries its own length prefix
+        self.assertEqual(connection.bytes_sent, sum(len(line) + wire.FRAME_HEADER.size for line in lines))
+
+    async def test_compressed_binary_transport(self):
+        lines = Bank("COMPRESSED").to_sysex() + Bank("SECOND").to_sysex()
+        connection = await self.binary_round_trip(lines, compress=True)
+        self.assertEqual(connection.version, wire.PROTOCOL_VERSION)
+        self.assertLess(connection.bytes_sent, sum(len(line) for line in lines) / 5)
+
+    async def binary_round_trip(self, lines, compress):
+        loop = asyncio.get_event_loop()
+        # room for a couple of banks
+        self.proxy.queue_size = 64
+        connection = await loop.run_in_executor(None, lambda: wire.Connection('127.0.0.1', self.port,
+                                                                              compress=compress))
+        await self.wait_for_clients(1)
+
+        for line in lines:
+            connection.send(mido.Message.from_bytes(line))
+        for line in lines:
+            self.proxy.device_message(mido.Message.from_bytes(line))
+        received = iter(connection)
+        messages = await loop.run_in_executor(None, lambda: [next(received) for _ in lines])
+        await self.wait_for_device(len(lines))
+
+        self.assertEqual([message.bin() for message in messages], [bytearray(line) for line in lines])
+        self.assertEqual([message.bin() for message in self.device.sent], [bytearray(line) for line in lines])
+        await loop.run_in_executor(None, connection.close)
+        return connection
+
+    async def test_clock_overtakes_queued_upload(self):
+        sending = threading.Event()
+        release = threading.Event()
+        send = self.device.send
+
+        def slow_send(message):
+            # hold up the device on the first frame, as a real upload would
+            sending.set()
+            release.wait(1)
+            send(message)
+        self.device.send = slow_send
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+        lines = Bank("CLOCK").to_sysex()
+        writer.write(bytes([b for line in lines for b in line]))
+        await writer.drain()
+        await asyncio.get_event_loop().run_in_executor(None, sending.wait, 1)
+        clock = mido.Message('clock')
+        writer.write(clock.bin())
+        await writer.drain()
+        for _ in range(100):
+            if self.proxy.device_queue.qsize() == len(lines):
+                break
+            await asyncio.sleep(0.01)
+        release.set()
+
+        await self.wait_for_device(len(lines) + 1)
+        self.assertEqual(self.device.sent[1], clock)
+        self.assertEqual([message.bin() for message in self.device.sent[:1] + self.device.sent[2:]],
+                         [bytearray(line) for line in lines])
+        stats = self.proxy.stats()["queued"]["to_device"]
+        self.assertEqual(stats["realtime"]["count"], 1)
+        self.assertEqual(stats["sysex"]["count"], len(lines))
+        self.assertLess(stats["realtime"]["max_us"], stats["sysex"]["max_us"])
+        writer.close()
+
+    async def test_rtp_clock_is_queued_while_an_upload_fills_the_device_queue(self):
+        sending = threading.Event()
+        release = threading.Event()
+        send = self.device.send
+
+        def slow_send(message):
+            sending.set()
+            release.wait(1)
+            send(message)
+        self.device.send = slow_send
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+        lines = [line for name in ("ONE", "TWO", "THREE", "FOUR") for line in Bank(name).to_sysex()]
+        writer.write(bytes([b for line in lines for b in line]))
+        await writer.drain()
+        await asyncio.get_event_loop().run_in_executor(None, sending.wait, 1)
+        for _ in range(100):
+            if self.proxy.device_queue.full():
+                break
+            await asyncio.sleep(0.01)
+        self.assertTrue(self.proxy.device_queue.full())
+
+        clock = mido.Message('clock')
+        self.proxy.rtp_message(None, clock)
+        self.assertEqual(self.proxy.device_queue.qsize(), server.DEVICE_QUEUE_SIZE + 1)
+        release.set()
+
+        await self.wait_for_device(len(lines) + 1)
+        self.assertEqual(self.device.sent[1], clock)
+        self.assertEqual([message.bin() for message in self.device.sent[:1] + self.device.sent[2:]],
+                         [bytearray(line) for line in lines])
+        writer.close()
+
+
+@unittest.skipIf(mido is None, "mido is not installed")
+class TestScheduler(unittest.IsolatedAsyncioTestCase):
+
+    async def test_highest_priority_first_then_oldest(self):
+        queue = scheduler.Scheduler()
+        for item, priority in [("sysex1", scheduler.SYSEX), ("cc", scheduler.CHANNEL), ("sysex2", scheduler.SYSEX),
+                               ("clock", scheduler.REALTIME)]:
+            queue.put_nowait(item, priority)
+        self.assertEqual([(await queue.get())[0] for _ in range(4)], ["clock", "cc", "sysex1", "sysex2"])
+        self.assertTrue(queue.empty())
+        self.assertEqual([stats.count for stats in queue.stats], [1, 1, 2])
+
+    async def test_bound_does_not_hold_up_realtime(self):
+        queue = scheduler.Scheduler(1)
+        queue.put_nowait("sysex", scheduler.SYSEX)
+        with self.assertRaises(asyncio.QueueFull):
+            queue.put_nowait("cc", scheduler.CHANNEL)
+        queue.put_nowait("start", scheduler.REALTIME)
+        self.assertEqual((await queue.get())[0], "start")
+        await asyncio.wait_for(queue.put("clock", scheduler.REALTIME), 1)
+        waiting = asyncio.ensure_future(queue.put("cc", scheduler.CHANNEL))
+        await asyncio.sleep(0)
+        self.assertFalse(waiting.done())
+        self.assertEqual((await queue.get())[0], "clock")
+        self.assertEqual((await queue.get())[0], "sysex")
+        await asyncio.wait_for(waiting, 1)
+        self.assertEqual((await queue.get())[0], "cc")
+
+    def test_classify(self):
+        for message, priority in [(mido.Message('clock'), scheduler.REALTIME),
+                                  (mido.Message('songpos', pos=4), scheduler.REALTIME),
+                                  (mido.Message('program_change', program=1), scheduler.CHANNEL),
+                                  (mido.Message('sysex', data=[1, 2]), scheduler.SYSEX)]:
+            self.assertEqual(scheduler.classify_message(message), priority)
+            self.assertEqual(scheduler.classify_bytes(message.bin()), priority)
+
+    def test_jitter(self):
+        stats = scheduler.LatencyStats()
+        for latency in [0.001, 0.001, 0.003]:
+            stats.record(latency)
+        self.assertEqual(stats.to_dict(), {"count": 3, "mean_us": 1666.7, "min_us": 1000.0, "max_us": 3000.0,
+                                           "jitter_us": 125.0, "p50_us": 1007, "p99_us": 3000})
+
+
+@unittest.skipIf(mido is None, "mido is not installed")
+class TestStats(unittest.IsolatedAsyncioTestCase):
+
+    def test_histogram_buckets_are_within_precision(self):
+        for value in [0, 1, 31, 32, 33, 63, 64, 1000, 123456789]:
+            lowest, highest = stats.bucket_range(stats.bucket_index(value))
+            self.assertLessEqual(lowest, value)
+            self.assertGreaterEqual(highest, value)
+            self.assertLessEqual(highest - lowest, max(value / 16, 1))
+
+    def test_histogram_percentiles(self):
+        histogram = stats.Histogram()
+        for value in range(1, 1001):
+            histogram.record(value)
+        result = histogram.to_dict()
+        self.assertEqual((result["count"], result["min"], result["max"], result["mean"]), (1000, 1, 1000, 500.5))
+        self.assertEqual(result["p50"], 503)
+        self.assertEqual(result["p99"], 991)
+        self.assertEqual(result["p99_9"], 1000)
+
+    def test_rate_limit(self):
+        limit = stats.RateLimitFilter(rate=2)
+        records = [logging.LogRecord("proxy", logging.DEBUG, "", 0, "Proxying %s", ("x",), None) for _ in range(5)]
+        for record in records:
+            record.created = 100.5
+        self.assertEqual([limit.filter(record) for record in records], [True, True, False, False, False])
+        warning = logging.LogRecord("proxy", logging.WARNING, "", 0, "Proxying %s", ("x",), None)
+        self.assertTrue(limit.filter(warning))
+        later = logging.LogRecord("proxy", logging.DEBUG, "", 0, "Proxying %s", ("x",), None)
+        later.created = 101.0
+        self.assertTrue(limit.filter(later))
+        self.assertEqual(later.getMessage(), "Proxying x (3 similar messages suppressed)")
+
+    async def test_serves_stats_as_json(self):
+        endpoint = await stats.serve_stats('127.0.0.1', 0, lambda: {"messages": 5})
+        reader, writer = await asyncio.open_connection('127.0.0.1', endpoint.sockets[0].getsockname()[1])
+        writer.write(b'GET / HTTP/1.0\r\n\r\n')
+        response = await asyncio.wait_for(reader.read(), 1)
+        headers, body = response.split(b'\r\n\r\n', 1)
+        self.assertTrue(headers.startswith(b'HTTP/1.0 200 OK'))
+        self.assertEqual(json.loads(body), {"messages": 5})
+        writer.close()
+        endpoint.close()
+        await endpoint.wait_closed()
+
+
+class DumpingDevice(FakeDevice):
+    """
+    Answers Dump Bank with a bank, as the device would
+    """
+
+    def __init__(self, proxy, bank):
+        super().__init__()
+        self.proxy = proxy
+        self.bank = bank
+        # answers are kept here rather than sent, if it is a list
+        self.held = None
+
+    def send(self, message):
+        super().send(message)
+        if message.bin() == bytearray(sysex_command(list(cache.DUMP_BANK))):
+            for line in self.bank.to_sysex():
+                if self.held is not None:
+                    self.held.append(mido.Message.from_bytes(line))
+                else:
+                    self.proxy.device_message(mido.Message.from_bytes(line))
+
+
+@unittest.skipIf(mido is None, "mido is not installed")
+class TestCachedDumps(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.proxy = server.ProxyServer()
+        self.bank = Bank("CACHED")
+        self.proxy.device = self.device = DumpingDevice(self.proxy, self.bank)
+        self.server = await self.proxy.start('127.0.0.1', 0)
+        self.reader, self.writer = await asyncio.open_connection('127.0.0.1', self.server.sockets[0].getsockname()[1])
+
+    async def asyncTearDown(self):
+        self.writer.close()
+        # let the server see the connection close
+        await asyncio.sleep(0.01)
+        self.proxy.device_writer.cancel()
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def dump_bank(self):
+        self.writer.write(sysex_command(list(cache.DUMP_BANK)))
+        data = await asyncio.wait_for(self.reader.readexactly(len(self.bank.to_sysex_bytes())), 1)
+        self.assertEqual(data, self.bank.to_sysex_bytes())
+
+    async def test_repeated_dump_is_answered_from_the_cache(self):
+        await self.dump_bank()
+        await self.dump_bank()
+        self.assertEqual(len(self.device.sent), 1)
+        self.assertEqual(self.proxy.stats()["cache"], {"entries": 1, "hits": 1, "misses": 1, "invalidations": 0})
+
+        # an upload clears the cache
+        self.writer.write(bytes(Bank("UPLOAD").to_sysex()[2]))
+        await self.dump_bank()
+        self.assertEqual(len(self.device.sent), 3)
+
+    async def test_answer_is_cached_after_the_client_has_gone(self):
+        self.device.held = []
+        self.writer.write(sysex_command(list(cache.DUMP_BANK)))
+        for _ in range(100):
+            if self.device.held:
+                break
+            await asyncio.sleep(0.01)
+        self.writer.close()
+        for _ in range(100):
+            if not self.proxy.clients:
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual(self.proxy.clients, set())
+        for message in self.device.held:
+            self.proxy.fan_out(message)
+
+        self.device.held = None
+        self.reader, self.writer = await asyncio.open_connection('127.0.0.1', self.server.sockets[0].getsockname()[1])
+        await self.dump_bank()
+        self.assertEqual(len(self.device.sent), 1)
+
+    async def test_passthrough(self):
+        self.proxy.cache = None
+        await self.dump_bank()
+        await self.dump_bank()
+        self.assertEqual(len(self.device.sent), 2)
+
+
+class TestDeviceCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = cache.DeviceCache(quiet=0)
+        self.lines = [bytes(line) for line in Bank("CACHE").to_sysex()]
+
+    def test_send_next_is_cached_per_preset(self):
+        first, second = sysex_command([3, 0, 0, 1, 0]), sysex_command([3, 0, 0, 2, 0])
+        self.assertIsNone(self.cache.request(first))
+        self.cache.response(self.lines[4])
+        self.assertEqual(self.cache.request(first), [self.lines[4]])
+        self.assertIsNone(self.cache.request(second))
+
+        # pressing a button may change the current bank, but not what is stored in each one
+        self.cache.channel_message()
+        self.assertEqual(self.cache.request(first), [self.lines[4]])
+
+    def test_dump_all_is_cached_once_the_device_is_quiet(self):
+        dump_all = sysex_command(list(cache.DUMP_ALL))
+        self.assertIsNone(self.cache.request(dump_all))
+        for line in self.lines + [bytes(line) for line in Bank("SECOND").to_sysex()]:
+            self.cache.response(line)
+        self.assertIsNone(self.cache.request(sysex_command([0x00, 0x7D])))
+        self.assertEqual(len(self.cache.request(dump_all)), len(self.lines) * 2)
+        self.assertEqual([bank.name.strip() for bank in self.cache.entries[dump_all[6:14]].banks], ["CACHE", "SECOND"])
+
+    def test_dump_all_is_kept_once_quiet_while_other_requests_are_answered(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        self.cache = cache.DeviceCache()
+        self.cache.loop = loop
+        dump_all, send_next = sysex_command(list(cache.DUMP_ALL)), sysex_command([3, 0, 0, 1, 0])
+        second = [bytes(line) for line in Bank("SECOND").to_sysex()]
+        self.cache.request(dump_all)
+        for line in self.lines + [self.lines[3]] + second:
+            self.cache.response(line)
+
+        # a request straight after the dump doesn't lose it, and is answered as usual
+        self.assertIsNone(self.cache.request(send_next))
+        self.cache.response(self.lines[4])
+        self.assertEqual(self.cache.request(send_next), [self.lines[4]])
+        self.assertNotIn(dump_all[6:14], self.cache.entries)
+
+        loop.run_until_complete(asyncio.sleep(cache.DUMP_ALL_QUIET * 1.5))
+        self.assertEqual(self.cache.request(dump_all), self.lines + second)
+
+    def test_dump_all_is_kept_once_every_bank_is_sent(self):
+        self.cache = cache.DeviceCache()
+        dump_all, send_next = sysex_command(list(cache.DUMP_ALL)), sysex_command([3, 0, 0, 1, 0])
+        self.cache.request(dump_all)
+        for _ in range(NUM_BANKS // 2):
+            for line in self.lines:
+                self.cache.response(line)
+        self.assertIsNone(self.cache.request(send_next))
+        for _ in range(NUM_BANKS - NUM_BANKS // 2):
+            for line in self.lines:
+                self.cache.response(line)
+        self.cache.response(self.lines[4])
+        self.assertEqual(len(self.cache.request(dump_all)), NUM_BANKS * len(self.lines))
+        self.assertEqual(self.cache.request(send_next), [self.lines[4]])
+
+    def test_bad_checksums_and_partial_banks_are_not_cached(self):
+        dump_bank = sysex_command(list(cache.DUMP_BANK))
+        corrupt = bytearray(self.lines[5])
+        corrupt[-2] ^= 1
+        self.cache.request(dump_bank)
+        for line in self.lines[:5] + [bytes(corrupt)] + self.lines[6:]:
+            self.cache.response(line)
+        self.assertIsNone(self.cache.request(dump_bank))
+        for line in self.lines[:10]:
+            self.cache.response(line)
+        self.assertIsNone(self.cache.request(dump_bank))
+        self.assertEqual(self.cache.entries, {})
+
+    def test_editor_mode_and_unprompted_dumps_invalidate(self):
+        dump_bank = sysex_command(list(cache.DUMP_BANK))
+        self.cache.request(dump_bank)
+        for line in self.lines:
+            self.cache.response(line)
+        self.cache.response(self.lines[3])
+        self.assertIsNone(self.cache.request(dump_bank))
+        for line in self.lines:
+            self.cache.response(line)
+        self.cache.request(sysex_command([0x00, 0x20]))
+        self.assertEqual(self.cache.entries, {})
+        self.assertEqual(self.cache.invalidations, 1)
+
+
+@unittest.skipIf(mido is None, "mido is not installed")
+class TestWire(unittest.TestCase):
+
+    def test_frames_split_across_reads(self):
+        lines = Bank("FRAMES").to_sysex()
+        data = b''.join(wire.encode_frame(bytes(line)) for line in lines)
+        decoder = wire.FrameDecoder()
+        messages = []
+        for i in range(0, len(data), 7):
+            messages += decoder.feed(data[i:i + 7])
+        self.assertEqual([list(message.bin()) for message in messages], lines)
+
+    def test_large_frames_are_compressed(self):
+        frames = [bytes(line) for line in Bank("ZLIB").to_sysex()]
+        frames.insert(5, bytes(mido.Message('clock').bin()))
+        encoder = wire.FrameEncoder()
+        data = b''.join(encoder.encode(frame) for frame in frames)
+        self.assertLess(len(data), sum(len(frame) for frame in frames) / 5)
+
+        decoder = wire.FrameDecoder()
+        messages = []
+        for i in range(0, len(data), 5):
+            messages += decoder.feed(data[i:i + 5])
+        self.assertEqual([bytes(message.bin()) for message in messages], frames)
+
+        # small frames are never compressed, and version 1 never compresses anything
+        self.assertEqual(wire.FrameEncoder().encode(frames[5]), wire.encode_frame(frames[5]))
+        self.assertEqual(wire.FrameEncoder(1).encode(frames[3]), wire.encode_frame(frames[3]))
+
+    def test_falls_back_to_raw_midi_for_old_servers(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        message = mido.Message('control_change', control=4, value=5)
+
+        def old_server():
+            # like mido.sockets.PortServer, ignores the hello and only ever writes raw MIDI
+            connection, address = listener.accept()
+            connection.sendall(message.bin())
+            connection.recv(16)
+            connection.close()
+
+        thread = threading.Thread(target=old_server)
+        thread.start()
+        timeout = wire.HANDSHAKE_TIMEOUT
+        wire.HANDSHAKE_TIMEOUT = 0.1
+        try:
+            with wire.Connection('127.0.0.1', listener.getsockname()[1]) as connection:
+                self.assertIsNone(connection.version)
+                self.assertEqual(list(connection), [message])
+        finally:
+            wire.HANDSHAKE_TIMEOUT = timeout
+            thread.join()
+            listener.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
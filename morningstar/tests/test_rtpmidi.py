@@ -0,0 +1,190 @@
+import asyncio
+import unittest
+
+try:
+    import mido
+    from morningstar.proxy import rtpmidi, server, wire
+except ImportError:
+    mido = None
+
+from morningstar.model import Bank
+
+
+@unittest.skipIf(mido is None, "mido is not installed")
+class TestRtpMidiPackets(unittest.TestCase):
+
+    def test_packet_round_trip(self):
+        messages = [mido.Message('clock'), mido.Message('program_change', channel=3, program=7),
+                    mido.Message('control_change', channel=1, control=4, value=100), mido.Message('start')]
+        journal = rtpmidi.Journal(65534)
+        journal.record(mido.Message('start'), 65534)
+        journal.record(mido.Message('clock'), 65535)
+        journal.record(mido.Message('program_change', channel=3, program=5), 65535)
+        journal.record(mido.Message('control_change', channel=3, control=1, value=2), 65536)
+
+        ssrc, sequence, decoded, parsed = rtpmidi.decode_packet(
+            rtpmidi.encode_packet(65537, 1234, messages, journal.encode()))
+
+        self.assertEqual((ssrc, sequence), (1234, 1))
+        self.assertEqual(decoded, messages)
+        self.assertEqual(parsed, {"checkpoint": 65534, "running": True, "clocks": 1, "programs": {3: 5},
+                                  "controllers": {3: {1: 2}}})
+
+    def test_long_command_section(self):
+        messages = [mido.Message('control_change', control=i, value=i) for i in range(20)]
+        self.assertEqual(rtpmidi.decode_packet(rtpmidi.encode_packet(1, 2, messages))[2], messages)
+
+    def test_acknowledged_changes_leave_the_journal(self):
+        journal = rtpmidi.Journal(10)
+        journal.record(mido.Message('program_change', program=5), 10)
+        journal.record(mido.Message('control_change', control=1, value=2), 11)
+        journal.acknowledge(10)
+        parsed = rtpmidi.parse_journal(journal.encode(), 0)
+        self.assertEqual((parsed["checkpoint"], parsed["programs"], parsed["controllers"]), (11, {}, {0: {1: 2}}))
+        journal.acknowledge(11)
+        self.assertEqual(journal.encode(), b'')
+
+    def test_recovery(self):
+        sender = rtpmidi.MidiState()
+        receiver = rtpmidi.MidiState()
+        for message in [mido.Message('start'), mido.Message('clock'), mido.Message('program_change', program=1)]:
+            sender.record(message)
+            receiver.record(message)
+        journal = rtpmidi.Journal()
+        for message in [mido.Message('start'), mido.Message('clock'), mido.Message('clock'), mido.Message('stop'),
+                        mido.Message('program_change', program=9)]:
+            journal.record(message)
+        recovered = receiver.recover(rtpmidi.parse_journal(journal.encode(), 0))
+        self.assertEqual(recovered, [mido.Message('stop'), mido.Message('program_change', program=9)])
+        self.assertEqual((receiver.running, receiver.clocks), (False, 2))
+
+
+@unittest.skipIf(mido is None, "mido is not installed")
+class TestRtpMidiSession(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.received = []
+        self.peers = []
+        self.listener = rtpmidi.RtpMidiSession("listener", on_message=lambda peer, message: self.received.append(
+            message), on_peer=lambda peer, connected: self.peers.append((peer.name, connected)))
+        self.port = await self.listener.listen('127.0.0.1', 0)
+        self.initiator = rtpmidi.RtpMidiSession("initiator", accept=False)
+        await self.initiator.listen('127.0.0.1', 0)
+
+    async def asyncTearDown(self):
+        self.initiator.close()
+        self.listener.close()
+
+    async def wait_for(self, condition):
+        for _ in range(100):
+            if condition():
+                return
+            await asyncio.sleep(0.01)
+        self.fail("timed out")
+
+    async def test_invite_and_send(self):
+        peer = await self.initiator.invite('127.0.0.1', self.port)
+        self.assertEqual(peer.name, "listener")
+        self.assertIsNotNone(peer.latency)
+        self.assertEqual(self.peers, [("initiator", True)])
+
+        messages = [mido.Message('start'), mido.Message('clock'), mido.Message('note_on', note=3)]
+        for message in messages:
+            self.initiator.send(message)
+        await self.wait_for(lambda: len(self.received) == 3)
+        self.assertEqual(self.received, messages)
+
+        self.initiator.close()
+        await self.wait_for(lambda: len(self.peers) == 2)
+        self.assertEqual(self.peers[1], ("initiator", False))
+
+    async def test_lost_packets_are_recovered_from_the_journal(self):
+        await self.initiator.invite('127.0.0.1', self.port)
+        sendto = self.initiator.data.sendto
+        dropped = []
+
+        def lossy(packet, address):
+            if packet[:2] != b'\xff\xff' and len(dropped) < 2 and len(self.received) == 1:
+                dropped.append(packet)
+            else:
+                sendto(packet, address)
+        self.initiator.data.sendto = lossy
+
+        for message in [mido.Message('start'), mido.Message('program_change', program=4), mido.Message('clock'),
+                        mido.Message('clock')]:
+            self.initiator.send(message)
+            await asyncio.sleep(0.01)
+        await self.wait_for(lambda: len(self.received) == 3)
+
+        self.assertEqual(len(dropped), 2)
+        self.assertEqual(self.received, [mido.Message('start'), mido.Message('program_change', program=4),
+                                         mido.Message('clock')])
+        peer = next(iter(self.listener.peers.values()))
+        self.assertEqual((peer.lost, peer.recovered, peer.received.clocks), (2, 1, 2))
+
+    async def test_rejects_invitations_when_not_accepting(self):
+        other = rtpmidi.RtpMidiSession("other", accept=False)
+        port = await other.listen('127.0.0.1', 0)
+        try:
+            with self.assertRaises(Exception):
+                await self.initiator.invite('127.0.0.1', port)
+        finally:
+            other.close()
+
+
+class FakeDevice:
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, message):
+        self.sent.append(message)
+
+
+@unittest.skipIf(mido is None, "mido is not installed")
+class TestProxyOverRtpMidi(unittest.IsolatedAsyncioTestCase):
+
+    async def test_realtime_over_rtp_and_sysex_over_tcp(self):
+        device = FakeDevice()
+        proxy = server.ProxyServer(device)
+        tcp_server = await proxy.start('127.0.0.1', 0)
+        port = await proxy.start_rtp('127.0.0.1', 0)
+        loop = asyncio.get_event_loop()
+        connection = await loop.run_in_executor(None, lambda: wire.Connection(
+            '127.0.0.1', tcp_server.sockets[0].getsockname()[1]))
+        address = connection.socket.getsockname()
+        received = []
+        session = await loop.run_in_executor(None, lambda: rtpmidi.SessionThread(
+            '127.0.0.1', port, address[0] + ":" + str(address[1]), received.append))
+        try:
+            client = next(iter(proxy.clients))
+            self.assertTrue(client.sysex_only)
+
+            session.send(mido.Message('clock'))
+            for _ in range(100):
+                if device.sent:
+                    break
+                await asyncio.sleep(0.01)
+            self.assertEqual(device.sent, [mido.Message('clock')])
+
+            line = Bank("RTP").to_sysex()[2]
+            proxy.fan_out(mido.Message('start'))
+            proxy.fan_out(mido.Message.from_bytes(line))
+            messages = iter(connection)
+            self.assertEqual((await loop.run_in_executor(None, next, messages)).bin(), bytearray(line))
+            for _ in range(100):
+                if received:
+                    break
+                await asyncio.sleep(0.01)
+            self.assertEqual(received, [mido.Message('start')])
+        finally:
+            await loop.run_in_executor(None, session.close)
+            await loop.run_in_executor(None, connection.close)
+            proxy.device_writer.cancel()
+            proxy.rtp.close()
+            tcp_server.close()
+            await tcp_server.wait_closed()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,9 @@
 import os
 import unittest
 
-from morningstar import sysex_converter
+from morningstar import sysex_converter, sysex_file
+from morningstar.model import Bank
+from morningstar.utils import format_data
 
 
 class TestSysexConverter(unittest.TestCase):
@@ -19,6 +21,30 @@ class TestSysexConverter(unittest.TestCase):
                 print("Generated: " + actual[i])
                 self.assertEqual(actual[i], line.rstrip())
 
+    def test_multiple_banks_in_stream(self):
+        banks = [Bank("FIRST"), Bank("SECOND"), Bank("THIRD")]
+        banks[1].presets[2].name = "SWITCH"
+        banks[2].expression_presets[1].name = "WAH"
+        text = "\n".join([format_data(bank.to_sysex()) for bank in banks])
+
+        parsed = list(sysex_converter.iter_banks(sysex_file.iter_frames(text.splitlines())))
+
+        self.assertEqual([bank.name.strip() for bank in parsed], ["FIRST", "SECOND", "THIRD"])
+        self.assertEqual(parsed[1].presets[2].name, "SWITCH  ")
+        self.assertEqual(parsed[2].expression_presets[1].name, "WAH     ")
+
+    def test_resync_after_corrupt_frame(self):
+        lines = [Bank("FIRST").to_sysex(), Bank("SECOND").to_sysex(), Bank("THIRD").to_sysex()]
+        lines[1][5][20] ^= 0x01
+        frames = [bytes(line) for bank_lines in lines for line in bank_lines]
+        errors = []
+
+        parsed = list(sysex_converter.iter_banks(frames, errors.append))
+
+        self.assertEqual([bank.name.strip() for bank in parsed], ["FIRST", "THIRD"])
+        self.assertEqual(len(errors), 1)
+        self.assertIn("Bad checksum", errors[0])
+
 
 if __name__ == "__main__":
     unittest.main()
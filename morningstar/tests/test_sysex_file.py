@@ -0,0 +1,42 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from morningstar import sysex_file
+from morningstar.model import Bank
+
+
+class TestSysexFile(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.data = Bank("FILE").to_sysex_bytes()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_and_read(self, filename):
+        path = os.path.join(self.directory, filename)
+        file_format = sysex_file.format_for_filename(path)
+        with sysex_file.open_output(path, file_format) as output_file:
+            sysex_file.write_sysex(output_file, self.data, file_format)
+        return b''.join([bytes(frame) for frame in sysex_file.read_frames(path)])
+
+    def test_round_trip(self):
+        for filename in ["bank.syx", "bank.mid", "bank.txt"]:
+            self.assertEqual(self.write_and_read(filename), self.data, filename)
+
+    def test_binary_syx_is_raw_frames(self):
+        self.write_and_read("bank.syx")
+        with open(os.path.join(self.directory, "bank.syx"), 'rb') as input_file:
+            self.assertEqual(input_file.read(), self.data)
+
+    def test_hex_text_with_syx_extension(self):
+        frames = list(sysex_file.read_frames(os.path.dirname(__file__) + '/debug.syx'))
+        self.assertEqual(len(frames), 18)
+        self.assertEqual(frames[0][-2], 0x75)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import os
+import unittest
+
+from morningstar import sysex_converter, sysex_file
+from morningstar.model import Bank, Action, Message, BANK_LINE_SPANS
+from morningstar.view import BankView, iter_bank_views
+
+
+class TestView(unittest.TestCase):
+
+    def setUp(self):
+        self.bank = Bank("VIEWED")
+        preset = self.bank.presets[2]
+        preset.name = "THREE"
+        preset.toggle_name = "3"
+        preset.long_name = "PRESET THREE"
+        preset.toggle_mode = True
+        preset.actions.append(Action("press", [Message("control_change", 1, 2, channel=3)]))
+        self.bank.expression_presets[1].messages.append(Message("expression_cc", 7, 0, 127, channel=2))
+        self.data = self.bank.to_sysex_bytes()
+
+    def test_fields_match_the_model(self):
+        view = BankView.from_bytes(self.data)
+        self.assertEqual(view.name.strip(), "VIEWED")
+        preset = view.preset(2)
+        self.assertEqual((preset.name, preset.toggle_name), ("THREE   ", "3       "))
+        self.assertEqual(preset.long_name.strip(), "PRESET THREE")
+        self.assertEqual((preset.toggle_mode, preset.blink_mode, preset.letter()), (True, False, "C"))
+        self.assertEqual(preset.slots(), [0])
+        self.assertEqual(preset.action(0).to_dict(), self.bank.presets[2].actions[0].to_dict())
+        expression = view.expression_preset(1)
+        self.assertTrue(expression.is_expression)
+        self.assertEqual(expression.message(0).to_dict(), self.bank.expression_presets[1].messages[0].to_dict())
+        self.assertEqual(view.to_bank().to_sysex_bytes(), self.data)
+        self.assertEqual(preset.to_preset().to_dict(), Bank("VIEWED").presets[2].from_sysex(preset.data).to_dict())
+
+    def test_views_do_not_copy(self):
+        view = BankView.from_bytes(self.data)
+        self.assertIs(view.preset(2).data.obj, self.data)
+        self.assertIs(view.lines[0].obj, self.data)
+
+    def test_verify(self):
+        self.assertIsNone(BankView.from_bytes(self.data).verify())
+        corrupt = bytearray(self.data)
+        corrupt[BANK_LINE_SPANS[4][0] + 20] ^= 1
+        self.assertEqual(BankView.from_bytes(corrupt).verify(), "Bad checksum in line 5")
+
+    def test_iter_bank_views(self):
+        frames = list(sysex_file.iter_binary_frames(self.data * 2))
+        errors = []
+        views = list(iter_bank_views(frames[:5] + frames, errors.append))
+        self.assertEqual(len(views), 2)
+        self.assertEqual(len(errors), 1)
+        self.assertEqual([view.name.strip() for view in views], ["VIEWED", "VIEWED"])
+
+    def test_list_banks(self):
+        listing = sysex_converter.list_banks(os.path.dirname(__file__) + '/debug.syx').splitlines()
+        self.assertEqual(listing[0], "001 BANKNAMECANBEREALLYLOONG")
+        self.assertEqual(listing[1], "    A PRESET01 TOGGLE01 LONGNAMEFORPRESET0000001")
+        self.assertEqual(len(listing), 13)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+import os
+import tempfile
+import time
+import unittest
+
+from morningstar.delta import DeviceState
+from morningstar.midi import DeviceSession
+from morningstar.model import Bank
+from morningstar.sysex_converter import bank_to_yaml
+from morningstar.watch import BankFile, InotifyWatcher, PollingWatcher, Watch
+
+try:
+    import mido
+    from morningstar.emulator import Emulator
+except ImportError:
+    mido = None
+
+
+class TestWatch(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'bank.yml')
+        self.bank = Bank("WATCHED")
+        self.bank.presets[0].name = "ONE"
+        self.save()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def save(self, path=None):
+        with open(path or self.path, 'w') as bank_file:
+            bank_file.write(bank_to_yaml(self.bank))
+
+    def test_only_changed_presets_are_rebuilt(self):
+        bank_file = BankFile(self.path)
+        self.assertEqual(bank_file.update(), ["bank"])
+        self.assertEqual(len(bank_file.frames()), 18)
+        bank_file.pushed = bank_file.bank.to_sysex_bytes()
+        first_preset = bank_file.bank.presets[0]
+
+        self.bank.presets[2].name = "THREE"
+        self.save()
+        self.assertEqual(bank_file.update(), ["C"])
+        self.assertIs(bank_file.bank.presets[0], first_preset)
+        self.assertEqual(bank_file.bank.to_sysex_bytes(), self.bank.to_sysex_bytes())
+        # both headers, preset C's line and the trailer
+        self.assertEqual(len(bank_file.frames()), 4)
+
+        self.bank.name = "RENAMED"
+        self.save()
+        self.assertEqual(bank_file.update(), ["name"])
+        self.assertEqual(bank_file.bank.to_sysex_bytes(), self.bank.to_sysex_bytes())
+
+    @unittest.skipIf(mido is None, "mido is not installed")
+    def test_changes_are_pushed_to_the_device(self):
+        device = Emulator()
+        with DeviceSession(device, ack_timeout=0.05) as session:
+            watch = Watch(self.directory.name, session, state=DeviceState('test', self.directory.name))
+            # every push is followed by a Dump Bank request to confirm it
+            self.assertIsNotNone(watch.changed(self.path))
+            self.assertEqual(device.frames_received, 18 + 1)
+
+            self.bank.presets[5].name = "SIX"
+            self.save()
+            self.assertIsNotNone(watch.changed(self.path))
+            self.assertEqual(device.frames_received, 23 + 1)
+            self.assertEqual(device.banks[0], self.bank.to_sysex_bytes())
+            # saving without changing anything sends nothing
+            self.assertIsNone(watch.changed(self.path))
+            self.assertEqual(device.frames_received, 23 + 1)
+        self.assertEqual(len(watch.latencies), 2)
+
+        # a new watch carries on from the state the last one pushed
+        watch = Watch(self.directory.name, None, state=DeviceState('test', self.directory.name))
+        self.assertEqual(watch.current, "bank")
+        self.assertEqual(watch.files[self.path].frames(), [])
+
+    @unittest.skipIf(mido is None, "mido is not installed")
+    def test_switching_files_pushes_the_whole_bank(self):
+        other_path = os.path.join(self.directory.name, 'other.yml')
+        other = Bank("OTHER")
+        with open(other_path, 'w') as bank_file:
+            bank_file.write(bank_to_yaml(other))
+        device = Emulator()
+        with DeviceSession(device, ack_timeout=0.05) as session:
+            watch = Watch(self.directory.name, session, state=DeviceState('test', self.directory.name))
+            watch.changed(self.path)
+            watch.changed(other_path)
+            self.assertEqual(device.banks[0], other.to_sysex_bytes())
+
+            # the device's current bank holds the other file, so none of this one can be left as it is
+            self.bank.presets[2].name = "THREE"
+            self.save()
+            received = device.frames_received
+            self.assertIsNotNone(watch.changed(self.path))
+            self.assertEqual(device.frames_received - received, 18 + 1)
+            self.assertEqual(device.banks[0], self.bank.to_sysex_bytes())
+            self.assertEqual(device.uploads_rejected, 0)
+
+            # a push the device rejects is followed by the whole bank
+            device.banks[0] = other.to_sysex_bytes()
+            self.bank.presets[3].name = "FOUR"
+            self.save()
+            self.assertIsNotNone(watch.changed(self.path))
+            self.assertEqual(device.uploads_rejected, 1)
+            self.assertEqual(device.banks[0], self.bank.to_sysex_bytes())
+            self.assertEqual(watch.current, "bank")
+
+    def test_polling_watcher(self):
+        watcher = PollingWatcher(self.directory.name, interval=0.001)
+        self.assertEqual(watcher.wait(0), [])
+        os.utime(self.path, ns=(0, 0))
+        self.assertEqual(watcher.wait(0.5), [self.path])
+
+    def test_inotify_watcher(self):
+        try:
+            watcher = InotifyWatcher(self.directory.name)
+        except (OSError, AttributeError):
+            self.skipTest("inotify is not available")
+        try:
+            self.assertEqual(watcher.wait(0), [])
+            started = time.monotonic()
+            self.save()
+            self.assertEqual(watcher.wait(0.5), [self.path])
+            self.assertLess(time.monotonic() - started, 0.5)
+        finally:
+            watcher.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,19 @@
 import os
+import shutil
+import tempfile
 import unittest
 
 import morningstar.model
 import morningstar.utils
 from morningstar import yaml_converter
+from morningstar.delta import DeviceState
+from morningstar.midi import DeviceSession
+
+try:
+    import mido
+    from morningstar.emulator import Emulator
+except ImportError:
+    mido = None
 
 
 class TestYamlConverter(unittest.TestCase):
@@ -310,6 +320,79 @@ class TestYamlConverter(unittest.TestCase):
             print("Generated: " + actual[i][:-1])
             self.assertEqual(actual[i], line)
 
+    def test_process_directory_in_parallel(self):
+        output_directory = tempfile.mkdtemp()
+        try:
+            args = {"send": False, "bank": None, "format": "syx", "quiet": True, "jobs": 2, "no_cache": True}
+            self.assertTrue(yaml_converter.process_directory(os.path.dirname(__file__) + '/../../yaml',
+                                                             output_directory, args))
+            self.assertEqual(sorted(os.listdir(output_directory)), ["blank.syx", "debug.syx", "example.syx"])
+            with open(os.path.join(output_directory, "debug.syx"), 'rb') as output_file:
+                with open(os.path.dirname(__file__) + '/debug.syx', 'r') as expectation_file:
+                    self.assertEqual(output_file.read(), bytes(morningstar.utils.parse_bytes(
+                        " ".join(expectation_file.read().split()))))
+        finally:
+            shutil.rmtree(output_directory)
+
+    def test_process_directory_skips_unchanged_files(self):
+        input_directory = tempfile.mkdtemp()
+        output_directory = tempfile.mkdtemp()
+        try:
+            shutil.copy(os.path.dirname(__file__) + '/../../yaml/debug.yml', input_directory)
+            shutil.copy(os.path.dirname(__file__) + '/../../yaml/blank.yml', input_directory)
+            args = {"send": False, "bank": None, "format": None, "quiet": True}
+            self.assertTrue(yaml_converter.process_directory(input_directory, output_directory, args))
+            output_filename = os.path.join(output_directory, "blank.syx")
+            built = os.stat(output_filename).st_mtime_ns
+
+            with open(os.path.join(input_directory, "debug.yml"), 'a') as input_file:
+                input_file.write("\n# changed\n")
+            cache = yaml_converter.BuildCache(os.path.join(output_directory, yaml_converter.DEFAULT_CACHE_DIRECTORY))
+            self.assertIsNone(cache.reason_to_build(os.path.join(input_directory, "blank.yml"), output_filename, "syx"))
+            self.assertEqual(cache.reason_to_build(os.path.join(input_directory, "debug.yml"),
+                                                   os.path.join(output_directory, "debug.syx"), "syx"), "input changed")
+
+            self.assertTrue(yaml_converter.process_directory(input_directory, output_directory, args))
+            self.assertEqual(os.stat(output_filename).st_mtime_ns, built)
+        finally:
+            shutil.rmtree(input_directory)
+            shutil.rmtree(output_directory)
+
+    @unittest.skipIf(mido is None, "mido is not installed")
+    def test_delta_uploads_follow_the_current_bank(self):
+        state_directory = tempfile.mkdtemp()
+        try:
+            state = DeviceState('test', state_directory)
+            first, second = morningstar.model.Bank("FIRST"), morningstar.model.Bank("SECOND")
+            device = Emulator()
+            with DeviceSession(device, ack_timeout=0.05) as session:
+                self.assertTrue(yaml_converter.send_delta(first.to_sysex(), "first", session=session, state=state))
+                self.assertTrue(yaml_converter.send_delta(second.to_sysex(), "second", session=session, state=state))
+                self.assertEqual(state.current(), "second")
+
+                # the device's current bank holds the second bank, so none of the first can be left as it is
+                first.presets[0].name = "EDITED"
+                received = device.frames_received
+                self.assertTrue(yaml_converter.send_delta(first.to_sysex(), "first", session=session, state=state))
+                self.assertEqual(device.frames_received - received, 18 + 1)
+                self.assertEqual(device.banks[0], first.to_sysex_bytes())
+
+                # an upload which the device rejects is followed by the whole bank
+                device.banks[0] = morningstar.model.Bank("CHANGED").to_sysex_bytes()
+                first.presets[1].name = "AGAIN"
+                self.assertTrue(yaml_converter.send_delta(first.to_sysex(), "first", session=session, state=state))
+                self.assertEqual(device.uploads_rejected, 1)
+                self.assertEqual(device.banks[0], first.to_sysex_bytes())
+                self.assertEqual(state.previous("first"), first.to_sysex_bytes())
+
+            # nothing is recorded if the device never confirms the upload
+            with DeviceSession(Emulator(drop_rate=1.0), ack_timeout=0.01) as session:
+                self.assertFalse(yaml_converter.send_delta(second.to_sysex(), "second", session=session, state=state))
+            self.assertIsNone(state.current())
+            self.assertIsNone(state.previous("first"))
+        finally:
+            shutil.rmtree(state_directory)
+
 
 if __name__ == "__main__":
     unittest.main()
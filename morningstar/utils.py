@@ -1,4 +1,7 @@
-from typing import List
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from typing import List, Callable, Sequence
 
 SYSEX_DEVICE_VERSION = 0x03
 SYSEX_DEVICE_ID = 0x03
@@ -13,7 +16,15 @@ STANDARD_HEADER = (SYSEX_START_PACKET,
                    SYSEX_DEVICE_ID,
                    SYSEX_DEVICE_VERSION)
 
-from morningstar.checksum import add_checksum_footer
+# commands sent to the device (rather than bank data) use 0 for the device id and version
+COMMAND_HEADER = STANDARD_HEADER[:4] + (0x00, 0x00)
+COMMAND_LENGTH = 8
+
+SYSEX_HEADER_LENGTH = len(STANDARD_HEADER)
+SYSEX_FOOTER_LENGTH = 2
+SYSEX_HEADER_BYTES = bytes(STANDARD_HEADER)
+
+from morningstar.checksum import add_checksum_footer, write_checksum_footer
 
 
 def format_data_line(data: List[int]) -> str:
@@ -28,6 +39,32 @@ def sysex_line(data: List[int]) -> List[int]:
     return add_checksum_footer(list(STANDARD_HEADER) + data)
 
 
+def sysex_command(data: List[int]) -> bytes:
+    """
+    Builds a complete command frame, padding the function bytes and arguments to COMMAND_LENGTH
+    """
+    return bytes(add_checksum_footer(list(COMMAND_HEADER) + data + [0] * (COMMAND_LENGTH - len(data))))
+
+
+def sysex_line_length(data_length: int) -> int:
+    return SYSEX_HEADER_LENGTH + data_length + SYSEX_FOOTER_LENGTH
+
+
+def finish_sysex_line(buffer: bytearray, offset: int, data_length: int) -> int:
+    """
+    Completes a sysex line whose data has already been written at offset + SYSEX_HEADER_LENGTH by filling in the
+    standard header and the checksum footer in place. Returns the offset of the next line.
+    """
+    data_end = offset + SYSEX_HEADER_LENGTH + data_length
+    buffer[offset:offset + SYSEX_HEADER_LENGTH] = SYSEX_HEADER_BYTES
+    write_checksum_footer(buffer, offset, data_end)
+    return data_end + SYSEX_FOOTER_LENGTH
+
+
+def write_sysex_text(buffer: bytearray, offset: int, text: str, field_length: int):
+    buffer[offset:offset + field_length] = (text or '')[:field_length].ljust(field_length).encode('latin-1')
+
+
 def sysex_text(text: str, field_length: int) -> List[int]:
     data = []
     for i in range(0, field_length):
@@ -44,4 +81,39 @@ def parse_string(data_bytes: List[int]) -> str:
 
 def parse_bytes(text: str) -> List[int]:
     data = text.split(" ")
-    return [int(b, 16) for b in data]
\ No newline at end of file
+    return [int(b, 16) for b in data]
+
+
+@contextmanager
+def atomic_write(filename: str, mode: str = 'w'):
+    """
+    Writes to a temporary file alongside filename which only replaces it once the write has completed, so readers
+    never see a partially written file
+    """
+    temp_filename = filename + '.' + str(os.getpid()) + '.tmp'
+    try:
+        with open(temp_filename, mode) as output_file:
+            yield output_file
+        os.replace(temp_filename, filename)
+    finally:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+
+
+def run_jobs(function: Callable, tasks: Sequence[tuple], jobs: int = 1) -> List:
+    """
+    Calls function(*task) for every task, using a pool of worker processes when jobs > 1. Returns the result, or the
+    exception raised, for each task in the same order as tasks.
+    """
+    if jobs <= 1 or len(tasks) <= 1:
+        results = []
+        for task in tasks:
+            try:
+                results.append(function(*task))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(function, *task) for task in tasks]
+        return [future.exception() or future.result() for future in futures]
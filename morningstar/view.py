@@ -0,0 +1,197 @@
+from typing import Callable, Iterable, Iterator, List, Optional, Sequence
+
+from morningstar.checksum import checksum
+from morningstar.delta import batch_checksum, line_number, NAME_LINE, PRESET_LINES, TRAILER_LINE
+from morningstar.model import Action, Bank, ExpressionPreset, Preset, Message, BANK_LINE_LENGTHS, BANK_LINE_SPANS, \
+    BANK_NAME_OFFSET, BANK_SETTINGS_DATA_LENGTH, LINE_PRESET, LINE_EXPRESSION_PRESET, MESSAGE_LENGTH, MAX_MESSAGES, \
+    NUM_BANK_LINES, PRESET_MESSAGES_OFFSET, PRESET_BIT_FIELD_OFFSET, PRESET_NAME_OFFSET, PRESET_TOGGLE_NAME_OFFSET, \
+    PRESET_LONG_NAME_OFFSET, PRESET_DATA_LENGTH, PRESET_TOGGLE_MODE_BIT, PRESET_BLINK_MODE_BIT
+from morningstar.codec import codec_for_id, EXPRESSION_CODECS_BY_ID
+from morningstar.utils import SYSEX_HEADER_LENGTH, SYSEX_FOOTER_LENGTH
+
+"""
+Read only views over encoded banks, which decode a field only when it is asked for. A view holds memoryviews of the
+lines it was given (eg the frames read_frames maps from a file) rather than copies, so listing or searching many banks
+only touches the bytes of the fields used. Fields are found with the same offsets the model encodes with.
+"""
+
+
+def parse_text(data) -> str:
+    # the same as parse_string, but decoded straight from the buffer
+    return str(data, 'latin-1')
+
+
+class PresetView:
+    """
+    A preset or expression preset line
+    """
+
+    def __init__(self, line):
+        self.line = memoryview(line)
+        self.data = self.line[SYSEX_HEADER_LENGTH:-SYSEX_FOOTER_LENGTH]
+
+    @property
+    def is_expression(self) -> bool:
+        return tuple(self.data[0:2]) == LINE_EXPRESSION_PRESET
+
+    @property
+    def id(self) -> int:
+        return self.data[3]
+
+    @property
+    def name(self) -> str:
+        return parse_text(self.data[PRESET_NAME_OFFSET:PRESET_TOGGLE_NAME_OFFSET])
+
+    @property
+    def toggle_name(self) -> str:
+        return parse_text(self.data[PRESET_TOGGLE_NAME_OFFSET:PRESET_LONG_NAME_OFFSET])
+
+    @property
+    def long_name(self) -> str:
+        return parse_text(self.data[PRESET_LONG_NAME_OFFSET:PRESET_DATA_LENGTH])
+
+    @property
+    def toggle_mode(self) -> bool:
+        return bool(self.data[PRESET_BIT_FIELD_OFFSET] & PRESET_TOGGLE_MODE_BIT)
+
+    @property
+    def blink_mode(self) -> bool:
+        return bool(self.data[PRESET_BIT_FIELD_OFFSET] & PRESET_BLINK_MODE_BIT)
+
+    def letter(self) -> str:
+        return chr(self.id + ord('A'))
+
+    def slot(self, index: int):
+        """
+        The raw bytes of one of the MAX_MESSAGES message slots
+        """
+        if not 0 <= index < MAX_MESSAGES:
+            raise IndexError("Message slot out of range: " + str(index))
+        offset = PRESET_MESSAGES_OFFSET + index * MESSAGE_LENGTH
+        return self.data[offset:offset + MESSAGE_LENGTH]
+
+    def slots(self) -> List[int]:
+        """
+        The indexes of the message slots in use
+        """
+        return [i for i in range(MAX_MESSAGES) if any(self.slot(i))]
+
+    def action(self, index: int) -> Action:
+        """
+        Decodes the action in a preset's message slot
+        """
+        return Action().from_sysex(self.slot(index))
+
+    def message(self, index: int) -> Message:
+        """
+        Decodes the message in an expression preset's message slot
+        """
+        data = self.slot(index)
+        codec = codec_for_id(data[0], EXPRESSION_CODECS_BY_ID)
+        return Message(codec.message_type, data[1], data[2], data[3], data[5] + 1)
+
+    def to_preset(self):
+        """
+        Decodes the whole line into a Preset or ExpressionPreset
+        """
+        preset = ExpressionPreset(self.id) if self.is_expression else Preset(self.id)
+        return preset.from_sysex(self.data)
+
+
+class BankView:
+    """
+    The NUM_BANK_LINES lines of a bank, in order. Lines are not checked until verify() is called.
+    """
+
+    def __init__(self, lines: Sequence):
+        if len(lines) != NUM_BANK_LINES:
+            raise Exception("A bank has " + str(NUM_BANK_LINES) + " lines, got " + str(len(lines)))
+        self.lines = [memoryview(line) for line in lines]
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        A view of a bank encoded back to back, as from Bank.to_sysex_bytes
+        """
+        view = memoryview(data)
+        return cls([view[start:end] for start, end in BANK_LINE_SPANS])
+
+    @property
+    def name(self) -> str:
+        data = self.lines[NAME_LINE][SYSEX_HEADER_LENGTH:]
+        return parse_text(data[BANK_NAME_OFFSET:BANK_SETTINGS_DATA_LENGTH])
+
+    def preset(self, index: int) -> PresetView:
+        first, count = PRESET_LINES[LINE_PRESET]
+        if not 0 <= index < count:
+            raise IndexError("Preset out of range: " + str(index))
+        return PresetView(self.lines[first + index])
+
+    def expression_preset(self, index: int) -> PresetView:
+        first, count = PRESET_LINES[LINE_EXPRESSION_PRESET]
+        if not 0 <= index < count:
+            raise IndexError("Expression preset out of range: " + str(index))
+        return PresetView(self.lines[first + index])
+
+    @property
+    def presets(self) -> List[PresetView]:
+        first, count = PRESET_LINES[LINE_PRESET]
+        return [PresetView(line) for line in self.lines[first:first + count]]
+
+    @property
+    def expression_presets(self) -> List[PresetView]:
+        first, count = PRESET_LINES[LINE_EXPRESSION_PRESET]
+        return [PresetView(line) for line in self.lines[first:first + count]]
+
+    def verify(self) -> Optional[str]:
+        """
+        Checks the checksum of every line and the batch checksum, returning what is wrong if anything
+        """
+        for number, line in enumerate(self.lines):
+            if checksum(line[:-SYSEX_FOOTER_LENGTH]) != line[-SYSEX_FOOTER_LENGTH]:
+                return "Bad checksum in line " + str(number + 1)
+        if self.lines[TRAILER_LINE][SYSEX_HEADER_LENGTH + 2] != batch_checksum(self.lines):
+            return "Bad batch checksum"
+        return None
+
+    def to_bank(self) -> Bank:
+        """
+        Decodes every line into a Bank
+        """
+        bank = Bank(self.name)
+        for i, preset in enumerate(self.presets):
+            bank.presets[i].from_sysex(preset.data)
+        for i, preset in enumerate(self.expression_presets):
+            bank.expression_presets[i].from_sysex(preset.data)
+        return bank
+
+
+def iter_bank_views(frames: Iterable, on_error: Callable[[str], None] = print) -> Iterator[BankView]:
+    """
+    Groups a stream of frames (eg a "Dump All" capture) into a view of each bank. Frames are only checked to be the
+    expected line of the expected length, so a bank with lines missing or out of order is skipped but checksums are
+    left to BankView.verify().
+    """
+    lines = None
+    for frame_number, frame in enumerate(frames):
+        line = line_number(frame)
+        if line == 0:
+            if lines:
+                on_error("Bank has only " + str(len(lines)) + " lines (frame " + str(frame_number) + "), skipping")
+            lines = []
+        elif lines is None:
+            continue
+        elif line != len(lines):
+            on_error("Expected line " + str(len(lines) + 1) + " of a bank (frame " + str(frame_number) +
+                     "), skipping bank")
+            lines = None
+            continue
+        if len(frame) != BANK_LINE_LENGTHS[line]:
+            on_error("Line " + str(line + 1) + " is " + str(len(frame)) + " bytes, expected " +
+                     str(BANK_LINE_LENGTHS[line]) + " (frame " + str(frame_number) + "), skipping bank")
+            lines = None
+            continue
+        lines.append(frame)
+        if len(lines) == NUM_BANK_LINES:
+            yield BankView(lines)
+            lines = None
@@ -0,0 +1,282 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+from typing import List, Optional
+
+import yaml
+
+import morningstar.midi
+from morningstar.delta import DeviceState, delta_frames
+from morningstar.midi import DeviceSession
+from morningstar.model import Preset, ExpressionPreset, NUM_PRESETS, NUM_EXPR_PRESETS, NUM_BANK_LINES
+from morningstar.yaml_converter import YamlLoader, convert_to_bank, configure_preset, configure_expression_preset, \
+    state_key
+
+"""
+Watches a directory of YAML banks and pushes each edit to the device as soon as the file is saved. Only the presets
+whose config changed are rebuilt and re-encoded, and only their lines (with the bank's headers and trailer) are sent,
+over a session which stays open for as long as the watch runs.
+"""
+
+DEFAULT_POLL_INTERVAL = 0.02
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+INOTIFY_EVENT = struct.Struct('iIII')
+READ_SIZE = 65536
+
+
+def is_bank_file(filename: str) -> bool:
+    # editors write swap and backup files such as .bank.yml.swp alongside the file being edited
+    name = os.path.basename(filename)
+    return name.endswith('.yml') and not name.startswith('.')
+
+
+class InotifyWatcher:
+    """
+    Reports files in a directory which have been written and closed, or moved into it (as editors which save to a
+    temporary file do). Only available on Linux.
+    """
+
+    def __init__(self, directory: str):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.directory = directory
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "Couldn't start inotify")
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), "Couldn't watch " + directory)
+
+    def wait(self, timeout: Optional[float] = None) -> List[str]:
+        """
+        Waits for files to change, returning their paths, or nothing if the timeout passes first
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        data = os.read(self.fd, READ_SIZE)
+        paths = []
+        offset = 0
+        while offset < len(data):
+            _, _, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if name:
+                paths.append(os.path.join(self.directory, os.fsdecode(name)))
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """
+    Reports files in a directory whose modification time or size has changed, checking every interval seconds
+    """
+
+    def __init__(self, directory: str, interval: float = DEFAULT_POLL_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self.files = self.scan()
+
+    def scan(self) -> dict:
+        files = {}
+        for entry in os.scandir(self.directory):
+            try:
+                status = entry.stat()
+            except OSError:
+                continue
+            files[entry.path] = (status.st_mtime_ns, status.st_size)
+        return files
+
+    def wait(self, timeout: Optional[float] = None) -> List[str]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            files = self.scan()
+            changed = [path for path, status in files.items() if self.files.get(path) != status]
+            self.files = files
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+            time.sleep(self.interval)
+
+    def close(self):
+        pass
+
+
+def open_watcher(directory: str, poll=False, interval: float = DEFAULT_POLL_INTERVAL):
+    """
+    Watches with inotify where it is available, otherwise by polling
+    """
+    if not poll:
+        try:
+            return InotifyWatcher(directory)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(directory, interval)
+
+
+class BankFile:
+    """
+    A watched YAML bank, the model built from it and the encoding last pushed to the device
+    """
+
+    def __init__(self, path: str, pushed: Optional[bytes] = None):
+        self.path = path
+        self.config = None
+        self.bank = None
+        self.pushed = pushed
+
+    def update(self) -> List[str]:
+        """
+        Re-reads the file, replacing only the presets whose config has changed. Returns what changed: "name", preset
+        letters and expression preset names, or just "bank" the first time.
+        """
+        with open(self.path, 'r') as bank_file:
+            config = yaml.load(bank_file, Loader=YamlLoader)["bank"]
+        if self.bank is None:
+            self.bank = convert_to_bank(config)
+            self.config = config
+            return ["bank"]
+
+        changed = []
+        if config.get("name") != self.config.get("name"):
+            self.bank.name = config.get("name")
+            changed.append("name")
+        presets_config = config.get("presets") or {}
+        previous_config = self.config.get("presets") or {}
+        for i in range(0, NUM_PRESETS):
+            preset_letter = chr(i + 65)
+            if presets_config.get(preset_letter) != previous_config.get(preset_letter):
+                preset = Preset(i)
+                if preset_letter in presets_config:
+                    configure_preset(preset, presets_config.get(preset_letter))
+                self.bank.presets[i] = preset
+                changed.append(preset_letter)
+        for i in range(0, NUM_EXPR_PRESETS):
+            expression_name = 'expression' + str(i + 1)
+            if presets_config.get(expression_name) != previous_config.get(expression_name):
+                preset = ExpressionPreset(i)
+                if expression_name in presets_config:
+                    configure_expression_preset(preset, presets_config.get(expression_name))
+                self.bank.expression_presets[i] = preset
+                changed.append(expression_name)
+        self.config = config
+        return changed
+
+    def frames(self, current=True) -> List[bytes]:
+        """
+        The lines to send to bring the device from what was last pushed to the file as it is now, or the whole bank if
+        something else has been pushed to the device's current bank since
+        """
+        return delta_frames(self.pushed if current else None, self.bank.to_sysex_bytes())
+
+
+class Watch:
+    """
+    Pushes each saved change to any bank file in a directory (or just one file) over the session, if there is one,
+    keeping each bank's model between edits. Every push goes to the device's current bank, so as with --delta only
+    the lines which changed are sent if the same file was pushed last, otherwise the whole bank, and a push is only
+    recorded once a dump of the bank confirms it. Records the time from each save to the device having the bank.
+    """
+
+    def __init__(self, directory: str, session: Optional[DeviceSession] = None, only: Optional[str] = None,
+                 state: Optional[DeviceState] = None):
+        self.directory = directory
+        self.session = session
+        self.only = only
+        self.state = state or DeviceState(morningstar.midi.device_name)
+        # the key of the file last pushed to the device's current bank
+        self.current = self.state.current()
+        self.files = {}
+        self.latencies = []
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if self.watched(path):
+                self.load(path)
+
+    def watched(self, path: str) -> bool:
+        return is_bank_file(path) and (self.only is None or os.path.basename(path) == os.path.basename(self.only))
+
+    def load(self, path: str) -> BankFile:
+        bank_file = BankFile(path, self.state.load(state_key(path, {})))
+        try:
+            bank_file.update()
+        except Exception as e:
+            print("Failed to read " + path + ": " + str(e))
+            bank_file.bank = None
+        self.files[path] = bank_file
+        return bank_file
+
+    def changed(self, path: str) -> Optional[float]:
+        """
+        Pushes whatever changed in a file, returning the seconds from it being saved to the device having it, or
+        None if nothing needed sending
+        """
+        if not self.watched(path) or not os.path.exists(path):
+            return None
+        saved = os.stat(path).st_mtime
+        bank_file = self.files.get(path) or self.load(path)
+        key = state_key(path, {})
+        started = time.monotonic()
+        try:
+            changed = bank_file.update()
+            frames = bank_file.frames(self.current == key)
+        except Exception as e:
+            print("Failed to convert " + path + ": " + str(e))
+            return None
+        if not frames:
+            return None
+        encoded = time.monotonic()
+        data = bank_file.bank.to_sysex_bytes()
+        if self.session is not None:
+            # until the push is confirmed the device's current bank is unknown
+            self.current = None
+            self.state.set_current(None)
+            if not morningstar.midi.send_bank_lines(frames, data, self.session):
+                print("The device didn't confirm the push of " + os.path.basename(path) + ", the next push will send "
+                      "the whole bank")
+                return None
+        sent = time.monotonic()
+        bank_file.pushed = data
+        self.current = key
+        if self.session is not None:
+            self.state.save(key, data)
+        latency = time.time() - saved
+        self.latencies.append(latency)
+        print("Pushed " + (", ".join(changed) or "bank") + " of " + os.path.basename(path) + " (" +
+              str(len(frames)) + " of " + str(NUM_BANK_LINES) + " lines) " + "{:.1f}".format(latency * 1000) +
+              "ms after saving (encoded in " + "{:.1f}".format((encoded - started) * 1000) +
+              "ms, sent and confirmed in " + "{:.1f}".format((sent - encoded) * 1000) + "ms)")
+        return latency
+
+    def run(self, watcher):
+        while True:
+            for path in sorted(set(watcher.wait())):
+                self.changed(path)
+
+    def summary(self) -> str:
+        if not self.latencies:
+            return "Nothing pushed"
+        latencies = sorted(self.latencies)
+        return "Pushed " + str(len(latencies)) + " changes, save to device median " + \
+            "{:.1f}".format(latencies[len(latencies) // 2] * 1000) + "ms, max " + \
+            "{:.1f}".format(latencies[-1] * 1000) + "ms"
+
+
+def main(path: str, send=True, poll=False, interval: float = DEFAULT_POLL_INTERVAL):
+    directory, only = (path, None) if os.path.isdir(path) else (os.path.dirname(path) or '.', path)
+    with morningstar.midi.open_session(send) as session:
+        watch = Watch(directory, session, only)
+        watcher = open_watcher(directory, poll, interval)
+        print("Watching " + path + (" by polling" if isinstance(watcher, PollingWatcher) else "") +
+              (", pushing changes to " + morningstar.midi.device_name if session else ""))
+        try:
+            watch.run(watcher)
+        except KeyboardInterrupt:
+            print(watch.summary())
+        finally:
+            watcher.close()
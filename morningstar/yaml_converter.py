@@ -6,125 +6,281 @@ from typing import List
 import yaml
 
 import morningstar.midi
-from morningstar.model import NUM_PRESETS, NUM_EXPR_PRESETS, ACTIONS, MESSAGE_TYPES, EXPRESSION_TYPES, \
-    Action, Message, Bank
-from morningstar.utils import format_data
-
-
-def parse_expression_message(message_type: str, default_channel: int, config) -> Message:
-    message = Message()
-    config_value = config[message_type]
-    if message_type == 'expression_cc':
-        message.data1 = config_value.get('cc_number') or 0
-        message.data2 = config_value.get('cc_min_value') or 0
-        message.data3 = config_value.get('cc_max_value') or 0
-    elif message_type in ['cc_toe_down', 'cc_heel_down']:
-        message.data1 = config_value.get('cc_number') or 0
-        message.data2 = config_value.get('cc_value') or 0
-    elif message_type == 'toe_down_toggle_channel':
-        message.data1 = (config_value.get('number') - 1) or 0
-        message.data2 = (config_value.get('channel1') - 1) or 0
-        message.data3 = (config_value.get('channel2') - 1) or 0
-    elif message_type == 'toe_down_toggle_cc':
-        message.data1 = (config_value.get('number') - 1) or 0
-        message.data2 = config_value.get('cc_number1') or 0
-        message.data3 = config_value.get('cc_number2') or 0
-    else:
-        message.data1 = config.get(message_type)
+from morningstar.build_cache import BuildCache
+from morningstar.delta import DeviceState, delta_frames
+from morningstar.codec import MESSAGE_CODECS, EXPRESSION_CODECS, message_codecs_in
+from morningstar.model import NUM_PRESETS, NUM_EXPR_PRESETS, NUM_BANK_LINES, ACTION_IDS, Action, Message, Bank, \
+    banks_to_sysex_bytes
+from morningstar.pack import PackReader, write_pack, is_pack_filename, DEFAULT_PACK_FILENAME, PACK_EXTENSION
+from morningstar.sysex_file import write_sysex, open_output, format_for_filename, extension_for_format, \
+    iter_binary_frames, FORMAT_HEX, FORMAT_SYX, FORMATS
+from morningstar.utils import atomic_write, format_data, run_jobs
 
-    if isinstance(config_value, dict) and config_value.get("channel"):
-        message.channel = config_value["channel"]
-    else:
-        message.channel = config.get("channel") or default_channel
-    message.message_type = message_type
-    return message
+DEFAULT_CACHE_DIRECTORY = '.morningstar-cache'
+
+# the libyaml based loader is many times faster, but is only available if PyYAML was built against libyaml
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
 
 
-def convert_to_bank(bank_config):  # noqa: C901
+def convert_to_bank(bank_config):
     bank = Bank(bank_config.get("name"))
     presets_config = bank_config.get("presets")
     if presets_config:
         for i in range(0, NUM_PRESETS):
             preset_letter = chr(i + 65)
             if preset_letter in presets_config:
-                preset_config = presets_config.get(preset_letter)
-                preset = bank.presets[i]
-                preset.name = preset_config.get("name")
-                preset.toggle_name = preset_config.get("toggle_name")
-                preset.long_name = preset_config.get("long_name")
-                if "toggle_mode" in preset_config:
-                    preset.toggle_mode = preset_config.get("toggle_mode")
-                if "blink_mode" in preset_config:
-                    preset.blink_mode = preset_config.get("blink_mode")
-                messages_config = preset_config.get("actions")
-                if messages_config:
-                    for action_config in messages_config:
-                        action_type = action_config.get("type")
-                        if not action_type:
-                            raise Exception("Action does not have a action type: " + str(action_config))
-                        if action_type not in ACTIONS:
-                            raise Exception("Unknown action type: " + action_type)
-
-                        action = Action()
-                        action.action_type = action_type
-                        preset.actions.append(action)
-
-                        for message_type in MESSAGE_TYPES:
-                            if message_type in action_config:
-                                message = Message().from_dict(message_type, action_config)
-                                action.messages.append(message)
-
-                        messages_config = action_config.get("messages")
-                        if messages_config:
-                            for message_config in messages_config:
-                                for message_type in MESSAGE_TYPES:
-                                    if message_type in message_config:
-                                        message = Message().from_dict(message_type,
-                                                                message_config)
-                                        if action_config.get("channel"):
-                                            message.channel = action_config.get("channel")
-                                        action.messages.append(message)
+                configure_preset(bank.presets[i], presets_config.get(preset_letter))
 
         for i in range(0, NUM_EXPR_PRESETS):
             expression_name = 'expression' + str(i + 1)
             if expression_name in presets_config:
-                preset_config = presets_config.get(expression_name)
-                preset = bank.expression_presets[i]
-                preset.name = preset_config.get("name")
-                preset.toggle_name = preset_config.get("toggle_name")
-                preset.long_name = preset_config.get("long_name")
-                messages_config = preset_config.get("messages")
-                if messages_config:
-                    for message_config in messages_config:
-                        for message_type in EXPRESSION_TYPES:
-                            if message_type in message_config:
-                                message = parse_expression_message(message_type, 1, message_config)
-                                preset.messages.append(message)
+                configure_expression_preset(bank.expression_presets[i], presets_config.get(expression_name))
     return bank
 
 
-def main(yaml_file, output_file=None, try_send=False, bank=None) -> List[List[int]]:
-    config = yaml.safe_load(yaml_file)
-    print(config)
+def configure_preset(preset, preset_config):
+    preset.name = preset_config.get("name")
+    preset.toggle_name = preset_config.get("toggle_name")
+    preset.long_name = preset_config.get("long_name")
+    if "toggle_mode" in preset_config:
+        preset.toggle_mode = preset_config.get("toggle_mode")
+    if "blink_mode" in preset_config:
+        preset.blink_mode = preset_config.get("blink_mode")
+    actions_config = preset_config.get("actions")
+    if actions_config:
+        # lists are built before being attached so that the model is only notified once per preset
+        actions = []
+        for action_config in actions_config:
+            action_type = action_config.get("type")
+            if not action_type:
+                raise Exception("Action does not have a action type: " + str(action_config))
+            if action_type not in ACTION_IDS:
+                raise Exception("Unknown action type: " + action_type)
+
+            messages = [Message.from_config(codec, action_config)
+                        for codec in message_codecs_in(action_config, MESSAGE_CODECS)]
+
+            messages_config = action_config.get("messages")
+            if messages_config:
+                for message_config in messages_config:
+                    for codec in message_codecs_in(message_config, MESSAGE_CODECS):
+                        message = Message.from_config(codec, message_config)
+                        if action_config.get("channel"):
+                            message.channel = action_config.get("channel")
+                        messages.append(message)
+            actions.append(Action(action_type, messages))
+        preset.actions = actions
+
+
+def configure_expression_preset(preset, preset_config):
+    preset.name = preset_config.get("name")
+    preset.toggle_name = preset_config.get("toggle_name")
+    preset.long_name = preset_config.get("long_name")
+    messages_config = preset_config.get("messages")
+    if messages_config:
+        preset.messages = [Message.from_config(codec, message_config)
+                           for message_config in messages_config
+                           for codec in message_codecs_in(message_config, EXPRESSION_CODECS)]
+
+
+def main(yaml_file, output_file=None, try_send=False, bank=None, file_format=FORMAT_HEX,
+         quiet=False, session=None) -> List[List[int]]:
+    config = yaml.load(yaml_file, Loader=YamlLoader)
+    if not quiet:
+        print(config)
     bank = convert_to_bank(config["bank"])
     data_bytes = bank.to_sysex()
-    formatted_data = format_data(data_bytes)
-    print(formatted_data)
+    if not quiet:
+        print(format_data(data_bytes))
 
     if output_file:
-        output_file.write(formatted_data)
-        output_file.write("\n")
+        write_sysex(output_file, bank.to_sysex_bytes(), file_format)
 
     if try_send:
-        morningstar.midi.send(data_bytes)
+        morningstar.midi.send(data_bytes, session)
+
+    return data_bytes
+
+
+def send_delta(data_bytes: List[List[int]], key: str, refresh_state=False, session=None,
+               state: DeviceState = None) -> bool:
+    """
+    Sends only the lines of a bank which differ from the last upload of the same bank, provided that was the last
+    bank uploaded to the device's current bank (or from a fresh dump of the current bank), and the whole bank
+    otherwise. The bank is only recorded as the device's new state once a dump confirms the device holds it.
+    """
+    if session is None:
+        with morningstar.midi.open_session() as session:
+            return session is not None and send_delta(data_bytes, key, refresh_state, session, state)
+    data = bytes([b for line in data_bytes for b in line])
+    state = state or DeviceState(morningstar.midi.device_name)
+    previous = session.request_bank_dump() if refresh_state else state.previous(key)
+    frames = delta_frames(previous, data)
+    print("Sending " + str(len(frames)) + " of " + str(NUM_BANK_LINES) + " lines for " + key)
+    if frames:
+        # until the upload is confirmed the device's current bank is unknown
+        state.set_current(None)
+        if not morningstar.midi.send_bank_lines(frames, data, session):
+            print("The device didn't confirm the upload of " + key + ", its state is unknown so the next upload will "
+                  "send the whole bank")
+            return False
+    state.save(key, data)
+    return True
+
+
+def state_key(inputfilename, args) -> str:
+    return "bank" + str(args["bank"]) if args.get("bank") is not None else \
+        os.path.splitext(os.path.basename(inputfilename))[0]
+
+
+def send(data_bytes: List[List[int]], inputfilename, args, session=None):
+    if args.get("delta"):
+        send_delta(data_bytes, state_key(inputfilename, args), args.get("refresh_state"), session)
+    else:
+        morningstar.midi.send(data_bytes, session)
+
+
+def process_file(inputfilename, outputfilename, args, session=None) -> List[List[int]]:
+    # delta uploads are sent from here so that they know which bank the file is
+    try_send = args["send"] and not args.get("delta")
+    with open(inputfilename, 'r') as inputfile:
+        if not outputfilename:
+            data_bytes = main(inputfile, None, try_send, args["bank"], quiet=args.get("quiet"), session=session)
+        else:
+            file_format = args["format"] or format_for_filename(outputfilename)
+            with open_output(outputfilename, file_format) as outputfile:
+                data_bytes = main(inputfile, outputfile, try_send, args["bank"], file_format, args.get("quiet"),
+                                  session)
+    if args["send"] and args.get("delta"):
+        send(data_bytes, inputfilename, args, session)
+    return data_bytes
+
 
+def process_pack_bank(packfilename, outputfilename, args, session=None) -> List[List[int]]:
+    """
+    Writes and sends bank args["bank"] (counting from 1) of a pack file, as process_file does for a YAML file
+    """
+    with PackReader(packfilename) as pack:
+        data = bytes(pack.bank_bytes(args["bank"] - 1))
+    data_bytes = [list(frame) for frame in iter_binary_frames(data)]
+    if not args.get("quiet"):
+        print(format_data(data_bytes))
+    if outputfilename:
+        file_format = args["format"] or format_for_filename(outputfilename)
+        with open_output(outputfilename, file_format) as outputfile:
+            write_sysex(outputfile, data, file_format)
+    if args["send"]:
+        send(data_bytes, packfilename, args, session)
     return data_bytes
 
 
-def process_file(inputfilename, outputfilename, args):
+def yaml_filenames(input_directory) -> List[str]:
+    return [os.path.join(input_directory, filename) for filename in sorted(os.listdir(input_directory))
+            if '.yml' in filename]
+
+
+def pack_is_current(packfilename, input_directory) -> bool:
+    """
+    Whether a pack file exists and is newer than every YAML file in the directory
+    """
+    try:
+        packed = os.stat(packfilename).st_mtime
+    except OSError:
+        return False
+    return all(os.stat(inputfilename).st_mtime <= packed for inputfilename in yaml_filenames(input_directory))
+
+
+def process_directory_bank(input_directory, outputfilename, args, session=None) -> List[List[int]]:
+    """
+    Converts bank args["bank"] of a directory, the YAML files being numbered in file name order from 1. The bank is
+    read from the directory's pack file if it is up to date, otherwise just its YAML file is converted.
+    """
+    packfilename = os.path.join(input_directory, DEFAULT_PACK_FILENAME)
+    if pack_is_current(packfilename, input_directory):
+        return process_pack_bank(packfilename, outputfilename, args, session)
+    inputfilenames = yaml_filenames(input_directory)
+    if not 1 <= args["bank"] <= len(inputfilenames):
+        raise Exception("There is no bank " + str(args["bank"]) + " in " + input_directory + " (" +
+                        str(len(inputfilenames)) + " YAML files)")
+    return process_file(inputfilenames[args["bank"] - 1], outputfilename, args, session)
+
+
+def load_bank(inputfilename) -> Bank:
     with open(inputfilename, 'r') as inputfile:
-        with open(outputfilename, 'w') as outputfile:
-            main(inputfile, outputfile, args["send"], args["bank"])
+        return convert_to_bank(yaml.load(inputfile, Loader=YamlLoader)["bank"])
+
+
+def process_directory_to_pack(input_directory, packfilename, args) -> bool:
+    """
+    Converts every YAML file in a directory into a single pack file, numbering the banks in file name order
+    """
+    jobs = args.get("jobs") or 1
+    tasks = [(inputfilename,) for inputfilename in yaml_filenames(input_directory)]
+    banks = []
+    for (inputfilename,), result in zip(tasks, run_jobs(load_bank, tasks, jobs)):
+        if isinstance(result, Exception):
+            print("Failed to convert " + inputfilename + ": " + str(result))
+            return False
+        banks.append(result)
+    # every bank is encoded at once with numpy if it is installed
+    with atomic_write(packfilename, 'wb') as packfile:
+        write_pack(packfile, banks_to_sysex_bytes(banks))
+    print("Packed " + str(len(banks)) + " banks into " + packfilename)
+    return True
+
+
+def process_directory(input_directory, output_directory, args) -> bool:
+    """
+    Converts every YAML file in a directory, in parallel if more than one job is requested. Results are reported in
+    file name order and any sends happen from this process, over one session, in the same order. Files whose output
+    is up to date according to the build cache are skipped, unless sending. Returns False if any file failed.
+    """
+    jobs = args.get("jobs") or 1
+    file_format = args["format"] or FORMAT_SYX
+    extension = extension_for_format(file_format)
+    cache_directory = args.get("cache_dir") or (os.path.join(output_directory, DEFAULT_CACHE_DIRECTORY)
+                                                if output_directory else None)
+    use_cache = output_directory and not args.get("no_cache") and not args["send"]
+    cache = BuildCache(cache_directory) if use_cache else None
+    # workers never send or print so that output doesn't interleave
+    worker_args = dict(args, send=False, quiet=args.get("quiet") or jobs > 1)
+    tasks = []
+    up_to_date = 0
+    for inputfilename in sorted(os.listdir(input_directory)):
+        if '.yml' not in inputfilename:
+            continue
+        inputfilename = os.path.join(input_directory, inputfilename)
+        outputfilename = os.path.join(output_directory, os.path.basename(inputfilename).replace('.yml', extension)) \
+            if output_directory else None
+        if cache:
+            reason = cache.reason_to_build(inputfilename, outputfilename, file_format)
+            if reason is None:
+                up_to_date += 1
+                if args.get("explain"):
+                    print("Skipping " + inputfilename + ": up to date")
+                continue
+            if args.get("explain"):
+                print("Rebuilding " + inputfilename + ": " + reason)
+        tasks.append((inputfilename, outputfilename, worker_args))
+
+    success = True
+    with morningstar.midi.open_session(args["send"]) as session:
+        for (inputfilename, outputfilename, _), result in zip(tasks, run_jobs(process_file, tasks, jobs)):
+            if isinstance(result, Exception):
+                print("Failed to convert " + inputfilename + ": " + str(result))
+                success = False
+                continue
+            print("Converted " + inputfilename + (" to " + outputfilename if outputfilename else ""))
+            if cache:
+                cache.record(inputfilename, outputfilename, file_format)
+            if session:
+                send(result, inputfilename, args, session)
+
+    if cache:
+        cache.save()
+        if up_to_date:
+            print(str(up_to_date) + " file(s) up to date")
+    return success
 
 
 if __name__ == "__main__":
@@ -132,33 +288,73 @@ if __name__ == "__main__":
     parser.add_argument('file', type=str,
                         help='yaml bank file')
     parser.add_argument('-o', '--output', type=str,
-                        help='output as file')
+                        help='output as file, or when converting a directory, a directory or a ' + PACK_EXTENSION +
+                             ' pack file holding every bank')
     parser.add_argument('-s', '--send', action='store_true',
                         help='attempt to send directly to device')
     parser.add_argument('-d', '--midi-device', dest='device', type=str,
                         help='alternate midi device name (default is "Morningstar MC6MK2")')
     parser.add_argument('-b', '--bank', type=int,
-                        help='export specific bank number')
+                        help='export specific bank number, counting from 1, from a pack file or a directory (using '
+                             'its ' + DEFAULT_PACK_FILENAME + ' if it is up to date)')
+    parser.add_argument('-f', '--format', type=str, choices=FORMATS,
+                        help='output format (default is chosen by output file extension: .syx for raw sysex, '
+                             '.mid for a MIDI file, otherwise hex text. Directories default to .syx)')
+    parser.add_argument('-j', '--jobs', type=int, nargs='?', const=os.cpu_count(), default=1,
+                        help='number of files to convert in parallel when converting a directory '
+                             '(default 1, or one per CPU if no number is given)')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='do not print the parsed config and generated sysex')
+    parser.add_argument('--cache-dir', dest='cache_dir', type=str,
+                        help='where to keep the build manifest used to skip unchanged files when converting a '
+                             'directory (default is "' + DEFAULT_CACHE_DIRECTORY + '" in the output directory)')
+    parser.add_argument('--no-cache', dest='no_cache', action='store_true',
+                        help='convert every file even if its output is up to date')
+    parser.add_argument('--explain', action='store_true',
+                        help='explain why each file was or was not converted')
+    parser.add_argument('--delta', action='store_true',
+                        help='when sending, only send the lines which differ from the last upload of the same bank')
+    parser.add_argument('--refresh-state', dest='refresh_state', action='store_true',
+                        help='with --delta, compare against a fresh dump of the current bank on the device rather '
+                             'than the last upload')
+    parser.add_argument('--frame-gap', dest='frame_gap', type=float, default=0,
+                        help='when sending, milliseconds to wait between frames (default 0)')
+    parser.add_argument('--window', type=int, default=morningstar.midi.default_window,
+                        help='when sending, frames which may be sent ahead of the device\'s acknowledgements '
+                             '(default ' + str(morningstar.midi.default_window) + ')')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running, converting each bank file (or every one in a directory) whenever it is '
+                             'saved, and with -s pushing only the presets which changed')
+    parser.add_argument('--poll', action='store_true',
+                        help='with --watch, look for changes by polling rather than with inotify')
 
     args = vars(parser.parse_args())
 
     if args["device"]:
         morningstar.midi.device_name = args["device"]
+    morningstar.midi.default_frame_gap = args["frame_gap"] / 1000
+    morningstar.midi.default_window = args["window"]
 
-    if os.path.isdir(args["file"]):
-        files = os.listdir(args["file"])
+    if args["watch"]:
+        from morningstar.watch import main as watch
+        watch(args["file"], args["send"], args["poll"])
+    elif is_pack_filename(args["file"]) or (os.path.isdir(args["file"]) and args["bank"] is not None):
+        if args["bank"] is None:
+            print("Choose a bank from the pack with -b")
+            exit(2)
+        process_bank = process_pack_bank if is_pack_filename(args["file"]) else process_directory_bank
+        with morningstar.midi.open_session(args["send"]) as session:
+            process_bank(args["file"], args["output"], args, session)
+    elif os.path.isdir(args["file"]) and args["output"] and is_pack_filename(args["output"]):
+        if not process_directory_to_pack(args["file"], args["output"], args):
+            exit(1)
+    elif os.path.isdir(args["file"]):
         if args["output"] and not os.path.isdir(args["output"]):
             print("Input file is a directory, but output file is not")
             exit(2)
 
-        for inputfilename in files:
-            if '.yml' not in inputfilename:
-                continue
-            outputfilename = inputfilename.replace('.yml', '.syx')
-
-            process_file(
-                os.path.join(args["file"], inputfilename),
-                os.path.join(args["output"], outputfilename),
-                args)
+        if not process_directory(args["file"], args["output"], args):
+            exit(1)
     else:
-        process_file(args["file"], args["output"], args)
+        with morningstar.midi.open_session(args["send"]) as session:
+            process_file(args["file"], args["output"], args, session)